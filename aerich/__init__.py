@@ -1,114 +1,708 @@
+import asyncio
+import logging
 import os
+import random
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from tortoise import Tortoise, generate_schema_for_client
-from tortoise.exceptions import OperationalError
 from tortoise.transactions import in_transaction
 from tortoise.utils import get_schema_sql
 
+from aerich.checkpoint import Checkpoint
+from aerich.ddl.sqlite.rebuild import TableRebuild
 from aerich.exceptions import DowngradeError
 from aerich.inspectdb.mysql import InspectMySQL
 from aerich.inspectdb.postgres import InspectPostgres
 from aerich.inspectdb.sqlite import InspectSQLite
-from aerich.migrate import MIGRATE_TEMPLATE, Migrate
+from aerich.migrate import MIGRATE_TEMPLATE, Migrator
 from aerich.models import Aerich
+from aerich.snapshot import SnapshotEncoder, apply_delta, get_delta_base, is_delta
 from aerich.utils import (
+    dedicated_connection,
+    dedicated_transaction,
     get_app_connection,
     get_app_connection_name,
     get_models_describe,
     import_py_file,
+    split_sql,
 )
 
+logger = logging.getLogger("aerich")
+
+
+class StatementTiming(NamedTuple):
+    version: Optional[str]
+    sql: str
+    seconds: float
+    # count of rows reported by the driver, None if unknown
+    rows: Optional[int]
+
 
 class Command:
+    # delay before the first retry of a statement which timed out waiting for a lock, doubled for
+    # each next retry up to the max, a random part of it is left out so retries don't line up
+    _LOCK_RETRY_DELAY = 0.5
+    _LOCK_RETRY_MAX_DELAY = 30.0
+    _SAVEPOINT = "aerich_statement"
+
     def __init__(
         self,
         tortoise_config: dict,
         app: str = "models",
         location: str = "./migrations",
+        slow_statement_seconds: float = 1.0,
+        lock_timeout: Optional[float] = None,
+        lock_retry_seconds: float = 60.0,
+        shadow_chunk_size: int = 1000,
+        shadow_chunk_sleep: float = 0.0,
     ):
+        """
+        :param tortoise_config:
+        :param app:
+        :param location:
+        :param slow_statement_seconds: statements running at least as long are reported as slow
+        :param lock_timeout: seconds a statement of upgrade waits for a lock, unless its migration
+            file declares lock_timeout, None to wait as long as the server does
+        :param lock_retry_seconds: statements which timed out waiting for a lock are retried
+            until they have been running that long
+        :param shadow_chunk_size: count of rows copied by one statement into a shadow table
+        :param shadow_chunk_sleep: seconds to sleep between chunks copied into a shadow table, to
+            throttle the copy
+        """
         self.tortoise_config = tortoise_config
         self.app = app
         self.location = location
-        Migrate.app = app
+        self.slow_statement_seconds = slow_statement_seconds
+        self.lock_timeout = lock_timeout
+        self.lock_retry_seconds = lock_retry_seconds
+        self.shadow_chunk_size = shadow_chunk_size
+        self.shadow_chunk_sleep = shadow_chunk_sleep
+        self.migrator = Migrator(app)
+        # statements executed by upgrade and downgrade
+        self.statement_timings: List[StatementTiming] = []
+
+    @property
+    def slow_statements(self) -> List[StatementTiming]:
+        return [
+            timing
+            for timing in self.statement_timings
+            if timing.seconds >= self.slow_statement_seconds
+        ]
 
     async def init(self):
-        await Migrate.init(self.tortoise_config, self.app, self.location)
+        await self.migrator.init(self.tortoise_config, self.app, self.location)
 
-    async def _upgrade(self, conn, version_file):
-        file_path = Path(Migrate.migrate_location, version_file)
-        m = import_py_file(file_path)
-        upgrade = getattr(m, "upgrade")
-        await conn.execute_script(await upgrade(conn))
-        await Aerich.create(
+    async def _run_statement(self, conn, sql: str, fallback: str = "inplace") -> Optional[int]:
+        """
+        run one statement, a statement with an online algorithm rejected by the server is retried
+        with the fallback algorithm, or on a shadow copy of the table, changes of columns the
+        dialect can't alter rebuild the table
+        :param conn:
+        :param sql:
+        :param fallback: none, inplace, copy or shadow
+        :return: count of rows reported by the driver, None if unknown
+        """
+        ddl = self.migrator.ddl
+        if ddl.TABLE_REBUILD:
+            rebuild_table = ddl.parse_rebuild_table(sql)
+            if rebuild_table:
+                return await TableRebuild(conn, *rebuild_table).run()
+        while True:
+            try:
+                rows, _ = await conn.execute_query(sql)
+                return ddl.get_row_count(sql, rows)
+            except Exception as e:
+                fallback_sql = ddl.get_algorithm_fallback(sql, e, fallback)
+                if fallback_sql is None:
+                    raise
+                if fallback == "shadow" and await self._alter_shadow_table(fallback_sql):
+                    return None
+                sql = fallback_sql
+
+    async def _retry_on_lock_timeout(
+        self,
+        conn,
+        version: Optional[str],
+        sql: str,
+        statement: Callable[[], Awaitable[Optional[int]]],
+        in_transaction: bool = False,
+    ) -> Optional[int]:
+        """
+        run a statement, while it times out waiting for a lock retry it with jittered exponential
+        backoff, until lock_retry_seconds have passed, so it doesn't queue the queries of a busy
+        table behind it
+        :param conn:
+        :param version:
+        :param sql:
+        :param statement: runs the statement and returns its row count
+        :param in_transaction: conn is in a transaction
+        :return: count of rows reported by the driver, None if unknown
+        """
+        ddl = self.migrator.ddl
+        savepoint = ddl.SAVEPOINT_RETRY and in_transaction
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if savepoint:
+                await conn.execute_script(f"SAVEPOINT {self._SAVEPOINT}")
+            try:
+                rows = await statement()
+            except Exception as e:
+                if savepoint:
+                    await conn.execute_script(f"ROLLBACK TO SAVEPOINT {self._SAVEPOINT}")
+                delay = min(self._LOCK_RETRY_MAX_DELAY, self._LOCK_RETRY_DELAY * 2**attempt)
+                delay = random.uniform(delay / 2, delay)
+                if (
+                    not ddl.is_lock_timeout(e)
+                    or time.monotonic() - start + delay > self.lock_retry_seconds
+                ):
+                    raise
+                logger.warning(
+                    "Statement of %s timed out waiting for a lock, retrying in %.2fs: %s",
+                    version,
+                    delay,
+                    sql,
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if savepoint:
+                await conn.execute_script(f"RELEASE SAVEPOINT {self._SAVEPOINT}")
+            return rows
+
+    async def _execute_statements(
+        self,
+        version: Optional[str],
+        statements: List[str],
+        run: Callable[[str], Awaitable[Optional[int]]],
+        checkpoint: Optional[Checkpoint] = None,
+        section: str = "upgrade",
+    ):
+        """
+        execute statements one by one, statements applied before the checkpoint are skipped and
+        the checkpoint is saved after each one
+        :param version: version file of the statements
+        :param statements:
+        :param run: runs a statement and returns its row count
+        :param checkpoint: None if the statements run in a transaction
+        :param section: pre_upgrade, upgrade or post_upgrade
+        :return:
+        """
+        for index, sql in enumerate(statements):
+            if checkpoint and checkpoint.is_applied(section, index):
+                continue
+            await self._timed(version, sql, run(sql))
+            if checkpoint:
+                await checkpoint.save(section, index + 1)
+
+    async def _execute_script(
+        self,
+        conn,
+        script: str,
+        fallback: str = "inplace",
+        version: Optional[str] = None,
+        checkpoint: Optional[Checkpoint] = None,
+        lock_retry: bool = False,
+    ):
+        """
+        execute migration script statement by statement, the wall time and row count of each one
+        are recorded in statement_timings
+        :param conn:
+        :param script:
+        :param fallback: none, inplace, copy or shadow
+        :param version: version file of the script
+        :param checkpoint: checkpoint of the version if it runs outside of a transaction
+        :param lock_retry: retry statements which timed out waiting for a lock
+        :return:
+        """
+
+        def run(sql: str) -> Awaitable[Optional[int]]:
+            if not lock_retry:
+                return self._run_statement(conn, sql, fallback)
+            # statements without a checkpoint run in a transaction
+            return self._retry_on_lock_timeout(
+                conn,
+                version,
+                sql,
+                lambda: self._run_statement(conn, sql, fallback),
+                checkpoint is None,
+            )
+
+        await self._execute_statements(
+            version, split_sql(script, self.migrator.ddl.DIALECT), run, checkpoint
+        )
+
+    async def _timed(self, version: Optional[str], sql: str, statement: Awaitable[Optional[int]]):
+        """
+        await a statement, record its wall time and row count, and log it, before it starts so a
+        statement holding up the migration can be found, and after it ends if it's slow
+        :param version:
+        :param sql:
+        :param statement: awaitable returning the row count
+        :return:
+        """
+        logger.info("Executing statement of %s: %s", version, sql)
+        start = time.perf_counter()
+        try:
+            rows = await statement
+        except Exception:
+            logger.error(
+                "Statement of %s failed after %.3fs: %s",
+                version,
+                time.perf_counter() - start,
+                sql,
+            )
+            raise
+        timing = StatementTiming(version, sql, time.perf_counter() - start, rows)
+        self.statement_timings.append(timing)
+        if timing.seconds >= self.slow_statement_seconds:
+            logger.warning("Slow statement of %s took %.3fs: %s", version, timing.seconds, sql)
+
+    async def _alter_shadow_table(self, sql: str) -> bool:
+        """
+        run an alteration on a shadow copy of the table, then swap the tables
+        :param sql:
+        :return: False if sql can't run on a shadow table
+        """
+        alter_table = self.migrator.ddl.parse_alter_table(sql)
+        if "ALGORITHM=" in sql or not alter_table:
+            return False
+        # only mysql has shadow tables, its backend requires the driver
+        from aerich.ddl.mysql.shadow import ShadowTable
+
+        table_name, alter_clauses = alter_table
+        await ShadowTable(
+            get_app_connection(self.tortoise_config, self.app),
+            table_name,
+            alter_clauses,
+            self.shadow_chunk_size,
+            self.shadow_chunk_sleep,
+        ).run()
+        return True
+
+    @asynccontextmanager
+    async def _foreign_keys_off(self, conn):
+        """
+        turn foreign keys off while migrating if the dialect rebuilds tables, otherwise dropping
+        the old table deletes or checks the rows referencing it, they can't be turned off inside
+        the migration transaction
+        :param conn: connection not in a transaction
+        :return:
+        """
+        ddl = self.migrator.ddl
+        if not ddl.TABLE_REBUILD or not await ddl.disable_foreign_keys(conn):
+            yield
+            return
+        try:
+            yield
+        finally:
+            await ddl.enable_foreign_keys(conn)
+
+    @asynccontextmanager
+    async def _tuned(self, conn, tune: bool):
+        """
+        tune connection settings for the migrations, restore them afterwards
+        :param conn: connection not in a transaction
+        :param tune:
+        :return:
+        """
+        if not tune:
+            yield
+            return
+        ddl = self.migrator.ddl
+        settings = await ddl.tune_for_migration(conn)
+        try:
+            yield
+        finally:
+            await ddl.restore_tuning(conn, settings)
+
+    @asynccontextmanager
+    async def _session_settings(self, conn, settings: Dict[str, Any]):
+        """
+        change session settings declared by a migration file, restore them afterwards
+        :param conn:
+        :param settings: settings returned by get_migration_settings
+        :return:
+        """
+        if not settings:
+            yield
+            return
+        ddl = self.migrator.ddl
+        previous = await ddl.set_session_settings(conn, settings)
+        try:
+            yield
+        finally:
+            await ddl.set_session_settings(conn, previous)
+
+    def _get_migration_settings(self, m) -> Dict[str, Any]:
+        """
+        get session settings declared by module attributes lock_timeout and statement_timeout, in
+        seconds, and session_settings of a migration file
+        :param m: migration module
+        :return:
+        """
+        return self.migrator.ddl.get_migration_settings(
+            getattr(m, "lock_timeout", self.lock_timeout),
+            getattr(m, "statement_timeout", None),
+            getattr(m, "session_settings", None),
+        )
+
+    def _new_version(
+        self, version_file: str, snapshot_encoder: SnapshotEncoder, describe: dict
+    ) -> Aerich:
+        return Aerich(
             version=version_file,
             app=self.app,
-            content=get_models_describe(self.app),
+            content=snapshot_encoder.encode(version_file, describe),
         )
 
-    async def upgrade(self, run_in_transaction: bool = True):
+    async def _upgrade(
+        self,
+        conn,
+        m,
+        version_file,
+        fallback: str = "inplace",
+        checkpoint: Optional[Checkpoint] = None,
+        settings: Optional[Dict[str, Any]] = None,
+        lock_retry: bool = False,
+    ):
+        upgrade = getattr(m, "upgrade")
+        ddl = self.migrator.ddl
+        # without a checkpoint conn is a transaction, the settings are changed for it only if the
+        # dialect can, e.g. SET LOCAL on postgres
+        local = checkpoint is None
+        previous = await ddl.set_session_settings(conn, settings or {}, local)
+        try:
+            await self._execute_script(
+                conn, await upgrade(conn), fallback, version_file, checkpoint, lock_retry
+            )
+        except Exception:
+            # a failed transaction reverts local settings and can't run more statements
+            if not (local and ddl.LOCAL_SESSION_SETTINGS):
+                await ddl.set_session_settings(conn, previous, local)
+            raise
+        # restored for the next versions sharing the transaction of a batch
+        await ddl.set_session_settings(conn, previous, local)
+
+    async def _get_non_transactional_sql(self, conn, m, section: str) -> List[str]:
+        func = getattr(m, section, None)
+        if func is None:
+            return []
+        return await func(conn)
+
+    async def _run_non_transactional_statement(self, conn, sql: str) -> None:
+        """
+        run a statement which can't run inside a transaction, an invalid index left by a failed
+        concurrent build is dropped before the build is retried and after it fails
+        :param conn: connection not in a transaction
+        :param sql:
+        :return:
+        """
+        ddl = self.migrator.ddl
+        index_name = ddl.get_concurrent_index_name(sql)
+        if index_name:
+            await ddl.drop_invalid_index(conn, index_name)
+        try:
+            await conn.execute_script(sql)
+        except Exception:
+            if index_name:
+                await ddl.drop_invalid_index(conn, index_name)
+            raise
+
+    async def _execute_non_transactional(
+        self,
+        conn,
+        sql_list: List[str],
+        version: Optional[str] = None,
+        checkpoint: Optional[Checkpoint] = None,
+        section: str = "pre_upgrade",
+        lock_retry: bool = False,
+    ):
+        """
+        execute statements which can't run inside a transaction one by one
+        :param conn: connection not in a transaction
+        :param sql_list:
+        :param version: version file of the statements
+        :param checkpoint: checkpoint of the version if it runs outside of a transaction
+        :param section: pre_upgrade, post_upgrade, pre_downgrade or post_downgrade
+        :param lock_retry: retry statements which timed out waiting for a lock
+        :return:
+        """
+
+        def run(sql: str) -> Awaitable[None]:
+            if not lock_retry:
+                return self._run_non_transactional_statement(conn, sql)
+            return self._retry_on_lock_timeout(
+                conn, version, sql, lambda: self._run_non_transactional_statement(conn, sql)
+            )
+
+        await self._execute_statements(version, sql_list, run, checkpoint, section)
+
+    async def _load_checkpoint(self, conn, version_file: str) -> Checkpoint:
+        checkpoint = Checkpoint(conn, self.migrator.ddl, self.app, version_file)
+        await checkpoint.load()
+        if checkpoint.section is not None:
+            logger.info(
+                "Resuming %s at statement %d of %s",
+                version_file,
+                checkpoint.statements + 1,
+                checkpoint.section,
+            )
+        return checkpoint
+
+    async def _upgrade_version(
+        self,
+        version_file: str,
+        m,
+        snapshot_encoder: SnapshotEncoder,
+        describe: dict,
+        run_in_transaction: bool = True,
+        fallback: str = "inplace",
+    ):
+        atomic = run_in_transaction and getattr(m, "atomic", True)
+        settings = self._get_migration_settings(m)
+        lock_retry = getattr(m, "lock_timeout", self.lock_timeout) is not None
+        checkpoint = None
+        # all statements and the transaction run on one connection, which has the settings
+        async with dedicated_connection(get_app_connection(self.tortoise_config, self.app)) as conn:
+            # the version is recorded after post_upgrade, until then the checkpoint records that
+            # the transaction is committed, so a failed post_upgrade resumes without running it
+            if not atomic or hasattr(m, "post_upgrade"):
+                checkpoint = await self._load_checkpoint(conn, version_file)
+            async with self._session_settings(conn, settings):
+                await self._execute_non_transactional(
+                    conn,
+                    await self._get_non_transactional_sql(conn, m, "pre_upgrade"),
+                    version_file,
+                    checkpoint,
+                    "pre_upgrade",
+                    lock_retry,
+                )
+                async with self._foreign_keys_off(conn):
+                    if atomic and not (checkpoint and checkpoint.is_applied("upgrade", 0)):
+                        async with dedicated_transaction(conn) as transaction:
+                            await self._upgrade(
+                                transaction,
+                                m,
+                                version_file,
+                                fallback,
+                                settings=settings,
+                                lock_retry=lock_retry,
+                            )
+                            if checkpoint:
+                                await checkpoint.save("post_upgrade", 0, transaction)
+                            else:
+                                await self._new_version(
+                                    version_file, snapshot_encoder, describe
+                                ).save(using_db=transaction)
+                    elif not atomic:
+                        await self._upgrade(
+                            conn, m, version_file, fallback, checkpoint, settings, lock_retry
+                        )
+                await self._execute_non_transactional(
+                    conn,
+                    await self._get_non_transactional_sql(conn, m, "post_upgrade"),
+                    version_file,
+                    checkpoint,
+                    "post_upgrade",
+                    lock_retry,
+                )
+            if checkpoint:
+                # recorded after post_upgrade, or a failed post_upgrade would never run again
+                await self._new_version(version_file, snapshot_encoder, describe).save(
+                    using_db=conn
+                )
+                await checkpoint.delete()
+
+    @staticmethod
+    def _can_batch(m) -> bool:
+        """
+        :param m: migration module
+        :return: False if the migration file has statements which run outside of a transaction
+        """
+        return getattr(m, "atomic", True) and not any(
+            hasattr(m, section) for section in ("pre_upgrade", "post_upgrade")
+        )
+
+    async def _upgrade_batch(
+        self,
+        versions: List[Tuple[str, Any]],
+        snapshot_encoder: SnapshotEncoder,
+        describe: dict,
+        fallback: str = "inplace",
+    ) -> List[str]:
+        """
+        apply versions in one transaction and record them with one insert
+        :param versions: version files and their migration modules
+        :param snapshot_encoder:
+        :param describe: models describe stored for each version
+        :param fallback: none, inplace, copy or shadow
+        :return: applied version files
+        """
+        if not versions:
+            return []
+        app_conn = get_app_connection(self.tortoise_config, self.app)
+        async with self._foreign_keys_off(app_conn), in_transaction(
+            get_app_connection_name(self.tortoise_config, self.app)
+        ) as conn:
+            for version_file, m in versions:
+                await self._upgrade(
+                    conn,
+                    m,
+                    version_file,
+                    fallback,
+                    settings=self._get_migration_settings(m),
+                    lock_retry=getattr(m, "lock_timeout", self.lock_timeout) is not None,
+                )
+            await Aerich.bulk_create(
+                [
+                    self._new_version(version_file, snapshot_encoder, describe)
+                    for version_file, _ in versions
+                ]
+            )
+        return [version_file for version_file, _ in versions]
+
+    async def upgrade(
+        self,
+        run_in_transaction: bool = True,
+        fallback: str = "inplace",
+        tune: bool = False,
+        batch: bool = False,
+    ):
+        """
+        :param run_in_transaction: if False, a checkpoint is saved after each statement, so
+            upgrading again after a failure resumes at the first statement not applied, a
+            migration file declaring atomic = False runs outside of a transaction either way
+        :param fallback: none, inplace, copy or shadow
+        :param tune: tune connection settings for the migrations, e.g. sqlite pragmas
+        :param batch: apply consecutive versions in one transaction and record them with one
+            insert, a version with statements which run outside of a transaction ends the batch
+        :return: migrated version files
+        """
         migrated = []
-        for version_file in Migrate.get_all_version_files():
-            try:
-                exists = await Aerich.exists(version=version_file, app=self.app)
-            except OperationalError:
-                exists = False
-            if not exists:
-                app_conn_name = get_app_connection_name(self.tortoise_config, self.app)
-                if run_in_transaction:
-                    async with in_transaction(app_conn_name) as conn:
-                        await self._upgrade(conn, version_file)
-                else:
-                    app_conn = get_app_connection(self.tortoise_config, self.app)
-                    await self._upgrade(app_conn, version_file)
+        applied_versions = await self.migrator.get_applied_versions()
+        version_files = [
+            version_file
+            for version_file in self.migrator.get_all_version_files()
+            if version_file not in applied_versions
+        ]
+        if not version_files:
+            return migrated
+        # decodes the latest snapshot, only needed when there is something to upgrade
+        snapshot_encoder = await self.migrator.get_snapshot_encoder()
+        # models don't change while upgrading, each version stores the same describe
+        describe = get_models_describe(self.app)
+        batch = batch and run_in_transaction
+        pending: List[Tuple[str, Any]] = []
+        async with self._tuned(get_app_connection(self.tortoise_config, self.app), tune):
+            for version_file in version_files:
+                m = import_py_file(Path(self.migrator.migrate_location, version_file))
+                if batch and self._can_batch(m):
+                    pending.append((version_file, m))
+                    continue
+                migrated += await self._upgrade_batch(pending, snapshot_encoder, describe, fallback)
+                pending = []
+                await self._upgrade_version(
+                    version_file, m, snapshot_encoder, describe, run_in_transaction, fallback
+                )
                 migrated.append(version_file)
+            migrated += await self._upgrade_batch(pending, snapshot_encoder, describe, fallback)
         return migrated
 
     async def downgrade(self, version: int, delete: bool):
         ret = []
         if version == -1:
-            specified_version = await Migrate.get_last_version()
+            specified_version = await self.migrator.get_last_version(with_content=False)
         else:
-            specified_version = await Aerich.filter(
-                app=self.app, version__startswith=f"{version}_"
-            ).first()
+            specified_version = (
+                await Aerich.filter(app=self.app, version__startswith=f"{version}_")
+                .only("id", "version")
+                .first()
+            )
         if not specified_version:
             raise DowngradeError("No specified version found")
         if version == -1:
             versions = [specified_version]
         else:
-            versions = await Aerich.filter(app=self.app, pk__gte=specified_version.pk)
+            versions = await Aerich.filter(app=self.app, pk__gte=specified_version.pk).only(
+                "id", "version"
+            )
+        app_conn = get_app_connection(self.tortoise_config, self.app)
         for version in versions:
             file = version.version
-            async with in_transaction(
-                get_app_connection_name(self.tortoise_config, self.app)
-            ) as conn:
-                file_path = Path(Migrate.migrate_location, file)
-                m = import_py_file(file_path)
-                downgrade = getattr(m, "downgrade")
-                downgrade_sql = await downgrade(conn)
-                if not downgrade_sql.strip():
-                    raise DowngradeError("No downgrade items found")
-                await conn.execute_script(downgrade_sql)
+            file_path = Path(self.migrator.migrate_location, file)
+            m = import_py_file(file_path)
+            pre_downgrade_sql = await self._get_non_transactional_sql(app_conn, m, "pre_downgrade")
+            post_downgrade_sql = await self._get_non_transactional_sql(
+                app_conn, m, "post_downgrade"
+            )
+            # the version is deleted after post_downgrade, until then the checkpoint records that
+            # the transaction is committed, so a failed post_downgrade resumes without running it
+            checkpoint = None
+            if post_downgrade_sql:
+                checkpoint = await self._load_checkpoint(app_conn, file)
+            await self._execute_non_transactional(
+                app_conn, pre_downgrade_sql, file, checkpoint, "pre_downgrade"
+            )
+            if not (checkpoint and checkpoint.is_applied("downgrade", 0)):
+                async with self._foreign_keys_off(app_conn), in_transaction(
+                    get_app_connection_name(self.tortoise_config, self.app)
+                ) as conn:
+                    downgrade = getattr(m, "downgrade")
+                    downgrade_sql = await downgrade(conn)
+                    if not (downgrade_sql.strip() or pre_downgrade_sql or post_downgrade_sql):
+                        raise DowngradeError("No downgrade items found")
+                    await self._execute_script(conn, downgrade_sql, version=file)
+                    if checkpoint:
+                        await checkpoint.save("post_downgrade", 0, conn)
+                    else:
+                        await version.delete()
+            await self._execute_non_transactional(
+                app_conn, post_downgrade_sql, file, checkpoint, "post_downgrade"
+            )
+            if checkpoint:
                 await version.delete()
-                if delete:
-                    os.unlink(file_path)
-                ret.append(file)
+                await checkpoint.delete()
+            if delete:
+                os.unlink(file_path)
+            ret.append(file)
         return ret
 
     async def heads(self):
-        ret = []
-        versions = Migrate.get_all_version_files()
-        for version in versions:
-            if not await Aerich.exists(version=version, app=self.app):
-                ret.append(version)
-        return ret
+        applied_versions = await self.migrator.get_applied_versions()
+        return [
+            version
+            for version in self.migrator.get_all_version_files()
+            if version not in applied_versions
+        ]
 
     async def history(self):
-        versions = Migrate.get_all_version_files()
+        versions = self.migrator.get_all_version_files()
         return [version for version in versions]
 
+    async def compact(self) -> int:
+        """
+        rewrite stored snapshots of app history into full snapshots and deltas
+        :return: count of rewritten versions
+        """
+        async with in_transaction(get_app_connection_name(self.tortoise_config, self.app)):
+            versions = await Aerich.filter(app=self.app).order_by("id")
+            snapshot_encoder = SnapshotEncoder()
+            bases = {}
+            for version in versions:
+                content = version.content
+                if is_delta(content):
+                    content = apply_delta(bases[get_delta_base(content)], content)
+                else:
+                    bases[version.version] = content
+                await Aerich.filter(pk=version.pk).update(
+                    content=snapshot_encoder.encode(version.version, content)
+                )
+        return len(versions)
+
     async def inspectdb(self, tables: List[str] = None) -> str:
         connection = get_app_connection(self.tortoise_config, self.app)
         dialect = connection.schema_generator.DIALECT
@@ -123,8 +717,14 @@ class Command:
         inspect = cls(connection, tables)
         return await inspect.inspect()
 
-    async def migrate(self, name: str = "update", empty: bool = False) -> str:
-        return await Migrate.migrate(name, empty)
+    async def migrate(
+        self,
+        name: str = "update",
+        empty: bool = False,
+        coalesce: bool = False,
+        online: bool = False,
+    ) -> str:
+        return await self.migrator.migrate(name, empty, coalesce, online)
 
     async def init_db(self, safe: bool):
         location = self.location
@@ -138,7 +738,7 @@ class Command:
 
         schema = get_schema_sql(connection, safe)
 
-        version = await Migrate.generate_version()
+        version = await self.migrator.generate_version()
         await Aerich.create(
             version=version,
             app=app,
@@ -0,0 +1,107 @@
+from typing import Optional
+
+from tortoise import BaseDBAsyncClient
+
+from aerich.ddl import BaseDDL
+
+# sections of a version in the order they run
+SECTIONS = ("pre_upgrade", "upgrade", "post_upgrade")
+DOWNGRADE_SECTIONS = ("pre_downgrade", "downgrade", "post_downgrade")
+
+
+class Checkpoint:
+    """
+    Statements of a version applied outside of a transaction, saved in a tracking table after
+    each one, so an interrupted upgrade or downgrade resumes at the first statement not applied.
+    """
+
+    TABLE_NAME = "aerich_checkpoint"
+
+    def __init__(self, conn: BaseDBAsyncClient, ddl: BaseDDL, app: str, version: str):
+        self.conn = conn
+        self.ddl = ddl
+        self.app = app
+        self.version = version
+        # section and count of its statements applied, None if nothing is applied
+        self.section: Optional[str] = None
+        self.statements = 0
+
+    def _quote(self, name: str) -> str:
+        return self.ddl.schema_generator.quote(name)
+
+    def _where(self, index: int = 1) -> str:
+        """
+        :param index: position of the app parameter, parameters are positional for some dialects
+        :return:
+        """
+        return (
+            f"{self._quote('app')} = {self.ddl.get_parameter(index)} AND "
+            f"{self._quote('version')} = {self.ddl.get_parameter(index + 1)}"
+        )
+
+    async def load(self):
+        """
+        create the tracking table if it doesn't exist and load the checkpoint of the version
+        :return:
+        """
+        quote = self._quote
+        await self.conn.execute_script(
+            f"CREATE TABLE IF NOT EXISTS {quote(self.TABLE_NAME)} ("
+            f"{quote('app')} VARCHAR(100) NOT NULL, {quote('version')} VARCHAR(255) NOT NULL, "
+            f"{quote('section')} VARCHAR(20) NOT NULL, {quote('statements')} INT NOT NULL, "
+            f"PRIMARY KEY ({quote('app')}, {quote('version')}))"
+        )
+        rows = await self.conn.execute_query_dict(
+            f"SELECT {quote('section')}, {quote('statements')} FROM {quote(self.TABLE_NAME)} "
+            f"WHERE {self._where()}",
+            [self.app, self.version],
+        )
+        if rows:
+            self.section = rows[0]["section"]
+            self.statements = rows[0]["statements"]
+
+    def is_applied(self, section: str, index: int) -> bool:
+        """
+        :param section: one of SECTIONS or DOWNGRADE_SECTIONS
+        :param index: index of the statement in the section
+        :return:
+        """
+        if self.section is None:
+            return False
+        if section != self.section:
+            sections = SECTIONS if section in SECTIONS else DOWNGRADE_SECTIONS
+            return sections.index(section) < sections.index(self.section)
+        return index < self.statements
+
+    async def save(self, section: str, statements: int, conn: Optional[BaseDBAsyncClient] = None):
+        """
+        :param section: one of SECTIONS or DOWNGRADE_SECTIONS
+        :param statements: count of statements of the section applied
+        :param conn: transaction the checkpoint is saved in, the checkpoint connection if None
+        :return:
+        """
+        quote, parameter = self._quote, self.ddl.get_parameter
+        conn = conn or self.conn
+        if self.section is None:
+            await conn.execute_query(
+                f"INSERT INTO {quote(self.TABLE_NAME)} ({quote('app')}, {quote('version')}, "
+                f"{quote('section')}, {quote('statements')}) "
+                f"VALUES ({parameter(1)}, {parameter(2)}, {parameter(3)}, {parameter(4)})",
+                [self.app, self.version, section, statements],
+            )
+        else:
+            await conn.execute_query(
+                f"UPDATE {quote(self.TABLE_NAME)} SET {quote('section')} = {parameter(1)}, "
+                f"{quote('statements')} = {parameter(2)} WHERE {self._where(3)}",
+                [section, statements, self.app, self.version],
+            )
+        self.section = section
+        self.statements = statements
+
+    async def delete(self):
+        await self.conn.execute_query(
+            f"DELETE FROM {self._quote(self.TABLE_NAME)} WHERE {self._where()}",
+            [self.app, self.version],
+        )
+        self.section = None
+        self.statements = 0
@@ -1,8 +1,9 @@
 import asyncio
+import logging
 import os
 from functools import wraps
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import click
 import tomlkit
@@ -80,11 +81,25 @@ async def cli(ctx: Context, config, app):
 @cli.command(help="Generate migrate changes file.")
 @click.option("--name", default="update", show_default=True, help="Migrate name.")
 @click.option("--empty", default=False, is_flag=True, help="Generate empty migration file.")
+@click.option(
+    "--coalesce",
+    default=False,
+    is_flag=True,
+    help="Merge alterations of the same table into one ALTER TABLE statement.",
+)
+@click.option(
+    "--online",
+    default=False,
+    is_flag=True,
+    help="Alter existing tables without blocking writes: build indexes concurrently, validate "
+    "foreign keys and NOT NULL through a CHECK constraint after adding them NOT VALID on "
+    "Postgres, and add ALGORITHM/LOCK hints on MySQL.",
+)
 @click.pass_context
 @coro
-async def migrate(ctx: Context, name):
+async def migrate(ctx: Context, name, empty, coalesce, online):
     command = ctx.obj["command"]
-    ret = await command.migrate(name)
+    ret = await command.migrate(name, empty, coalesce, online)
     if not ret:
         return click.secho("No changes detected", fg=Color.yellow)
     click.secho(f"Success migrate {ret}", fg=Color.green)
@@ -98,11 +113,95 @@ async def migrate(ctx: Context, name):
     type=bool,
     help="Make migrations in transaction or not. Can be helpful for large migrations or creating concurrent indexes.",
 )
+@click.option(
+    "--fallback",
+    default="inplace",
+    type=click.Choice(["none", "inplace", "copy", "shadow"]),
+    show_default=True,
+    help="Retry an alteration rejected by MySQL with ALGORITHM=INPLACE, LOCK=NONE (inplace), then without algorithm (copy) or on a shadow copy of the table (shadow).",
+)
+@click.option(
+    "--tune",
+    default=False,
+    is_flag=True,
+    help="Tune SQLite pragmas for faster migrations, restore them and run PRAGMA optimize afterwards.",
+)
+@click.option(
+    "--slow",
+    default=1.0,
+    type=float,
+    show_default=True,
+    help="Report statements running at least this many seconds.",
+)
+@click.option(
+    "--verbose",
+    is_flag=True,
+    default=False,
+    help="Print each statement before it runs, to find the one holding up a migration.",
+)
+@click.option(
+    "--lock-timeout",
+    default=None,
+    type=float,
+    help="Seconds a statement waits for a lock before it's retried, unless its migration file declares lock_timeout.",
+)
+@click.option(
+    "--lock-retry",
+    default=60.0,
+    type=float,
+    show_default=True,
+    help="Seconds statements which timed out waiting for a lock are retried with backoff.",
+)
+@click.option(
+    "--shadow-chunk-size",
+    default=1000,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="Rows copied by one statement into a shadow table with --fallback shadow.",
+)
+@click.option(
+    "--shadow-chunk-sleep",
+    default=0.0,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    help="Seconds to sleep between chunks copied into a shadow table, to throttle the copy.",
+)
+@click.option(
+    "--batch",
+    is_flag=True,
+    default=False,
+    help="Apply consecutive versions in one transaction and record them with one insert.",
+)
 @click.pass_context
 @coro
-async def upgrade(ctx: Context, in_transaction: bool):
+async def upgrade(
+    ctx: Context,
+    in_transaction: bool,
+    fallback: str,
+    tune: bool,
+    slow: float,
+    verbose: bool,
+    lock_timeout: Optional[float],
+    lock_retry: float,
+    shadow_chunk_size: int,
+    shadow_chunk_sleep: float,
+    batch: bool,
+):
     command = ctx.obj["command"]
-    migrated = await command.upgrade(run_in_transaction=in_transaction)
+    command.slow_statement_seconds = slow
+    command.lock_timeout = lock_timeout
+    command.lock_retry_seconds = lock_retry
+    command.shadow_chunk_size = shadow_chunk_size
+    command.shadow_chunk_sleep = shadow_chunk_sleep
+    if verbose:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger = logging.getLogger("aerich")
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    migrated = await command.upgrade(
+        run_in_transaction=in_transaction, fallback=fallback, tune=tune, batch=batch
+    )
     if not migrated:
         click.secho("No upgrade items found", fg=Color.yellow)
     else:
@@ -166,6 +265,15 @@ async def history(ctx: Context):
         click.secho(version, fg=Color.green)
 
 
+@cli.command(help="Compact stored models snapshots of migrate history.")
+@click.pass_context
+@coro
+async def compact(ctx: Context):
+    command = ctx.obj["command"]
+    count = await command.compact()
+    click.secho(f"Success compact {count} versions", fg=Color.green)
+
+
 @cli.command(help="Init config file and generate root migrate location.")
 @click.option(
     "-t",
@@ -1,31 +1,93 @@
 import base64
+import functools
+import importlib
 import json
 import pickle  # nosec: B301,B403
+import zlib
 
 from tortoise.indexes import Index
 
+# attributes of an index that can be stored as plain json fields
+INDEX_ATTRS = {"fields", "name", "expressions", "extra"}
+
+
+def _index_class_path(index: Index) -> str:
+    return f"{index.__class__.__module__}.{index.__class__.__qualname__}"
+
+
+@functools.lru_cache(maxsize=None)
+def _load_index_class(path: str):
+    module_name, class_name = path.rsplit(".", 1)
+    index_class = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(index_class, type) and issubclass(index_class, Index)):
+        raise TypeError(f"{path} is not an index class")
+    return index_class
+
+
+def encode_index(index: Index) -> dict:
+    """
+    encode index as structured fields, fallback to pickle for expressions and unknown attributes
+    :param index:
+    :return:
+    """
+    attrs = {attr for attr in index.__dict__ if not attr.startswith("__")}
+    if index.expressions or attrs.difference(INDEX_ATTRS):
+        return {
+            "type": "index",
+            "val": base64.b64encode(pickle.dumps(index)).decode(),  # nosec: B301
+        }
+    return {
+        "type": "index",
+        "class": _index_class_path(index),
+        "fields": index.fields,
+        "name": index.name,
+        "extra": index.extra,
+    }
+
+
+def decode_index(obj: dict) -> Index:
+    if "val" in obj:
+        # legacy format
+        return pickle.loads(base64.b64decode(obj["val"]))  # nosec: B301
+    index_class = _load_index_class(obj["class"])
+    index = index_class.__new__(index_class)
+    index.fields = list(obj["fields"])
+    index.name = obj["name"]
+    index.expressions = ()
+    index.extra = obj["extra"]
+    return index
+
 
 class JsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Index):
-            return {
-                "type": "index",
-                "val": base64.b64encode(pickle.dumps(obj)).decode(),  # nosec: B301
-            }
+            return encode_index(obj)
         else:
             return super().default(obj)
 
 
 def object_hook(obj):
-    _type = obj.get("type")
-    if not _type:
+    if obj.get("type") != "index":
         return obj
-    return pickle.loads(base64.b64decode(obj["val"]))  # nosec: B301
+    return decode_index(obj)
 
 
 def encoder(obj: dict):
-    return json.dumps(obj, cls=JsonEncoder)
+    return json.dumps(obj, cls=JsonEncoder, separators=(",", ":"))
 
 
 def decoder(obj: str):
     return json.loads(obj, object_hook=object_hook)
+
+
+def encode_binary(obj: dict) -> bytes:
+    """
+    zlib compressed binary form of encoder output
+    :param obj:
+    :return:
+    """
+    return zlib.compress(encoder(obj).encode())
+
+
+def decode_binary(obj: bytes):
+    return decoder(zlib.decompress(obj).decode())
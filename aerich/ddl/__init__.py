@@ -1,15 +1,35 @@
+import re
 from enum import Enum
-from typing import List, Type
+from typing import Any, Dict, List, Optional, Pattern, Type
 
 from tortoise import BaseDBAsyncClient, Model
 from tortoise.backends.base.schema_generator import BaseSchemaGenerator
 
+from aerich.exceptions import NotSupportError
 from aerich.utils import is_default_function
 
 
 class BaseDDL:
     schema_generator_cls: Type[BaseSchemaGenerator] = BaseSchemaGenerator
     DIALECT = "sql"
+    # indexes can be built and dropped without blocking writes, outside of a transaction
+    CONCURRENT_INDEX = False
+    # constraints can be added without checking existing rows and validated later
+    NOT_VALID_CONSTRAINT = False
+    # ALTER TABLE accepts ALGORITHM and LOCK clauses
+    ALGORITHM_HINTS = False
+    # columns can only be changed by rebuilding the table
+    TABLE_REBUILD = False
+    # session settings limiting how long a statement waits for a lock and how long it runs
+    _LOCK_TIMEOUT_SETTING: Optional[str] = None
+    _STATEMENT_TIMEOUT_SETTING: Optional[str] = None
+    _SETTING_NAME_PATTERN = re.compile(r"^\w+(\.\w+)?$")
+    # error message of a statement which timed out waiting for a lock
+    _LOCK_TIMEOUT_PATTERN: Optional[Pattern] = None
+    # a failed statement aborts the transaction, it's retried from a savepoint
+    SAVEPOINT_RETRY = False
+    # session settings changed in a transaction are reverted with it
+    LOCAL_SESSION_SETTINGS = False
     _DROP_TABLE_TEMPLATE = 'DROP TABLE IF EXISTS "{table_name}"'
     _ADD_COLUMN_TEMPLATE = 'ALTER TABLE "{table_name}" ADD {column}'
     _DROP_COLUMN_TEMPLATE = 'ALTER TABLE "{table_name}" DROP COLUMN "{column_name}"'
@@ -34,6 +54,9 @@ class BaseDDL:
         'ALTER TABLE "{table_name}" CHANGE {old_column_name} {new_column_name} {new_column_type}'
     )
     _RENAME_TABLE_TEMPLATE = 'ALTER TABLE "{old_table_name}" RENAME TO "{new_table_name}"'
+    _ALTER_TABLE_TEMPLATE = 'ALTER TABLE "{table_name}" {clauses}'
+    # clauses can't share an ALTER TABLE statement with other clauses
+    _SINGLE_ALTER_TABLE_CLAUSES = ("RENAME ",)
 
     def __init__(self, client: "BaseDBAsyncClient"):
         self.client = client
@@ -138,7 +161,13 @@ class BaseDDL:
             table_name=model._meta.db_table, column_name=column_name
         )
 
-    def modify_column(self, model: "Type[Model]", field_describe: dict, is_pk: bool = False):
+    def modify_column(
+        self,
+        model: "Type[Model]",
+        field_describe: dict,
+        is_pk: bool = False,
+        old_field_describe: Optional[dict] = None,
+    ):
         db_table = model._meta.db_table
         db_field_types = field_describe.get("db_field_types")
         default = self._get_default(model, field_describe)
@@ -163,6 +192,20 @@ class BaseDDL:
             ),
         )
 
+    def get_column_type(self, field_describe: dict) -> str:
+        db_field_types = field_describe.get("db_field_types")
+        return db_field_types.get(self.DIALECT) or db_field_types.get("")
+
+    def is_binary_coercible(self, old_column_type: str, new_column_type: str) -> bool:
+        """
+        values of old_column_type are stored the same way as new_column_type, so the column type
+        can be changed without rewriting the table
+        :param old_column_type:
+        :param new_column_type:
+        :return:
+        """
+        return old_column_type.upper() == new_column_type.upper()
+
     def rename_column(self, model: "Type[Model]", old_column_name: str, new_column_name: str):
         return self._RENAME_COLUMN_TEMPLATE.format(
             table_name=model._meta.db_table,
@@ -248,9 +291,147 @@ class BaseDDL:
     def alter_column_null(self, model: "Type[Model]", field_describe: dict):
         return self.modify_column(model, field_describe)
 
+    def alter_column_default_null(self, model: "Type[Model]", field_describe: dict):
+        return self.modify_column(model, field_describe)
+
     def set_comment(self, model: "Type[Model]", field_describe: dict):
         return self.modify_column(model, field_describe)
 
+    def get_alter_table_clause(self, table_name: str, sql: str) -> Optional[str]:
+        """
+        get clause of an ALTER TABLE statement that can be coalesced with other clauses
+        :param table_name:
+        :param sql:
+        :return: None if sql is not such statement
+        """
+        prefix = self._ALTER_TABLE_TEMPLATE.format(table_name=table_name, clauses="")
+        if not sql.startswith(prefix):
+            return None
+        clause = sql[len(prefix) :]
+        if clause.startswith(self._SINGLE_ALTER_TABLE_CLAUSES):
+            return None
+        return clause
+
+    def get_concurrent_index_name(self, sql: str) -> Optional[str]:
+        """
+        get name of the index built by a concurrent index statement
+        :param sql:
+        :return: None if sql doesn't build an index concurrently
+        """
+        return None
+
+    def get_parameter(self, index: int) -> str:
+        """
+        get placeholder of a query parameter
+        :param index: position of the parameter, starting from 1
+        :return:
+        """
+        return "?"
+
+    async def drop_invalid_index(self, conn: "BaseDBAsyncClient", index_name: str) -> bool:
+        """
+        drop the index left invalid by a failed concurrent build
+        :param conn:
+        :param index_name:
+        :return: True if an invalid index was dropped
+        """
+        return False
+
+    async def tune_for_migration(self, conn: "BaseDBAsyncClient") -> dict:
+        """
+        change connection settings to make migrating faster
+        :param conn: connection not in a transaction
+        :return: previous settings, to restore them with restore_tuning
+        """
+        return {}
+
+    async def restore_tuning(self, conn: "BaseDBAsyncClient", settings: dict):
+        """
+        restore settings changed by tune_for_migration
+        :param conn:
+        :param settings: previous settings
+        :return:
+        """
+
+    def format_timeout(self, seconds: float) -> Any:
+        """
+        :param seconds:
+        :return: value of a timeout setting
+        """
+        return round(seconds * 1000)
+
+    def get_migration_settings(
+        self,
+        lock_timeout: Optional[float] = None,
+        statement_timeout: Optional[float] = None,
+        session_settings: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        get session settings declared by a migration file
+        :param lock_timeout: seconds a statement waits for a lock
+        :param statement_timeout: seconds a statement runs
+        :param session_settings: settings of the dialect, e.g. maintenance_work_mem on postgres
+        :return:
+        """
+        ret = {}
+        for name, setting, seconds in (
+            ("lock_timeout", self._LOCK_TIMEOUT_SETTING, lock_timeout),
+            ("statement_timeout", self._STATEMENT_TIMEOUT_SETTING, statement_timeout),
+        ):
+            if seconds is None:
+                continue
+            if setting is None:
+                raise NotSupportError(f"{name} is not supported by {self.DIALECT}.")
+            ret[setting] = self.format_timeout(seconds)
+        for name, value in (session_settings or {}).items():
+            if not self._SETTING_NAME_PATTERN.match(name):
+                raise NotSupportError(f"Invalid session setting {name!r}.")
+            ret[name] = value
+        return ret
+
+    async def set_session_settings(
+        self, conn: "BaseDBAsyncClient", settings: Dict[str, Any], local: bool = False
+    ) -> Dict[str, Any]:
+        """
+        change settings of the connection session
+        :param conn:
+        :param settings: settings returned by get_migration_settings
+        :param local: conn is in a transaction, change them for the transaction only if the
+            dialect can
+        :return: previous settings, to restore them with set_session_settings
+        """
+        if settings:
+            raise NotSupportError(f"Session settings are not supported by {self.DIALECT}.")
+        return {}
+
+    def get_row_count(self, sql: str, rows: int) -> Optional[int]:
+        """
+        :param sql: statement run with execute_query
+        :param rows: row count returned by execute_query
+        :return: count of rows affected or returned by sql, None if the driver doesn't report it
+        """
+        return rows
+
+    def is_lock_timeout(self, error: Exception) -> bool:
+        """
+        :param error: error raised by the server
+        :return: True if the statement timed out waiting for a lock and can be retried
+        """
+        return bool(self._LOCK_TIMEOUT_PATTERN and self._LOCK_TIMEOUT_PATTERN.search(str(error)))
+
+    def get_algorithm_fallback(self, sql: str, error: Exception, fallback: str) -> Optional[str]:
+        """
+        get the statement to retry when the server rejects the algorithm of sql
+        :param sql:
+        :param error: error raised by the server
+        :param fallback: none, inplace, copy or shadow
+        :return: None if sql must not be retried
+        """
+        return None
+
+    def coalesce_alter_table(self, table_name: str, clauses: List[str]):
+        return self._ALTER_TABLE_TEMPLATE.format(table_name=table_name, clauses=", ".join(clauses))
+
     def rename_table(self, model: "Type[Model]", old_table_name: str, new_table_name: str):
         db_table = model._meta.db_table
         return self._RENAME_TABLE_TEMPLATE.format(
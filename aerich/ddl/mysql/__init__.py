@@ -1,3 +1,8 @@
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from tortoise import BaseDBAsyncClient
 from tortoise.backends.mysql.schema_generator import MySQLSchemaGenerator
 
 from aerich.ddl import BaseDDL
@@ -6,6 +11,17 @@ from aerich.ddl import BaseDDL
 class MysqlDDL(BaseDDL):
     schema_generator_cls = MySQLSchemaGenerator
     DIALECT = MySQLSchemaGenerator.DIALECT
+    ALGORITHM_HINTS = True
+    # max_execution_time only limits SELECT statements, so statement_timeout isn't supported
+    _LOCK_TIMEOUT_SETTING = "lock_wait_timeout"
+    # ER_LOCK_WAIT_TIMEOUT, also raised for metadata locks
+    _LOCK_TIMEOUT_PATTERN = re.compile(r"Lock wait timeout exceeded")
+    _ALGORITHM_HINTS = {
+        "INSTANT": "ALGORITHM=INSTANT",
+        "INPLACE": "ALGORITHM=INPLACE, LOCK=NONE",
+    }
+    # ER_ALTER_OPERATION_NOT_SUPPORTED(_REASON) and ER_UNKNOWN_ALTER_ALGORITHM
+    _ALGORITHM_REJECTED_PATTERN = re.compile(r"is not supported.*Try |Unknown ALGORITHM", re.S)
     _DROP_TABLE_TEMPLATE = "DROP TABLE IF EXISTS `{table_name}`"
     _ADD_COLUMN_TEMPLATE = "ALTER TABLE `{table_name}` ADD {column}"
     _ALTER_DEFAULT_TEMPLATE = "ALTER TABLE `{table_name}` ALTER COLUMN `{column}` {default}"
@@ -30,3 +46,79 @@ class MysqlDDL(BaseDDL):
     )
     _MODIFY_COLUMN_TEMPLATE = "ALTER TABLE `{table_name}` MODIFY COLUMN {column}"
     _RENAME_TABLE_TEMPLATE = "ALTER TABLE `{old_table_name}` RENAME TO `{new_table_name}`"
+    _ALTER_TABLE_TEMPLATE = "ALTER TABLE `{table_name}` {clauses}"
+    _SINGLE_ALTER_TABLE_CLAUSES = ("RENAME TO ",)
+
+    def get_parameter(self, index: int) -> str:
+        return "%s"
+
+    def format_timeout(self, seconds: float) -> Any:
+        # whole seconds, at least 1
+        return max(1, math.ceil(seconds))
+
+    async def set_session_settings(
+        self, conn: BaseDBAsyncClient, settings: Dict[str, Any], local: bool = False
+    ) -> Dict[str, Any]:
+        ret = {}
+        for name, value in settings.items():
+            rows = await conn.execute_query_dict(f"SELECT @@SESSION.{name} AS value")
+            ret[name] = rows[0]["value"]
+            await conn.execute_query(f"SET SESSION {name} = %s", [value])
+        return ret
+
+    def get_algorithm(
+        self, instant_since: Optional[Tuple[int, ...]], db_version: Optional[str]
+    ) -> str:
+        """
+        get the best online algorithm for an alteration
+        :param instant_since: server version which can do the alteration instantly
+        :param db_version: server version, INSTANT is not used if unknown
+        :return: INSTANT or INPLACE
+        """
+        match = re.match(r"(\d+)\.(\d+)\.(\d+)", db_version or "")
+        if instant_since and match and tuple(map(int, match.groups())) >= instant_since:
+            return "INSTANT"
+        return "INPLACE"
+
+    def add_algorithm(self, table_name: str, sql: str, algorithm: str) -> str:
+        if not sql.startswith(self._ALTER_TABLE_TEMPLATE.format(table_name=table_name, clauses="")):
+            return sql
+        return f"{sql}, {self._ALGORITHM_HINTS[algorithm]}"
+
+    def get_algorithm_fallback(self, sql: str, error: Exception, fallback: str) -> Optional[str]:
+        if fallback == "none" or not self._ALGORITHM_REJECTED_PATTERN.search(str(error)):
+            return None
+        instant, inplace = (f", {hint}" for hint in self._ALGORITHM_HINTS.values())
+        if sql.endswith(instant):
+            return sql[: -len(instant)] + inplace
+        if fallback in ("copy", "shadow") and sql.endswith(inplace):
+            return sql[: -len(inplace)]
+        return None
+
+    def parse_alter_table(self, sql: str) -> Optional[Tuple[str, str]]:
+        """
+        get table name and clauses of an ALTER TABLE statement
+        :param sql:
+        :return: None if sql is not such statement
+        """
+        match = re.match(r"ALTER TABLE `([^`]+)` (.+)", sql, re.S)
+        if not match or match.group(2).startswith(self._SINGLE_ALTER_TABLE_CLAUSES):
+            return None
+        return match.group(1), match.group(2)
+
+    def coalesce_alter_table(self, table_name: str, clauses: List[str]):
+        # one algorithm for the statement, INSTANT only if all clauses can be done instantly
+        algorithms = set()
+        stripped = []
+        for clause in clauses:
+            for algorithm, hint in self._ALGORITHM_HINTS.items():
+                if clause.endswith(f", {hint}"):
+                    clause = clause[: -len(hint) - 2]
+                    algorithms.add(algorithm)
+            stripped.append(clause)
+        sql = super().coalesce_alter_table(table_name, stripped)
+        if not algorithms:
+            return sql
+        return self.add_algorithm(
+            table_name, sql, "INSTANT" if algorithms == {"INSTANT"} else "INPLACE"
+        )
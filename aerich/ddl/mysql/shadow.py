@@ -0,0 +1,208 @@
+import asyncio
+import re
+from typing import Dict, List, Optional
+
+from tortoise import BaseDBAsyncClient
+
+from aerich.exceptions import NotSupportError
+
+
+class ShadowTable:
+    """
+    Alter a table without locking it for the whole change, like gh-ost or pt-online-schema-change:
+    the alteration is done on an empty shadow copy of the table, rows are copied in primary key
+    chunks while triggers keep the copy in sync, then both tables are swapped with one atomic
+    RENAME TABLE.
+    """
+
+    _RENAME_COLUMN_PATTERN = re.compile(
+        r"(?:^|,\s*)(?:RENAME COLUMN `([^`]+)` TO `([^`]+)`|CHANGE `?(\w+)`? `?(\w+)`?\s)", re.I
+    )
+    _SELECT_PRIMARY_KEY_SQL = (
+        "SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() "
+        "AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY' ORDER BY ORDINAL_POSITION"
+    )
+    _SELECT_FOREIGN_KEYS_SQL = (
+        "SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() "
+        "AND REFERENCED_TABLE_NAME IS NOT NULL AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)"
+    )
+    _SELECT_COLUMNS_SQL = (
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+        "AND TABLE_NAME = %s AND EXTRA NOT LIKE '%%GENERATED%%' ORDER BY ORDINAL_POSITION"
+    )
+
+    def __init__(
+        self,
+        conn: BaseDBAsyncClient,
+        table_name: str,
+        alter_clauses: str,
+        chunk_size: int = 1000,
+        chunk_sleep: float = 0.0,
+    ):
+        """
+        :param conn: connection in autocommit mode, row locks of a chunk are released after it
+        :param table_name:
+        :param alter_clauses: clauses of the ALTER TABLE statement
+        :param chunk_size: count of rows copied by one statement
+        :param chunk_sleep: seconds to sleep between chunks, to throttle the copy
+        """
+        if "FOREIGN KEY" in alter_clauses.upper():
+            raise NotSupportError("Shadow table migration can't add foreign keys.")
+        self.conn = conn
+        self.table_name = table_name
+        self.alter_clauses = alter_clauses
+        self.chunk_size = chunk_size
+        self.chunk_sleep = chunk_sleep
+        # names are at most 64 characters
+        self.shadow_table_name = f"_{table_name[:58]}_new"
+        self.old_table_name = f"_{table_name[:58]}_old"
+        self.trigger_names = {
+            event: f"_{table_name[:57]}_{event[:3].lower()}"
+            for event in ("INSERT", "UPDATE", "DELETE")
+        }
+
+    def get_renamed_columns(self) -> Dict[str, str]:
+        ret = {}
+        for match in self._RENAME_COLUMN_PATTERN.finditer(self.alter_clauses):
+            old_column_name, new_column_name = (
+                match.group(1, 2) if match.group(1) else match.group(3, 4)
+            )
+            ret[old_column_name] = new_column_name
+        return ret
+
+    def get_trigger_sql(self, pk: str, columns: Dict[str, str]) -> List[str]:
+        """
+        triggers applying writes to the table on the shadow table
+        :param pk: primary key column of the table
+        :param columns: columns of the table mapped to the ones of the shadow table
+        :return:
+        """
+        shadow_pk = columns[pk]
+        target = ", ".join(f"`{column}`" for column in columns.values())
+        insert = (
+            f"INSERT IGNORE INTO `{self.shadow_table_name}` ({target}) "
+            f"VALUES ({', '.join(f'NEW.`{column}`' for column in columns)})"
+        )
+        delete = f"DELETE FROM `{self.shadow_table_name}` WHERE `{shadow_pk}`"
+        bodies = {
+            "INSERT": f"BEGIN {delete} = NEW.`{pk}`; {insert}; END",
+            "UPDATE": f"BEGIN {delete} IN (OLD.`{pk}`, NEW.`{pk}`); {insert}; END",
+            "DELETE": f"{delete} = OLD.`{pk}`",
+        }
+        return [
+            f"CREATE TRIGGER `{self.trigger_names[event]}` AFTER {event} ON `{self.table_name}` "
+            f"FOR EACH ROW {body}"
+            for event, body in bodies.items()
+        ]
+
+    def get_copy_sql(
+        self, pk: str, columns: Dict[str, str], lower: bool = False, upper: bool = False
+    ) -> str:
+        """
+        copy a chunk of rows, rows written by the triggers meanwhile are kept
+        :param pk:
+        :param columns:
+        :param lower: rows after a primary key value only
+        :param upper: rows until a primary key value only
+        :return:
+        """
+        conditions = []
+        if lower:
+            conditions.append(f"`{pk}` > %s")
+        if upper:
+            conditions.append(f"`{pk}` <= %s")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return (
+            f"INSERT IGNORE INTO `{self.shadow_table_name}` "
+            f"({', '.join(f'`{column}`' for column in columns.values())}) "
+            f"SELECT {', '.join(f'`{column}`' for column in columns)} FROM `{self.table_name}`"
+            f"{where} LOCK IN SHARE MODE"
+        )
+
+    def get_swap_sql(self) -> str:
+        return (
+            f"RENAME TABLE `{self.table_name}` TO `{self.old_table_name}`, "
+            f"`{self.shadow_table_name}` TO `{self.table_name}`"
+        )
+
+    async def _get_columns(self, table_name: str) -> List[str]:
+        ret = await self.conn.execute_query_dict(self._SELECT_COLUMNS_SQL, [table_name])
+        return [row["COLUMN_NAME"] for row in ret]
+
+    async def _get_primary_key(self) -> str:
+        ret = await self.conn.execute_query_dict(self._SELECT_PRIMARY_KEY_SQL, [self.table_name])
+        if len(ret) != 1:
+            raise NotSupportError(
+                "Shadow table migration needs a single column primary key, "
+                f"table {self.table_name} has {len(ret)}."
+            )
+        return ret[0]["COLUMN_NAME"]
+
+    async def _check_foreign_keys(self):
+        ret = await self.conn.execute_query_dict(
+            self._SELECT_FOREIGN_KEYS_SQL, [self.table_name, self.table_name]
+        )
+        if ret:
+            raise NotSupportError(
+                f"Shadow table migration can't keep foreign keys of table {self.table_name}."
+            )
+
+    async def _drop_triggers(self):
+        for trigger_name in self.trigger_names.values():
+            await self.conn.execute_script(f"DROP TRIGGER IF EXISTS `{trigger_name}`")
+
+    async def _copy_rows(self, pk: str, columns: Dict[str, str]):
+        last: Optional[object] = None
+        while True:
+            where, values = ("", []) if last is None else (f" WHERE `{pk}` > %s", [last])
+            ret = await self.conn.execute_query_dict(
+                f"SELECT `{pk}` AS pk FROM `{self.table_name}`{where} ORDER BY `{pk}` "
+                f"LIMIT 1 OFFSET {self.chunk_size - 1}",
+                values,
+            )
+            upper = ret[0]["pk"] if ret else None
+            if upper is not None:
+                values.append(upper)
+            await self.conn.execute_query(
+                self.get_copy_sql(pk, columns, last is not None, upper is not None), values
+            )
+            if upper is None:
+                return
+            last = upper
+            if self.chunk_sleep:
+                await asyncio.sleep(self.chunk_sleep)
+
+    async def run(self):
+        pk = await self._get_primary_key()
+        await self._check_foreign_keys()
+        # leftovers of a failed run
+        await self._drop_triggers()
+        await self.conn.execute_script(f"DROP TABLE IF EXISTS `{self.shadow_table_name}`")
+
+        await self.conn.execute_script(
+            f"CREATE TABLE `{self.shadow_table_name}` LIKE `{self.table_name}`"
+        )
+        try:
+            await self.conn.execute_script(
+                f"ALTER TABLE `{self.shadow_table_name}` {self.alter_clauses}"
+            )
+            renamed_columns = self.get_renamed_columns()
+            shadow_columns = set(await self._get_columns(self.shadow_table_name))
+            columns = {}
+            for column in await self._get_columns(self.table_name):
+                shadow_column = renamed_columns.get(column, column)
+                if shadow_column in shadow_columns:
+                    columns[column] = shadow_column
+            if pk not in columns:
+                raise NotSupportError("Shadow table migration can't drop the primary key.")
+            try:
+                for sql in self.get_trigger_sql(pk, columns):
+                    await self.conn.execute_script(sql)
+                await self._copy_rows(pk, columns)
+                await self.conn.execute_script(self.get_swap_sql())
+            finally:
+                await self._drop_triggers()
+        except Exception:
+            await self.conn.execute_script(f"DROP TABLE IF EXISTS `{self.shadow_table_name}`")
+            raise
+        await self.conn.execute_script(f"DROP TABLE `{self.old_table_name}`")
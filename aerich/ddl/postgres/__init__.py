@@ -1,7 +1,9 @@
-from typing import Type
+import re
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
-from tortoise import Model
+from tortoise import BaseDBAsyncClient, Model
 from tortoise.backends.asyncpg.schema_generator import AsyncpgSchemaGenerator
+from tortoise.indexes import Index
 
 from aerich.ddl import BaseDDL
 
@@ -9,14 +11,37 @@ from aerich.ddl import BaseDDL
 class PostgresDDL(BaseDDL):
     schema_generator_cls = AsyncpgSchemaGenerator
     DIALECT = AsyncpgSchemaGenerator.DIALECT
+    CONCURRENT_INDEX = True
+    NOT_VALID_CONSTRAINT = True
+    _LOCK_TIMEOUT_SETTING = "lock_timeout"
+    _STATEMENT_TIMEOUT_SETTING = "statement_timeout"
+    _LOCK_TIMEOUT_PATTERN = re.compile(r"canceling statement due to lock timeout")
+    SAVEPOINT_RETRY = True
+    LOCAL_SESSION_SETTINGS = True
     _ADD_INDEX_TEMPLATE = 'CREATE {unique}INDEX "{index_name}" ON "{table_name}" ({column_names})'
     _DROP_INDEX_TEMPLATE = 'DROP INDEX "{index_name}"'
+    _ADD_INDEX_CONCURRENTLY_TEMPLATE = 'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_names})'
+    _DROP_INDEX_CONCURRENTLY_TEMPLATE = 'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'
+    _CONCURRENT_INDEX_NAME_PATTERN = re.compile(r'INDEX CONCURRENTLY IF NOT EXISTS "([^"]+)"')
+    _SELECT_INVALID_INDEX_SQL = "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid AND c.relname = $1"
     _ALTER_NULL_TEMPLATE = 'ALTER TABLE "{table_name}" ALTER COLUMN "{column}" {set_drop} NOT NULL'
+    _ALTER_DEFAULT_NULL_TEMPLATE = 'ALTER TABLE "{table_name}" ALTER COLUMN "{column}" {default}, ALTER COLUMN "{column}" {set_drop} NOT NULL'
     _MODIFY_COLUMN_TEMPLATE = (
         'ALTER TABLE "{table_name}" ALTER COLUMN "{column}" TYPE {datatype}{using}'
     )
     _SET_COMMENT_TEMPLATE = 'COMMENT ON COLUMN "{table_name}"."{column}" IS {comment}'
+    _COLUMN_TYPE_PATTERN = re.compile(r"\s*([A-Za-z ]+?)\s*(?:\(([\d\s,]+)\))?\s*")
+    # statements whose returned rows are counted by execute_query
+    _RETURNING_ROWS_PATTERN = re.compile(r"^\s*(?:SELECT|VALUES|SHOW)\b|\bRETURNING\b", re.I)
+    _COLUMN_TYPE_ALIASES = {"CHARACTER VARYING": "VARCHAR", "DECIMAL": "NUMERIC"}
+    # types whose length or precision can be increased, or removed, without a rewrite
+    _WIDENING_COLUMN_TYPES = ("VARCHAR", "NUMERIC", "TIMESTAMP", "TIMESTAMPTZ")
     _DROP_FK_TEMPLATE = 'ALTER TABLE "{table_name}" DROP CONSTRAINT "{fk_name}"'
+    _VALIDATE_CONSTRAINT_TEMPLATE = (
+        'ALTER TABLE "{table_name}" VALIDATE CONSTRAINT "{constraint_name}"'
+    )
+    _DROP_CONSTRAINT_TEMPLATE = 'ALTER TABLE "{table_name}" DROP CONSTRAINT "{constraint_name}"'
+    _ADD_NOT_NULL_CHECK_TEMPLATE = 'ALTER TABLE "{table_name}" ADD CONSTRAINT "{constraint_name}" CHECK ("{column}" IS NOT NULL) NOT VALID'
 
     def alter_column_null(self, model: "Type[Model]", field_describe: dict):
         db_table = model._meta.db_table
@@ -26,18 +51,151 @@ class PostgresDDL(BaseDDL):
             set_drop="DROP" if field_describe.get("nullable") else "SET",
         )
 
-    def modify_column(self, model: "Type[Model]", field_describe: dict, is_pk: bool = False):
+    def _get_index_name(
+        self, model: "Type[Model]", fields: Union[List[str], Index], unique=False
+    ) -> str:
+        if isinstance(fields, Index):
+            return fields.index_name(self.schema_generator, model)
+        return self.schema_generator._generate_index_name("uid" if unique else "idx", model, fields)
+
+    def add_index_concurrently(
+        self, model: "Type[Model]", fields: Union[List[str], Index], unique=False
+    ):
+        if isinstance(fields, Index):
+            sql = fields.get_sql(self.schema_generator, model, False).rstrip(";")
+            return sql.replace("INDEX ", "INDEX CONCURRENTLY IF NOT EXISTS ", 1)
+        return self._ADD_INDEX_CONCURRENTLY_TEMPLATE.format(
+            unique="UNIQUE " if unique else "",
+            index_name=self._get_index_name(model, fields, unique),
+            table_name=model._meta.db_table,
+            column_names=", ".join(self.schema_generator.quote(f) for f in fields),
+        )
+
+    def drop_index_concurrently(
+        self, model: "Type[Model]", fields: Union[List[str], Index], unique=False
+    ):
+        return self._DROP_INDEX_CONCURRENTLY_TEMPLATE.format(
+            index_name=self._get_index_name(model, fields, unique)
+        )
+
+    def get_concurrent_index_name(self, sql: str) -> Optional[str]:
+        match = self._CONCURRENT_INDEX_NAME_PATTERN.search(sql)
+        return match.group(1) if match else None
+
+    def get_parameter(self, index: int) -> str:
+        return f"${index}"
+
+    def format_timeout(self, seconds: float) -> Any:
+        return f"{round(seconds * 1000)}ms"
+
+    async def set_session_settings(
+        self, conn: BaseDBAsyncClient, settings: Dict[str, Any], local: bool = False
+    ) -> Dict[str, Any]:
+        ret = {}
+        for name, value in settings.items():
+            rows = await conn.execute_query_dict("SELECT current_setting($1) AS value", [name])
+            ret[name] = rows[0]["value"]
+            # set_config with is_local is SET LOCAL, reverted at the end of the transaction
+            await conn.execute_query("SELECT set_config($1, $2, $3)", [name, str(value), local])
+        return ret
+
+    def get_row_count(self, sql: str, rows: int) -> Optional[int]:
+        # asyncpg reports the count of a command only for statements starting with UPDATE or DELETE,
+        # from the command status, others count the returned rows, 0 for DDL or INSERT ... SELECT
+        if sql.startswith(("UPDATE", "DELETE")) or self._RETURNING_ROWS_PATTERN.search(sql):
+            return rows
+        return None
+
+    async def drop_invalid_index(self, conn: BaseDBAsyncClient, index_name: str) -> bool:
+        rows = await conn.execute_query_dict(self._SELECT_INVALID_INDEX_SQL, [index_name])
+        if not rows:
+            return False
+        await conn.execute_script(
+            self._DROP_INDEX_CONCURRENTLY_TEMPLATE.format(index_name=index_name)
+        )
+        return True
+
+    def add_fk_not_valid(
+        self, model: "Type[Model]", field_describe: dict, reference_table_describe: dict
+    ):
+        return f"{self.add_fk(model, field_describe, reference_table_describe)} NOT VALID"
+
+    def validate_constraint(self, model: "Type[Model]", constraint_name: str):
+        return self._VALIDATE_CONSTRAINT_TEMPLATE.format(
+            table_name=model._meta.db_table, constraint_name=constraint_name
+        )
+
+    def drop_constraint(self, model: "Type[Model]", constraint_name: str):
+        return self._DROP_CONSTRAINT_TEMPLATE.format(
+            table_name=model._meta.db_table, constraint_name=constraint_name
+        )
+
+    def get_not_null_check_name(self, model: "Type[Model]", column_name: str) -> str:
+        return self.schema_generator._generate_index_name("chk", model, [column_name])
+
+    def add_not_null_check(self, model: "Type[Model]", column_name: str, constraint_name: str):
+        return self._ADD_NOT_NULL_CHECK_TEMPLATE.format(
+            table_name=model._meta.db_table, constraint_name=constraint_name, column=column_name
+        )
+
+    def alter_column_default_null(self, model: "Type[Model]", field_describe: dict):
+        default = self._get_default(model, field_describe)
+        return self._ALTER_DEFAULT_NULL_TEMPLATE.format(
+            table_name=model._meta.db_table,
+            column=field_describe.get("db_column"),
+            default="SET" + default if default is not None else "DROP DEFAULT",
+            set_drop="DROP" if field_describe.get("nullable") else "SET",
+        )
+
+    def modify_column(
+        self,
+        model: "Type[Model]",
+        field_describe: dict,
+        is_pk: bool = False,
+        old_field_describe: Optional[dict] = None,
+    ):
         db_table = model._meta.db_table
-        db_field_types = field_describe.get("db_field_types")
         db_column = field_describe.get("db_column")
-        datatype = db_field_types.get(self.DIALECT) or db_field_types.get("")
+        datatype = self.get_column_type(field_describe)
+        # USING makes postgres rewrite the table even if the values are stored the same way
+        if old_field_describe and self.is_binary_coercible(
+            self.get_column_type(old_field_describe), datatype
+        ):
+            using = ""
+        else:
+            using = f' USING "{db_column}"::{datatype}'
         return self._MODIFY_COLUMN_TEMPLATE.format(
             table_name=db_table,
             column=db_column,
             datatype=datatype,
-            using=f' USING "{db_column}"::{datatype}',
+            using=using,
         )
 
+    def _parse_column_type(self, column_type: str) -> Tuple[str, Tuple[int, ...]]:
+        match = self._COLUMN_TYPE_PATTERN.fullmatch(column_type)
+        if not match:
+            return column_type.upper(), ()
+        name = match.group(1).upper()
+        args = tuple(int(arg) for arg in match.group(2).split(",")) if match.group(2) else ()
+        return self._COLUMN_TYPE_ALIASES.get(name, name), args
+
+    def is_binary_coercible(self, old_column_type: str, new_column_type: str) -> bool:
+        old_name, old_args = self._parse_column_type(old_column_type)
+        new_name, new_args = self._parse_column_type(new_column_type)
+        if old_name == new_name:
+            if old_args == new_args:
+                return True
+            if old_name not in self._WIDENING_COLUMN_TYPES:
+                return False
+            if not new_args:
+                return True
+            if not old_args:
+                return False
+            return new_args[0] >= old_args[0] and new_args[1:] == old_args[1:]
+        if (old_name, new_name) == ("VARCHAR", "TEXT"):
+            return True
+        return (old_name, new_name) == ("TEXT", "VARCHAR") and not new_args
+
     def set_comment(self, model: "Type[Model]", field_describe: dict):
         db_table = model._meta.db_table
         return self._SET_COMMENT_TEMPLATE.format(
@@ -1,24 +1,101 @@
-from typing import Type
+import re
+from typing import Any, Dict, List, Optional, Tuple, Type
 
-from tortoise import Model
+from tortoise import BaseDBAsyncClient, Model
 from tortoise.backends.sqlite.schema_generator import SqliteSchemaGenerator
 
 from aerich.ddl import BaseDDL
-from aerich.exceptions import NotSupportError
+from aerich.ddl.sqlite.rebuild import get_column_name, split_definitions
 
 
 class SqliteDDL(BaseDDL):
     schema_generator_cls = SqliteSchemaGenerator
     DIALECT = SqliteSchemaGenerator.DIALECT
+    TABLE_REBUILD = True
+    _LOCK_TIMEOUT_SETTING = "busy_timeout"
+    _LOCK_TIMEOUT_PATTERN = re.compile(r"database (table )?is locked")
+    _MODIFY_COLUMN_CLAUSE = "MODIFY COLUMN "
+    # pragmas making table rebuilds and index builds faster, synchronous NORMAL is safe in WAL
+    # mode, only the last transactions may be lost on a power failure
+    _MIGRATION_PRAGMAS = {
+        "journal_mode": "WAL",
+        # 128 MiB
+        "cache_size": "-131072",
+        "temp_store": "MEMORY",
+        "synchronous": "NORMAL",
+    }
+    _REBUILD_TABLE_PATTERN = re.compile(r'^ALTER TABLE "((?:[^"]|"")+)" (MODIFY COLUMN .*)$', re.S)
 
-    def modify_column(self, model: "Type[Model]", field_object: dict, is_pk: bool = True):
-        raise NotSupportError("Modify column is unsupported in SQLite.")
+    def get_alter_table_clause(self, table_name: str, sql: str) -> Optional[str]:
+        # SQLite only supports one clause in ALTER TABLE
+        return None
 
     def alter_column_default(self, model: "Type[Model]", field_describe: dict):
-        raise NotSupportError("Alter column default is unsupported in SQLite.")
+        return self.modify_column(model, field_describe)
 
-    def alter_column_null(self, model: "Type[Model]", field_describe: dict):
-        raise NotSupportError("Alter column null is unsupported in SQLite.")
+    def rebuild_table(self, model: "Type[Model]", field_describes: List[dict]):
+        """
+        ALTER TABLE with the new definitions of the changed columns, SQLite can't run it, the
+        table is rebuilt with TableRebuild instead
+        :param model:
+        :param field_describes:
+        :return:
+        """
+        db_table = model._meta.db_table
+        prefix = self._ALTER_TABLE_TEMPLATE.format(table_name=db_table, clauses="")
+        return self.coalesce_alter_table(
+            db_table,
+            [
+                self.modify_column(model, field_describe)[len(prefix) :]
+                for field_describe in field_describes
+            ],
+        )
 
-    def set_comment(self, model: "Type[Model]", field_describe: dict):
-        raise NotSupportError("Alter column comment is unsupported in SQLite.")
+    def parse_rebuild_table(self, sql: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """
+        get table and new column definitions of a statement rendered by rebuild_table
+        :param sql:
+        :return: None if sql is not such statement
+        """
+        match = self._REBUILD_TABLE_PATTERN.match(sql)
+        if not match:
+            return None
+        columns = {}
+        for clause in split_definitions(match.group(2)):
+            if not clause.startswith(self._MODIFY_COLUMN_CLAUSE):
+                return None
+            definition = clause[len(self._MODIFY_COLUMN_CLAUSE) :]
+            columns[get_column_name(definition)] = definition
+        return match.group(1).replace('""', '"'), columns
+
+    async def set_session_settings(
+        self, conn: "BaseDBAsyncClient", settings: Dict[str, Any], local: bool = False
+    ) -> Dict[str, Any]:
+        ret = {}
+        for pragma, value in settings.items():
+            _, rows = await conn.execute_query(f"PRAGMA {pragma}")
+            ret[pragma] = rows[0][0]
+            await conn.execute_script(f"PRAGMA {pragma} = {value}")
+        return ret
+
+    async def tune_for_migration(self, conn: "BaseDBAsyncClient") -> dict:
+        return await self.set_session_settings(conn, self._MIGRATION_PRAGMAS)
+
+    async def restore_tuning(self, conn: "BaseDBAsyncClient", settings: dict):
+        await self.set_session_settings(conn, settings)
+        await conn.execute_script("PRAGMA optimize")
+
+    async def disable_foreign_keys(self, conn: "BaseDBAsyncClient") -> bool:
+        """
+        turn foreign keys off, it has no effect inside a transaction
+        :param conn:
+        :return: True if they were on
+        """
+        _, ret = await conn.execute_query("PRAGMA foreign_keys")
+        if not ret[0][0]:
+            return False
+        await conn.execute_script("PRAGMA foreign_keys = OFF")
+        return True
+
+    async def enable_foreign_keys(self, conn: "BaseDBAsyncClient"):
+        await conn.execute_script("PRAGMA foreign_keys = ON")
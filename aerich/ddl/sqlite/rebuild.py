@@ -0,0 +1,268 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from tortoise import BaseDBAsyncClient
+from tortoise.exceptions import IntegrityError
+
+from aerich.exceptions import NotSupportError
+
+_QUOTES = {'"': '"', "'": "'", "`": "`", "[": "]"}
+_NAME_PATTERN = re.compile(r'\s*("(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\]|[^\s(,]+)')
+_TABLE_CONSTRAINTS = ("CONSTRAINT", "PRIMARY", "UNIQUE", "CHECK", "FOREIGN")
+
+
+def _find_end(sql: str, start: int, end: str) -> int:
+    position = sql.find(end, start)
+    return len(sql) if position == -1 else position + len(end) - 1
+
+
+def _skip_quoted(sql: str, start: int) -> int:
+    """
+    :param sql:
+    :param start: position of the opening quote
+    :return: position after the closing quote, doubled quotes are escapes
+    """
+    end = _QUOTES[sql[start]]
+    i = start + 1
+    while True:
+        i = _find_end(sql, i, end) + 1
+        if i >= len(sql) or end == "]" or sql[i] != end:
+            return i
+        i += 1
+
+
+def tokenize(sql: str) -> List[str]:
+    """
+    split sql into words, quoted names and strings, and parenthesized groups, comments are left
+    out
+    :param sql:
+    :return:
+    """
+    ret = []
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char.isspace():
+            i += 1
+            continue
+        if sql.startswith("/*", i):
+            i = _find_end(sql, i + 2, "*/") + 1
+            continue
+        if sql.startswith("--", i):
+            i = _find_end(sql, i + 2, "\n") + 1
+            continue
+        start = i
+        if char in _QUOTES:
+            i = _skip_quoted(sql, i)
+        elif char == "(":
+            depth = 0
+            while i < len(sql):
+                if sql[i] in _QUOTES:
+                    i = _skip_quoted(sql, i)
+                    continue
+                if sql[i] == "(":
+                    depth += 1
+                elif sql[i] == ")":
+                    depth -= 1
+                    if not depth:
+                        i += 1
+                        break
+                i += 1
+        elif char.isalnum() or char == "_":
+            while i < len(sql) and (sql[i].isalnum() or sql[i] == "_"):
+                i += 1
+        else:
+            i += 1
+        ret.append(sql[start:i])
+    return ret
+
+
+def get_kept_constraints(definition: str) -> str:
+    """
+    get the column constraints the ddl doesn't render: PRIMARY KEY, UNIQUE and REFERENCES, with
+    their names and options, other constraints like DEFAULT or NOT NULL are left out
+    :param definition: column definition in the body of CREATE TABLE
+    :return:
+    """
+    tokens = tokenize(definition)[1:]
+
+    def word(index: int) -> str:
+        return tokens[index].upper() if index < len(tokens) else ""
+
+    def skip_conflict_clause(index: int) -> int:
+        if word(index) == "ON" and word(index + 1) == "CONFLICT":
+            return index + 3
+        return index
+
+    kept = []
+    i = 0
+    while i < len(tokens):
+        start = i
+        if word(i) == "CONSTRAINT":
+            i += 2
+        if word(i) == "PRIMARY":
+            i += 2
+            if word(i) in ("ASC", "DESC"):
+                i += 1
+            i = skip_conflict_clause(i)
+            if word(i) == "AUTOINCREMENT":
+                i += 1
+        elif word(i) == "UNIQUE":
+            i = skip_conflict_clause(i + 1)
+        elif word(i) == "REFERENCES":
+            i += 2
+            if i < len(tokens) and tokens[i].startswith("("):
+                i += 1
+            while True:
+                if word(i) == "ON" and word(i + 1) in ("DELETE", "UPDATE"):
+                    i += 4 if word(i + 2) in ("SET", "NO") else 3
+                elif word(i) == "MATCH":
+                    i += 2
+                elif word(i) == "DEFERRABLE" or (word(i), word(i + 1)) == ("NOT", "DEFERRABLE"):
+                    i += 1 if word(i) == "DEFERRABLE" else 2
+                    if word(i) == "INITIALLY":
+                        i += 2
+                else:
+                    break
+        else:
+            i = start + 1
+            continue
+        kept.append(" ".join(tokens[start:i]))
+    return " ".join(kept)
+
+
+def split_definitions(sql: str) -> List[str]:
+    """
+    split comma separated definitions, e.g. the body of CREATE TABLE, commas in parentheses,
+    quotes and comments don't split
+    :param sql:
+    :return: stripped definitions
+    """
+    ret = []
+    depth = start = i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char in _QUOTES:
+            i = _find_end(sql, i + 1, _QUOTES[char])
+        elif sql.startswith("/*", i):
+            i = _find_end(sql, i + 2, "*/")
+        elif sql.startswith("--", i):
+            i = _find_end(sql, i + 2, "\n")
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and not depth:
+            ret.append(sql[start:i].strip())
+            start = i + 1
+        i += 1
+    ret.append(sql[start:].strip())
+    return ret
+
+
+def get_column_name(definition: str) -> Optional[str]:
+    """
+    :param definition: definition in the body of CREATE TABLE
+    :return: None if definition is a table constraint
+    """
+    match = _NAME_PATTERN.match(definition)
+    if not match:
+        return None
+    name = match.group(1)
+    if name.upper() in _TABLE_CONSTRAINTS:
+        return None
+    if name[0] in _QUOTES:
+        return name[1:-1].replace(name[0] * 2, name[0])
+    return name
+
+
+class TableRebuild:
+    """
+    Change columns of a table the way SQLite documents for changes ALTER TABLE can't do: create
+    the table in the new format, copy all rows with one INSERT ... SELECT, drop the old table,
+    rename the new one, then create the indexes and triggers of the old table again. It runs in
+    the migration transaction with foreign keys off, otherwise dropping the old table deletes or
+    checks the rows referencing it.
+    """
+
+    _SELECT_SCHEMA_SQL = (
+        "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL "
+        "AND type IN ('table', 'index', 'trigger')"
+    )
+    _CREATE_TABLE_PATTERN = re.compile(r'^CREATE TABLE ("(?:[^"]|"")+"|\S+?)\s*\(', re.I)
+
+    def __init__(self, conn: BaseDBAsyncClient, table_name: str, columns: Dict[str, str]):
+        """
+        :param conn: connection with foreign keys off
+        :param table_name:
+        :param columns: changed columns mapped to their new definitions
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.columns = columns
+        self.new_table_name = f"_{table_name}_new"
+
+    def _get_definition(self, old_definition: str, definition: str) -> str:
+        # column constraints the ddl doesn't render are kept from the old definition
+        constraints = get_kept_constraints(old_definition)
+        if not constraints:
+            return definition
+        return f"{definition} {constraints}"
+
+    def get_create_table_sql(self, sql: str) -> Tuple[str, List[str]]:
+        """
+        :param sql: CREATE TABLE statement of the table
+        :return: CREATE TABLE statement of the new table and the columns of the table
+        """
+        match = self._CREATE_TABLE_PATTERN.match(sql)
+        end = sql.rindex(")")
+        columns, definitions = [], []
+        for definition in split_definitions(sql[match.end() : end]):
+            column_name = get_column_name(definition)
+            if column_name is not None:
+                columns.append(column_name)
+                if column_name in self.columns:
+                    definition = self._get_definition(definition, self.columns[column_name])
+            definitions.append(definition)
+        missing_columns = set(self.columns).difference(columns)
+        if missing_columns:
+            raise NotSupportError(
+                f"Can't rebuild table {self.table_name}, it has no column "
+                f"{', '.join(sorted(missing_columns))}."
+            )
+        body = ",\n    ".join(definitions)
+        return (
+            f'CREATE TABLE "{self.new_table_name}" (\n    {body}\n{sql[end:]}',
+            columns,
+        )
+
+    async def run(self) -> int:
+        """
+        :return: count of copied rows
+        """
+        schema = await self.conn.execute_query_dict(self._SELECT_SCHEMA_SQL, [self.table_name])
+        table_sql = next((row["sql"] for row in schema if row["type"] == "table"), None)
+        if table_sql is None:
+            raise NotSupportError(f"Can't rebuild table {self.table_name}, it doesn't exist.")
+        create_table_sql, columns = self.get_create_table_sql(table_sql)
+        column_names = ", ".join(f'"{column}"' for column in columns)
+        await self.conn.execute_script(create_table_sql)
+        rows, _ = await self.conn.execute_query(
+            f'INSERT INTO "{self.new_table_name}" ({column_names}) '
+            f'SELECT {column_names} FROM "{self.table_name}"'
+        )
+        for sql in (
+            f'DROP TABLE "{self.table_name}"',
+            f'ALTER TABLE "{self.new_table_name}" RENAME TO "{self.table_name}"',
+            *(row["sql"] for row in schema if row["type"] != "table"),
+        ):
+            await self.conn.execute_script(sql)
+        violations = await self.conn.execute_query_dict(
+            f'PRAGMA foreign_key_check("{self.table_name}")'
+        )
+        if violations:
+            raise IntegrityError(
+                f"Rebuilt table {self.table_name} has {len(violations)} rows violating "
+                "foreign keys."
+            )
+        return rows
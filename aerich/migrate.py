@@ -1,9 +1,10 @@
 import importlib
+import json
 import os
+from collections import defaultdict
 from datetime import datetime
-from hashlib import md5
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Type, Union
+from typing import Dict, List, Optional, Set, Tuple, Type, Union
 
 import click
 from dictdiffer import diff
@@ -12,7 +13,44 @@ from tortoise.exceptions import OperationalError
 from tortoise.indexes import Index
 
 from aerich.ddl import BaseDDL
+from aerich.enums import Color
 from aerich.models import MAX_VERSION_LENGTH, Aerich
+from aerich.operations import (
+    AddColumn,
+    AddFk,
+    AddIndex,
+    AlterColumn,
+    AlterDefault,
+    AlterNull,
+    ChangeColumn,
+    CreateM2M,
+    CreateTable,
+    DropColumn,
+    DropFk,
+    DropIndex,
+    DropM2M,
+    DropTable,
+    ModifyColumn,
+    Operation,
+    RebuildTable,
+    RenameColumn,
+    RenameTable,
+    SetComment,
+    column_resource,
+    constraint_resource,
+    index_resource,
+    make_online,
+    optimize_operations,
+    sort_operations,
+    table_resource,
+)
+from aerich.snapshot import (
+    SnapshotEncoder,
+    apply_delta,
+    get_delta_base,
+    get_fingerprint,
+    is_delta,
+)
 from aerich.utils import get_app_connection, get_models_describe, is_default_function
 
 MIGRATE_TEMPLATE = """from tortoise import BaseDBAsyncClient
@@ -27,83 +65,154 @@ async def downgrade(db: BaseDBAsyncClient) -> str:
     return \"\"\"
         {downgrade_sql}\"\"\"
 """
+# statements which can't run inside a transaction, e.g. CREATE INDEX CONCURRENTLY, they are
+# executed one by one before or after the transactional upgrade/downgrade
+NON_TRANSACTIONAL_TEMPLATE = """
+
+async def {name}(db: BaseDBAsyncClient) -> list:
+    return [
+        {sql_list}
+    ]
+"""
+NON_TRANSACTIONAL_SECTIONS = ("pre_upgrade", "post_upgrade", "pre_downgrade", "post_downgrade")
 
 
-class Migrate:
-    upgrade_operators: List[str] = []
-    downgrade_operators: List[str] = []
-    _upgrade_fk_m2m_index_operators: List[str] = []
-    _downgrade_fk_m2m_index_operators: List[str] = []
-    _upgrade_m2m: List[str] = []
-    _downgrade_m2m: List[str] = []
+class Migrator:
+    """
+    Diff engine of one app, it owns the operators, the ddl and the models snapshot, so several
+    apps can be migrated in one process.
+    """
+
     _aerich = Aerich.__name__
-    _rename_old = []
-    _rename_new = []
 
     ddl: BaseDDL
-    _last_version_content: Optional[dict] = None
     app: str
     migrate_location: Path
     dialect: str
-    _db_version: Optional[str] = None
 
-    @classmethod
-    def get_all_version_files(cls) -> List[str]:
+    def __init__(self, app: Optional[str] = None):
+        self._last_version_content: Optional[dict] = None
+        self._db_version: Optional[str] = None
+        self._reset_operators()
+        if app:
+            self.app = app
+
+    def _reset_operators(self):
+        self.upgrade_operators: List[str] = []
+        self.downgrade_operators: List[str] = []
+        self.pre_upgrade_operators: List[str] = []
+        self.post_upgrade_operators: List[str] = []
+        self.pre_downgrade_operators: List[str] = []
+        self.post_downgrade_operators: List[str] = []
+        self._upgrade_operations: List[Operation] = []
+        self._downgrade_operations: List[Operation] = []
+        self._m2m_tables: Set[str] = set()
+
+    def get_all_version_files(self) -> List[str]:
         return sorted(
-            filter(lambda x: x.endswith("py"), os.listdir(cls.migrate_location)),
+            filter(lambda x: x.endswith("py"), os.listdir(self.migrate_location)),
             key=lambda x: int(x.split("_")[0]),
         )
 
-    @classmethod
-    def _get_model(cls, model: str) -> Type[Model]:
-        return Tortoise.apps.get(cls.app).get(model)
+    def _get_model(self, model: str) -> Type[Model]:
+        return Tortoise.apps.get(self.app).get(model)
 
-    @classmethod
-    async def get_last_version(cls) -> Optional[Aerich]:
+    async def get_last_version(self, with_content: bool = True) -> Optional[Aerich]:
+        """
+        get last applied version of app
+        :param with_content: if False only id and version are selected, skip decoding the snapshot
+        :return:
+        """
+        queryset = Aerich.filter(app=self.app)
+        if not with_content:
+            queryset = queryset.only("id", "version")
         try:
-            return await Aerich.filter(app=cls.app).first()
+            return await queryset.first()
         except OperationalError:
             pass
 
-    @classmethod
-    async def _get_db_version(cls, connection: BaseDBAsyncClient):
-        if cls.dialect == "mysql":
+    async def get_last_version_content(self) -> Optional[dict]:
+        """
+        fetch and decode models snapshot of last applied version
+        :return:
+        """
+        try:
+            content = await Aerich.filter(app=self.app).first().values_list("content", flat=True)
+            if is_delta(content):
+                base = await self._get_version_content(get_delta_base(content))
+                content = apply_delta(base, content)
+            return content
+        except OperationalError:
+            pass
+
+    async def _get_version_content(self, version: str) -> Optional[dict]:
+        return (
+            await Aerich.filter(app=self.app, version=version)
+            .first()
+            .values_list("content", flat=True)
+        )
+
+    async def get_snapshot_encoder(self) -> SnapshotEncoder:
+        """
+        get encoder for snapshots of versions applied after the last one
+        :return:
+        """
+        try:
+            last_version = (
+                await Aerich.filter(app=self.app).first().values_list("version", "content")
+            )
+        except OperationalError:
+            last_version = None
+        if not last_version:
+            return SnapshotEncoder()
+        version, content = last_version
+        base = None
+        if is_delta(content):
+            base = await self._get_version_content(get_delta_base(content))
+        return SnapshotEncoder.from_last_version(version, content, base)
+
+    async def get_applied_versions(self) -> Set[str]:
+        """
+        load all applied versions of app with one query
+        :return:
+        """
+        try:
+            return set(await Aerich.filter(app=self.app).values_list("version", flat=True))
+        except OperationalError:
+            return set()
+
+    async def _get_db_version(self, connection: BaseDBAsyncClient):
+        if self.dialect == "mysql":
             sql = "select version() as version"
             ret = await connection.execute_query(sql)
-            cls._db_version = ret[1][0].get("version")
-
-    @classmethod
-    async def load_ddl_class(cls):
-        ddl_dialect_module = importlib.import_module(f"aerich.ddl.{cls.dialect}")
-        return getattr(ddl_dialect_module, f"{cls.dialect.capitalize()}DDL")
-
-    @classmethod
-    async def init(cls, config: dict, app: str, location: str):
-        await Tortoise.init(config=config)
-        last_version = await cls.get_last_version()
-        cls.app = app
-        cls.migrate_location = Path(location, app)
-        if last_version:
-            cls._last_version_content = last_version.content
+            self._db_version = ret[1][0].get("version")
+
+    async def load_ddl_class(self):
+        ddl_dialect_module = importlib.import_module(f"aerich.ddl.{self.dialect}")
+        return getattr(ddl_dialect_module, f"{self.dialect.capitalize()}DDL")
+
+    async def init(self, config: dict, app: str, location: str):
+        if not Tortoise._inited:
+            await Tortoise.init(config=config)
+        self.app = app
+        self.migrate_location = Path(location, app)
 
         connection = get_app_connection(config, app)
-        cls.dialect = connection.schema_generator.DIALECT
-        cls.ddl_class = await cls.load_ddl_class()
-        cls.ddl = cls.ddl_class(connection)
-        await cls._get_db_version(connection)
-
-    @classmethod
-    async def _get_last_version_num(cls):
-        last_version = await cls.get_last_version()
+        self.dialect = connection.schema_generator.DIALECT
+        self.ddl_class = await self.load_ddl_class()
+        self.ddl = self.ddl_class(connection)
+        await self._get_db_version(connection)
+
+    async def _get_last_version_num(self):
+        last_version = await self.get_last_version(with_content=False)
         if not last_version:
             return None
         version = last_version.version
         return int(version.split("_", 1)[0])
 
-    @classmethod
-    async def generate_version(cls, name=None):
+    async def generate_version(self, name=None):
         now = datetime.now().strftime("%Y%m%d%H%M%S").replace("/", "")
-        last_version_num = await cls._get_last_version_num()
+        last_version_num = await self._get_last_version_num()
         if last_version_num is None:
             return f"0_{now}_init.py"
         version = f"{last_version_num + 1}_{now}_{name}.py"
@@ -111,45 +220,51 @@ class Migrate:
             raise ValueError(f"Version name exceeds maximum length ({MAX_VERSION_LENGTH})")
         return version
 
-    @classmethod
-    async def _generate_diff_py(cls, name):
-        version = await cls.generate_version(name)
+    async def _generate_diff_py(self, name):
+        version = await self.generate_version(name)
         # delete if same version exists
-        for version_file in cls.get_all_version_files():
+        for version_file in self.get_all_version_files():
             if version_file.startswith(version.split("_")[0]):
-                os.unlink(Path(cls.migrate_location, version_file))
+                os.unlink(Path(self.migrate_location, version_file))
 
-        version_file = Path(cls.migrate_location, version)
-        content = cls._get_diff_file_content()
+        version_file = Path(self.migrate_location, version)
+        content = self._get_diff_file_content()
 
         with open(version_file, "w", encoding="utf-8") as f:
             f.write(content)
         return version
 
-    @classmethod
-    async def migrate(cls, name: str, empty: bool) -> str:
+    async def migrate(
+        self, name: str, empty: bool, coalesce: bool = False, online: bool = False
+    ) -> str:
         """
         diff old models and new models to generate diff content
         :param name: str name for migration
         :param empty: bool if True generates empty migration
+        :param coalesce: bool if True merges alterations of the same table into one ALTER TABLE
+        :param online: bool if True changes tables without blocking writes if the dialect supports
+            it, e.g. builds indexes outside of the migration transaction, adds MySQL ALGORITHM
+            and LOCK clauses
         :return:
         """
         if empty:
-            return await cls._generate_diff_py(name)
+            return await self._generate_diff_py(name)
 
-        new_version_content = get_models_describe(cls.app)
-        cls.diff_models(cls._last_version_content, new_version_content)
-        cls.diff_models(new_version_content, cls._last_version_content, False)
+        self._reset_operators()
+        self._last_version_content = await self.get_last_version_content()
+        new_version_content = get_models_describe(self.app)
+        self.diff_models(self._last_version_content, new_version_content)
 
-        cls._merge_operators()
+        self._merge_operators(coalesce, online)
 
-        if not cls.upgrade_operators:
+        if not (
+            self.upgrade_operators or self.pre_upgrade_operators or self.post_upgrade_operators
+        ):
             return ""
 
-        return await cls._generate_diff_py(name)
+        return await self._generate_diff_py(name)
 
-    @classmethod
-    def _get_diff_file_content(cls) -> str:
+    def _get_diff_file_content(self) -> str:
         """
         builds content for diff file from template
         """
@@ -159,395 +274,380 @@ class Migrate:
                 return ""
             return ";\n        ".join(lines) + ";"
 
-        return MIGRATE_TEMPLATE.format(
-            upgrade_sql=join_lines(cls.upgrade_operators),
-            downgrade_sql=join_lines(cls.downgrade_operators),
+        content = MIGRATE_TEMPLATE.format(
+            upgrade_sql=join_lines(self.upgrade_operators),
+            downgrade_sql=join_lines(self.downgrade_operators),
         )
+        for section in NON_TRANSACTIONAL_SECTIONS:
+            operators = getattr(self, f"{section}_operators")
+            if operators:
+                content += NON_TRANSACTIONAL_TEMPLATE.format(
+                    name=section,
+                    sql_list="\n        ".join(f"{operator!r}," for operator in operators),
+                )
+        return content
 
-    @classmethod
-    def _add_operator(cls, operator: str, upgrade=True, fk_m2m_index=False):
+    def _add_operator(self, operator: Union[Operation, str], upgrade=True):
         """
-        add operator,differentiate fk because fk is order limit
-        :param operator:
+        add operator, the order is resolved from dependencies of operators in _merge_operators
+        :param operator: operation, or raw sql without dependencies
         :param upgrade:
-        :param fk_m2m_index:
         :return:
         """
-        operator = operator.rstrip(";")
+        if not isinstance(operator, Operation):
+            operator = Operation(operator)
         if upgrade:
-            if fk_m2m_index:
-                cls._upgrade_fk_m2m_index_operators.append(operator)
-            else:
-                cls.upgrade_operators.append(operator)
+            self._upgrade_operations.append(operator)
         else:
-            if fk_m2m_index:
-                cls._downgrade_fk_m2m_index_operators.append(operator)
-            else:
-                cls.downgrade_operators.append(operator)
+            self._downgrade_operations.append(operator)
 
-    @classmethod
-    def _handle_indexes(cls, model: Type[Model], indexes: List[Union[Tuple[str], Index]]):
-        ret = []
+    def _handle_indexes(
+        self, model: Type[Model], indexes: List[Union[Tuple[str], Index]]
+    ) -> Dict[Union[Tuple[str], str], Union[Tuple[str], Index]]:
+        """
+        key indexes by fields, or by class and name for Index objects, so a stored index and the
+        current one compare equal
+        :param model:
+        :param indexes:
+        :return:
+        """
+        ret = {}
         for index in indexes:
             if isinstance(index, Index):
-                index.__hash__ = lambda self: md5(  # nosec: B303
-                    self.index_name(cls.ddl.schema_generator, model).encode()
-                    + self.__class__.__name__.encode()
-                ).hexdigest()
-            ret.append(index)
+                key = f"{index.__class__.__name__}:{index.index_name(self.ddl.schema_generator, model)}"
+            else:
+                index = key = tuple(index)
+            ret[key] = index
         return ret
 
-    @classmethod
-    def diff_models(cls, old_models: Dict[str, dict], new_models: Dict[str, dict], upgrade=True):
+    def _get_field_signature(self, field_describe: dict) -> str:
+        """
+        all attributes of field except name and db_column, a field can only be renamed to
+        another one with the same signature
+        :param field_describe:
+        :return:
+        """
+        return json.dumps(
+            {k: v for k, v in field_describe.items() if k not in ("name", "db_column")},
+            sort_keys=True,
+            default=str,
+        )
+
+    def diff_models(self, old_models: Dict[str, dict], new_models: Dict[str, dict]):
         """
-        diff models and add operators
+        diff models in one pass, add upgrade operators and the inverse downgrade operators
         :param old_models:
         :param new_models:
-        :param upgrade:
         :return:
         """
-        _aerich = f"{cls.app}.{cls._aerich}"
+        _aerich = f"{self.app}.{self._aerich}"
         old_models.pop(_aerich, None)
         new_models.pop(_aerich, None)
 
         for new_model_str, new_model_describe in new_models.items():
-            model = cls._get_model(new_model_describe.get("name").split(".")[1])
-
-            if new_model_str not in old_models.keys():
-                if upgrade:
-                    cls._add_operator(cls.add_model(model), upgrade)
-                else:
-                    # we can't find origin model when downgrade, so skip
-                    pass
-            else:
-                old_model_describe = old_models.get(new_model_str)
-                # rename table
-                new_table = new_model_describe.get("table")
-                old_table = old_model_describe.get("table")
-                if new_table != old_table:
-                    cls._add_operator(cls.rename_table(model, old_table, new_table), upgrade)
-                old_unique_together = set(
-                    map(lambda x: tuple(x), old_model_describe.get("unique_together"))
-                )
-                new_unique_together = set(
-                    map(lambda x: tuple(x), new_model_describe.get("unique_together"))
-                )
-                old_indexes = set(
-                    map(
-                        lambda x: x if isinstance(x, Index) else tuple(x),
-                        cls._handle_indexes(model, old_model_describe.get("indexes", [])),
-                    )
-                )
-                new_indexes = set(
-                    map(
-                        lambda x: x if isinstance(x, Index) else tuple(x),
-                        cls._handle_indexes(model, new_model_describe.get("indexes", [])),
-                    )
-                )
-                old_pk_field = old_model_describe.get("pk_field")
-                new_pk_field = new_model_describe.get("pk_field")
-                # pk field
-                changes = diff(old_pk_field, new_pk_field)
-                for action, option, change in changes:
-                    # current only support rename pk
-                    if action == "change" and option == "name":
-                        cls._add_operator(cls._rename_field(model, *change), upgrade)
-                # m2m fields
-                old_m2m_fields = old_model_describe.get("m2m_fields")
-                new_m2m_fields = new_model_describe.get("m2m_fields")
-                for action, option, change in diff(old_m2m_fields, new_m2m_fields):
-                    if change[0][0] == "db_constraint":
+            model = self._get_model(new_model_describe.get("name").split(".")[1])
+
+            if new_model_str not in old_models:
+                self._add_operator(self.add_model(model), True)
+                self._add_operator(self.drop_model(new_model_describe.get("table")), False)
+                continue
+            old_model_describe = old_models.get(new_model_str)
+            if get_fingerprint(old_model_describe) == get_fingerprint(new_model_describe):
+                continue
+            # rename table
+            new_table = new_model_describe.get("table")
+            old_table = old_model_describe.get("table")
+            if new_table != old_table:
+                self._add_operator(self.rename_table(model, old_table, new_table), True)
+                self._add_operator(self.rename_table(model, new_table, old_table), False)
+            old_unique_together = set(
+                map(lambda x: tuple(x), old_model_describe.get("unique_together"))
+            )
+            new_unique_together = set(
+                map(lambda x: tuple(x), new_model_describe.get("unique_together"))
+            )
+            old_indexes = self._handle_indexes(model, old_model_describe.get("indexes", []))
+            new_indexes = self._handle_indexes(model, new_model_describe.get("indexes", []))
+            old_pk_field = old_model_describe.get("pk_field")
+            new_pk_field = new_model_describe.get("pk_field")
+            # pk field
+            for action, option, change in diff(old_pk_field, new_pk_field):
+                # current only support rename pk
+                if action == "change" and option == "name":
+                    old_pk_name, new_pk_name = change
+                    self._add_operator(self._rename_field(model, old_pk_name, new_pk_name), True)
+                    self._add_operator(self._rename_field(model, new_pk_name, old_pk_name), False)
+            # m2m fields
+            old_m2m_fields = old_model_describe.get("m2m_fields")
+            new_m2m_fields = new_model_describe.get("m2m_fields")
+            for action, option, change in diff(old_m2m_fields, new_m2m_fields):
+                if action not in ("add", "remove") or option:
+                    continue
+                for _, m2m_field in change:
+                    through = m2m_field.get("through")
+                    if through in self._m2m_tables:
                         continue
-                    if isinstance(change[0][1], str):
-                        for new_m2m_field in new_m2m_fields:
-                            if new_m2m_field["name"] == change[0][1]:
-                                table = new_m2m_field.get("through")
-                                break
-                    else:
-                        table = change[0][1].get("through")
+                    self._m2m_tables.add(through)
+                    reference_model = m2m_field.get("model_name")
+                    models = new_models if action == "add" else old_models
+                    create_m2m = self.create_m2m(model, m2m_field, models.get(reference_model))
+                    drop_m2m = self.drop_m2m(through)
+                    # m2m table must be dropped before the tables it references
+                    drop_m2m.requires.update(create_m2m.requires)
                     if action == "add":
-                        add = False
-                        if upgrade and table not in cls._upgrade_m2m:
-                            cls._upgrade_m2m.append(table)
-                            add = True
-                        elif not upgrade and table not in cls._downgrade_m2m:
-                            cls._downgrade_m2m.append(table)
-                            add = True
-                        if add:
-                            cls._add_operator(
-                                cls.create_m2m(
-                                    model,
-                                    change[0][1],
-                                    new_models.get(change[0][1].get("model_name")),
-                                ),
-                                upgrade,
-                                fk_m2m_index=True,
-                            )
-                    elif action == "remove":
-                        add = False
-                        if upgrade and table not in cls._upgrade_m2m:
-                            cls._upgrade_m2m.append(table)
-                            add = True
-                        elif not upgrade and table not in cls._downgrade_m2m:
-                            cls._downgrade_m2m.append(table)
-                            add = True
-                        if add:
-                            cls._add_operator(cls.drop_m2m(table), upgrade, True)
-                # add unique_together
-                for index in new_unique_together.difference(old_unique_together):
-                    cls._add_operator(cls._add_index(model, index, True), upgrade, True)
-                # remove unique_together
-                for index in old_unique_together.difference(new_unique_together):
-                    cls._add_operator(cls._drop_index(model, index, True), upgrade, True)
-                # add indexes
-                for index in new_indexes.difference(old_indexes):
-                    cls._add_operator(cls._add_index(model, index, False), upgrade, True)
-                # remove indexes
-                for index in old_indexes.difference(new_indexes):
-                    cls._add_operator(cls._drop_index(model, index, False), upgrade, True)
-                old_data_fields = list(
-                    filter(
-                        lambda x: x.get("db_field_types") is not None,
-                        old_model_describe.get("data_fields"),
-                    )
-                )
-                new_data_fields = list(
-                    filter(
-                        lambda x: x.get("db_field_types") is not None,
-                        new_model_describe.get("data_fields"),
-                    )
-                )
-
-                old_data_fields_name = list(map(lambda x: x.get("name"), old_data_fields))
-                new_data_fields_name = list(map(lambda x: x.get("name"), new_data_fields))
-
-                # add fields or rename fields
-                for new_data_field_name in set(new_data_fields_name).difference(
-                    set(old_data_fields_name)
-                ):
-                    new_data_field = next(
-                        filter(lambda x: x.get("name") == new_data_field_name, new_data_fields)
+                        self._add_operator(create_m2m, True)
+                        self._add_operator(drop_m2m, False)
+                    else:
+                        self._add_operator(drop_m2m, True)
+                        self._add_operator(create_m2m, False)
+            # add unique_together
+            for index in new_unique_together.difference(old_unique_together):
+                self._add_operator(self._add_index(model, index, True), True)
+                self._add_operator(self._drop_index(model, index, True), False)
+            # remove unique_together
+            for index in old_unique_together.difference(new_unique_together):
+                self._add_operator(self._drop_index(model, index, True), True)
+                self._add_operator(self._add_index(model, index, True), False)
+            # add indexes
+            for key in new_indexes.keys() - old_indexes.keys():
+                index = new_indexes[key]
+                self._add_operator(self._add_index(model, index, False), True)
+                self._add_operator(self._drop_index(model, index, False), False)
+            # remove indexes
+            for key in old_indexes.keys() - new_indexes.keys():
+                index = old_indexes[key]
+                self._add_operator(self._drop_index(model, index, False), True)
+                self._add_operator(self._add_index(model, index, False), False)
+            old_data_fields = {
+                x["name"]: x
+                for x in old_model_describe.get("data_fields")
+                if x.get("db_field_types") is not None
+            }
+            new_data_fields = {
+                x["name"]: x
+                for x in new_model_describe.get("data_fields")
+                if x.get("db_field_types") is not None
+            }
+
+            # rename candidates, removed fields bucketed by signature
+            renamed_fields = defaultdict(list)
+            for old_data_field_name, old_data_field in old_data_fields.items():
+                if old_data_field_name not in new_data_fields:
+                    renamed_fields[self._get_field_signature(old_data_field)].append(old_data_field)
+            renamed_fields_name = set()
+            # add fields or rename fields
+            for new_data_field_name, new_data_field in new_data_fields.items():
+                if new_data_field_name in old_data_fields:
+                    continue
+                is_rename = False
+                candidates = renamed_fields.get(self._get_field_signature(new_data_field), [])
+                for old_data_field in candidates:
+                    old_data_field_name = old_data_field["name"]
+                    old_db_column = old_data_field.get("db_column")
+                    new_db_column = new_data_field.get("db_column")
+                    if old_db_column == new_db_column:
+                        continue
+                    is_rename = click.prompt(
+                        f"Rename {old_data_field_name} to {new_data_field_name}?",
+                        default=True,
+                        type=bool,
+                        show_choices=True,
                     )
-                    is_rename = False
-                    for old_data_field in old_data_fields:
-                        changes = list(diff(old_data_field, new_data_field))
-                        old_data_field_name = old_data_field.get("name")
-                        if len(changes) == 2:
-                            # rename field
-                            if (
-                                changes[0]
-                                == (
-                                    "change",
-                                    "name",
-                                    (old_data_field_name, new_data_field_name),
-                                )
-                                and changes[1]
-                                == (
-                                    "change",
-                                    "db_column",
-                                    (
-                                        old_data_field.get("db_column"),
-                                        new_data_field.get("db_column"),
-                                    ),
-                                )
-                                and old_data_field_name not in new_data_fields_name
-                            ):
-                                if upgrade:
-                                    is_rename = click.prompt(
-                                        f"Rename {old_data_field_name} to {new_data_field_name}?",
-                                        default=True,
-                                        type=bool,
-                                        show_choices=True,
-                                    )
-                                else:
-                                    is_rename = old_data_field_name in cls._rename_new
-                                if is_rename:
-                                    cls._rename_new.append(new_data_field_name)
-                                    cls._rename_old.append(old_data_field_name)
-                                    # only MySQL8+ has rename syntax
-                                    if (
-                                        cls.dialect == "mysql"
-                                        and cls._db_version
-                                        and cls._db_version.startswith("5.")
-                                    ):
-                                        cls._add_operator(
-                                            cls._change_field(
-                                                model, old_data_field, new_data_field
-                                            ),
-                                            upgrade,
-                                        )
-                                    else:
-                                        cls._add_operator(
-                                            cls._rename_field(model, *changes[1][2]),
-                                            upgrade,
-                                        )
                     if not is_rename:
-                        cls._add_operator(
-                            cls._add_field(
-                                model,
-                                new_data_field,
-                            ),
-                            upgrade,
+                        continue
+                    candidates.remove(old_data_field)
+                    renamed_fields_name.add(old_data_field_name)
+                    # only MySQL8+ has rename syntax
+                    if (
+                        self.dialect == "mysql"
+                        and self._db_version
+                        and self._db_version.startswith("5.")
+                    ):
+                        self._add_operator(
+                            self._change_field(model, old_data_field, new_data_field), True
                         )
-                        if new_data_field["indexed"]:
-                            cls._add_operator(
-                                cls._add_index(
-                                    model, {new_data_field["db_column"]}, new_data_field["unique"]
-                                ),
-                                upgrade,
-                                True,
-                            )
-                # remove fields
-                for old_data_field_name in set(old_data_fields_name).difference(
-                    set(new_data_fields_name)
+                        self._add_operator(
+                            self._change_field(model, new_data_field, old_data_field), False
+                        )
+                    else:
+                        self._add_operator(
+                            self._rename_field(model, old_db_column, new_db_column), True
+                        )
+                        self._add_operator(
+                            self._rename_field(model, new_db_column, old_db_column), False
+                        )
+                    break
+                if not is_rename:
+                    db_column = new_data_field["db_column"]
+                    unique = new_data_field["unique"]
+                    self._add_operator(self._add_field(model, new_data_field), True)
+                    self._add_operator(self._remove_field(model, db_column), False)
+                    if new_data_field["indexed"]:
+                        self._add_operator(
+                            self._add_columns_index(model, [db_column], unique), True
+                        )
+                        self._add_operator(
+                            self._drop_columns_index(model, [db_column], unique), False
+                        )
+            # remove fields
+            for old_data_field_name, old_data_field in old_data_fields.items():
+                # don't remove field if is renamed
+                if (
+                    old_data_field_name in new_data_fields
+                    or old_data_field_name in renamed_fields_name
                 ):
-                    # don't remove field if is renamed
-                    if (upgrade and old_data_field_name in cls._rename_old) or (
-                        not upgrade and old_data_field_name in cls._rename_new
-                    ):
+                    continue
+                db_column = old_data_field["db_column"]
+                unique = old_data_field["unique"]
+                self._add_operator(self._remove_field(model, db_column), True)
+                self._add_operator(self._add_field(model, old_data_field), False)
+                if old_data_field["indexed"]:
+                    self._add_operator(self._drop_columns_index(model, [db_column], unique), True)
+                    self._add_operator(self._add_columns_index(model, [db_column], unique), False)
+
+            old_fk_fields = {x["name"]: x for x in old_model_describe.get("fk_fields")}
+            new_fk_fields = {x["name"]: x for x in new_model_describe.get("fk_fields")}
+
+            # add fk
+            for new_fk_field_name, fk_field in new_fk_fields.items():
+                if new_fk_field_name in old_fk_fields or not fk_field.get("db_constraint"):
+                    continue
+                reference_table_describe = new_models.get(fk_field.get("python_type"))
+                self._add_operator(self._add_fk(model, fk_field, reference_table_describe), True)
+                self._add_operator(self._drop_fk(model, fk_field, reference_table_describe), False)
+            # drop fk
+            for old_fk_field_name, old_fk_field in old_fk_fields.items():
+                if old_fk_field_name in new_fk_fields or not old_fk_field.get("db_constraint"):
+                    continue
+                reference_table_describe = old_models.get(old_fk_field.get("python_type"))
+                self._add_operator(
+                    self._drop_fk(model, old_fk_field, reference_table_describe), True
+                )
+                self._add_operator(
+                    self._add_fk(model, old_fk_field, reference_table_describe), False
+                )
+            # change fields
+            for field_name, new_data_field in new_data_fields.items():
+                old_data_field = old_data_fields.get(field_name)
+                if old_data_field is None:
+                    continue
+                modified = False
+                for _, option, old_new in diff(old_data_field, new_data_field):
+                    if option == "indexed":
+                        # change index
+                        old_unique = old_data_field.get("unique")
+                        new_unique = new_data_field.get("unique")
+                        if old_new[0] is False and old_new[1] is True:
+                            self._add_operator(
+                                self._add_index(model, (field_name,), new_unique), True
+                            )
+                            self._add_operator(
+                                self._drop_index(model, (field_name,), new_unique), False
+                            )
+                        else:
+                            self._add_operator(
+                                self._drop_index(model, (field_name,), old_unique), True
+                            )
+                            self._add_operator(
+                                self._add_index(model, (field_name,), old_unique), False
+                            )
+                    elif option == "db_field_types.":
+                        # modify column
+                        if new_data_field.get("field_type") == "DecimalField":
+                            self._add_operator(
+                                self._modify_field(model, new_data_field, old_data_field), True
+                            )
+                        if old_data_field.get("field_type") == "DecimalField":
+                            self._add_operator(
+                                self._modify_field(model, old_data_field, new_data_field), False
+                            )
+                    elif option == "default":
+                        if not (is_default_function(old_new[0]) or is_default_function(old_new[1])):
+                            # change column default
+                            self._add_operator(
+                                self._alter_default(model, new_data_field, old_data_field), True
+                            )
+                            self._add_operator(
+                                self._alter_default(model, old_data_field, new_data_field), False
+                            )
+                    elif option == "unique":
+                        # because indexed include it
                         continue
-                    old_data_field = next(
-                        filter(lambda x: x.get("name") == old_data_field_name, old_data_fields)
-                    )
-                    db_column = old_data_field["db_column"]
-                    cls._add_operator(
-                        cls._remove_field(
-                            model,
-                            db_column,
-                        ),
-                        upgrade,
-                    )
-                    if old_data_field["indexed"]:
-                        cls._add_operator(
-                            cls._drop_index(
-                                model,
-                                {db_column},
-                            ),
-                            upgrade,
-                            True,
+                    elif option == "nullable":
+                        # change nullable
+                        self._add_operator(
+                            self._alter_null(model, new_data_field, old_data_field), True
                         )
-
-                old_fk_fields = old_model_describe.get("fk_fields")
-                new_fk_fields = new_model_describe.get("fk_fields")
-
-                old_fk_fields_name = list(map(lambda x: x.get("name"), old_fk_fields))
-                new_fk_fields_name = list(map(lambda x: x.get("name"), new_fk_fields))
-
-                # add fk
-                for new_fk_field_name in set(new_fk_fields_name).difference(
-                    set(old_fk_fields_name)
-                ):
-                    fk_field = next(
-                        filter(lambda x: x.get("name") == new_fk_field_name, new_fk_fields)
-                    )
-                    if fk_field.get("db_constraint"):
-                        cls._add_operator(
-                            cls._add_fk(
-                                model, fk_field, new_models.get(fk_field.get("python_type"))
-                            ),
-                            upgrade,
-                            fk_m2m_index=True,
+                        self._add_operator(
+                            self._alter_null(model, old_data_field, new_data_field), False
                         )
-                # drop fk
-                for old_fk_field_name in set(old_fk_fields_name).difference(
-                    set(new_fk_fields_name)
-                ):
-                    old_fk_field = next(
-                        filter(lambda x: x.get("name") == old_fk_field_name, old_fk_fields)
-                    )
-                    if old_fk_field.get("db_constraint"):
-                        cls._add_operator(
-                            cls._drop_fk(
-                                model, old_fk_field, old_models.get(old_fk_field.get("python_type"))
-                            ),
-                            upgrade,
-                            fk_m2m_index=True,
+                    elif option == "description":
+                        # change comment
+                        self._add_operator(
+                            self._set_comment(model, new_data_field, old_data_field), True
                         )
-                # change fields
-                for field_name in set(new_data_fields_name).intersection(set(old_data_fields_name)):
-                    old_data_field = next(
-                        filter(lambda x: x.get("name") == field_name, old_data_fields)
-                    )
-                    new_data_field = next(
-                        filter(lambda x: x.get("name") == field_name, new_data_fields)
-                    )
-                    changes = diff(old_data_field, new_data_field)
-                    modified = False
-                    for change in changes:
-                        _, option, old_new = change
-                        if option == "indexed":
-                            # change index
-                            unique = new_data_field.get("unique")
-                            if old_new[0] is False and old_new[1] is True:
-                                cls._add_operator(
-                                    cls._add_index(model, (field_name,), unique), upgrade, True
-                                )
-                            else:
-                                cls._add_operator(
-                                    cls._drop_index(model, (field_name,), unique), upgrade, True
-                                )
-                        elif option == "db_field_types.":
-                            if new_data_field.get("field_type") == "DecimalField":
-                                # modify column
-                                cls._add_operator(
-                                    cls._modify_field(model, new_data_field),
-                                    upgrade,
-                                )
-                            else:
-                                continue
-                        elif option == "default":
-                            if not (
-                                is_default_function(old_new[0]) or is_default_function(old_new[1])
-                            ):
-                                # change column default
-                                cls._add_operator(
-                                    cls._alter_default(model, new_data_field), upgrade
-                                )
-                        elif option == "unique":
-                            # because indexed include it
+                        self._add_operator(
+                            self._set_comment(model, old_data_field, new_data_field), False
+                        )
+                    else:
+                        if modified:
                             continue
-                        elif option == "nullable":
-                            # change nullable
-                            cls._add_operator(cls._alter_null(model, new_data_field), upgrade)
-                        elif option == "description":
-                            # change comment
-                            cls._add_operator(cls._set_comment(model, new_data_field), upgrade)
-                        else:
-                            if modified:
-                                continue
-                            # modify column
-                            cls._add_operator(
-                                cls._modify_field(model, new_data_field),
-                                upgrade,
-                            )
-                            modified = True
+                        # modify column
+                        self._add_operator(
+                            self._modify_field(model, new_data_field, old_data_field), True
+                        )
+                        self._add_operator(
+                            self._modify_field(model, old_data_field, new_data_field), False
+                        )
+                        modified = True
 
-        for old_model in old_models:
-            if old_model not in new_models.keys():
-                cls._add_operator(cls.drop_model(old_models.get(old_model).get("table")), upgrade)
+        for old_model_str, old_model_describe in old_models.items():
+            if old_model_str not in new_models:
+                # we can't find origin model when downgrade, so only drop it
+                self._add_operator(self.drop_model(old_model_describe.get("table")), True)
 
-    @classmethod
-    def rename_table(cls, model: Type[Model], old_table_name: str, new_table_name: str):
-        return cls.ddl.rename_table(model, old_table_name, new_table_name)
+    def rename_table(self, model: Type[Model], old_table_name: str, new_table_name: str):
+        return RenameTable(
+            model,
+            old_table_name,
+            new_table_name,
+            provides=[table_resource(new_table_name)],
+            removes=[table_resource(old_table_name)],
+        )
 
-    @classmethod
-    def add_model(cls, model: Type[Model]):
-        return cls.ddl.create_table(model)
+    def add_model(self, model: Type[Model]):
+        meta = model._meta
+        return CreateTable(
+            model,
+            requires=[
+                table_resource(meta.fields_map[field_name].related_model._meta.db_table)
+                for field_name in (*meta.fk_fields, *meta.o2o_fields)
+            ],
+            provides=[table_resource(meta.db_table)],
+        )
 
-    @classmethod
-    def drop_model(cls, table_name: str):
-        return cls.ddl.drop_table(table_name)
+    def drop_model(self, table_name: str):
+        return DropTable(table_name, removes=[table_resource(table_name)])
 
-    @classmethod
-    def create_m2m(cls, model: Type[Model], field_describe: dict, reference_table_describe: dict):
-        return cls.ddl.create_m2m(model, field_describe, reference_table_describe)
+    def create_m2m(self, model: Type[Model], field_describe: dict, reference_table_describe: dict):
+        return CreateM2M(
+            model,
+            field_describe,
+            reference_table_describe,
+            requires=[
+                column_resource(model._meta.db_table, model._meta.db_pk_column),
+                column_resource(
+                    reference_table_describe.get("table"),
+                    reference_table_describe.get("pk_field").get("db_column"),
+                ),
+            ],
+            provides=[table_resource(field_describe.get("through"))],
+        )
 
-    @classmethod
-    def drop_m2m(cls, table_name: str):
-        return cls.ddl.drop_m2m(table_name)
+    def drop_m2m(self, table_name: str):
+        return DropM2M(table_name, removes=[table_resource(table_name)])
 
-    @classmethod
-    def _resolve_fk_fields_name(cls, model: Type[Model], fields_name: Tuple[str]):
+    def _resolve_fk_fields_name(self, model: Type[Model], fields_name: Tuple[str]):
         ret = []
         for field_name in fields_name:
             field = model._meta.fields_map[field_name]
@@ -559,66 +659,162 @@ class Migrate:
                 ret.append(field_name)
         return ret
 
-    @classmethod
-    def _drop_index(cls, model: Type[Model], fields_name: Union[Tuple[str], Index], unique=False):
+    def _get_index_name(self, model: Type[Model], columns: List[str], unique=False) -> str:
+        return self.ddl.schema_generator._generate_index_name(
+            "idx" if not unique else "uid", model, columns
+        )
+
+    def _add_columns_index(self, model: Type[Model], columns: List[str], unique=False):
+        db_table = model._meta.db_table
+        return AddIndex(
+            model,
+            columns,
+            unique,
+            requires=[column_resource(db_table, name) for name in columns],
+            provides=[index_resource(db_table, self._get_index_name(model, columns, unique))],
+        )
+
+    def _drop_columns_index(self, model: Type[Model], columns: List[str], unique=False):
+        db_table = model._meta.db_table
+        return DropIndex(
+            model,
+            columns,
+            unique,
+            requires=[column_resource(db_table, name) for name in columns],
+            removes=[index_resource(db_table, self._get_index_name(model, columns, unique))],
+        )
+
+    def _drop_index(self, model: Type[Model], fields_name: Union[Tuple[str], Index], unique=False):
         if isinstance(fields_name, Index):
-            return cls.ddl.drop_index_by_name(
-                model, fields_name.index_name(cls.ddl.schema_generator, model)
+            db_table = model._meta.db_table
+            index_name = fields_name.index_name(self.ddl.schema_generator, model)
+            return DropIndex(
+                model,
+                fields_name,
+                requires=[column_resource(db_table, name) for name in fields_name.fields],
+                removes=[index_resource(db_table, index_name)],
             )
-        fields_name = cls._resolve_fk_fields_name(model, fields_name)
-        return cls.ddl.drop_index(model, fields_name, unique)
+        return self._drop_columns_index(
+            model, self._resolve_fk_fields_name(model, fields_name), unique
+        )
 
-    @classmethod
-    def _add_index(cls, model: Type[Model], fields_name: Union[Tuple[str], Index], unique=False):
+    def _add_index(self, model: Type[Model], fields_name: Union[Tuple[str], Index], unique=False):
         if isinstance(fields_name, Index):
-            return fields_name.get_sql(cls.ddl.schema_generator, model, False)
-        fields_name = cls._resolve_fk_fields_name(model, fields_name)
-        return cls.ddl.add_index(model, fields_name, unique)
-
-    @classmethod
-    def _add_field(cls, model: Type[Model], field_describe: dict, is_pk: bool = False):
-        return cls.ddl.add_column(model, field_describe, is_pk)
-
-    @classmethod
-    def _alter_default(cls, model: Type[Model], field_describe: dict):
-        return cls.ddl.alter_column_default(model, field_describe)
+            db_table = model._meta.db_table
+            index_name = fields_name.index_name(self.ddl.schema_generator, model)
+            return AddIndex(
+                model,
+                fields_name,
+                requires=[column_resource(db_table, name) for name in fields_name.fields],
+                provides=[index_resource(db_table, index_name)],
+            )
+        return self._add_columns_index(
+            model, self._resolve_fk_fields_name(model, fields_name), unique
+        )
 
-    @classmethod
-    def _alter_null(cls, model: Type[Model], field_describe: dict):
-        return cls.ddl.alter_column_null(model, field_describe)
+    def _add_field(self, model: Type[Model], field_describe: dict, is_pk: bool = False):
+        return AddColumn(
+            model,
+            field_describe,
+            is_pk,
+            provides=[column_resource(model._meta.db_table, field_describe.get("db_column"))],
+        )
 
-    @classmethod
-    def _set_comment(cls, model: Type[Model], field_describe: dict):
-        return cls.ddl.set_comment(model, field_describe)
+    def _alter_column(
+        self,
+        operation_class: Type[AlterColumn],
+        model: Type[Model],
+        field_describe: dict,
+        old_field_describe: Optional[dict] = None,
+    ):
+        return operation_class(
+            model,
+            field_describe,
+            old_field_describe,
+            requires=[column_resource(model._meta.db_table, field_describe.get("db_column"))],
+        )
 
-    @classmethod
-    def _modify_field(cls, model: Type[Model], field_describe: dict):
-        return cls.ddl.modify_column(model, field_describe)
+    def _alter_default(
+        self, model: Type[Model], field_describe: dict, old_field_describe: Optional[dict] = None
+    ):
+        return self._alter_column(AlterDefault, model, field_describe, old_field_describe)
+
+    def _alter_null(
+        self, model: Type[Model], field_describe: dict, old_field_describe: Optional[dict] = None
+    ):
+        return self._alter_column(AlterNull, model, field_describe, old_field_describe)
+
+    def _set_comment(
+        self, model: Type[Model], field_describe: dict, old_field_describe: Optional[dict] = None
+    ):
+        return self._alter_column(SetComment, model, field_describe, old_field_describe)
+
+    def _modify_field(
+        self, model: Type[Model], field_describe: dict, old_field_describe: Optional[dict] = None
+    ):
+        return self._alter_column(ModifyColumn, model, field_describe, old_field_describe)
+
+    def _get_fk_name(
+        self, model: Type[Model], field_describe: dict, reference_table_describe: dict
+    ) -> str:
+        return self.ddl.schema_generator._generate_fk_name(
+            from_table=model._meta.db_table,
+            from_field=field_describe.get("raw_field"),
+            to_table=reference_table_describe.get("table"),
+            to_field=reference_table_describe.get("pk_field").get("db_column"),
+        )
 
-    @classmethod
-    def _drop_fk(cls, model: Type[Model], field_describe: dict, reference_table_describe: dict):
-        return cls.ddl.drop_fk(model, field_describe, reference_table_describe)
+    def _drop_fk(self, model: Type[Model], field_describe: dict, reference_table_describe: dict):
+        db_table = model._meta.db_table
+        return DropFk(
+            model,
+            field_describe,
+            reference_table_describe,
+            requires=[
+                column_resource(db_table, field_describe.get("raw_field")),
+                table_resource(reference_table_describe.get("table")),
+                column_resource(
+                    reference_table_describe.get("table"),
+                    reference_table_describe.get("pk_field").get("db_column"),
+                ),
+            ],
+            removes=[
+                constraint_resource(
+                    db_table, self._get_fk_name(model, field_describe, reference_table_describe)
+                )
+            ],
+        )
 
-    @classmethod
-    def _remove_field(cls, model: Type[Model], column_name: str):
-        return cls.ddl.drop_column(model, column_name)
+    def _remove_field(self, model: Type[Model], column_name: str):
+        return DropColumn(
+            model, column_name, removes=[column_resource(model._meta.db_table, column_name)]
+        )
 
-    @classmethod
-    def _rename_field(cls, model: Type[Model], old_field_name: str, new_field_name: str):
-        return cls.ddl.rename_column(model, old_field_name, new_field_name)
+    def _rename_field(self, model: Type[Model], old_field_name: str, new_field_name: str):
+        db_table = model._meta.db_table
+        return RenameColumn(
+            model,
+            old_field_name,
+            new_field_name,
+            provides=[column_resource(db_table, new_field_name)],
+            removes=[column_resource(db_table, old_field_name)],
+        )
 
-    @classmethod
-    def _change_field(cls, model: Type[Model], old_field_describe: dict, new_field_describe: dict):
+    def _change_field(self, model: Type[Model], old_field_describe: dict, new_field_describe: dict):
+        db_table = model._meta.db_table
         db_field_types = new_field_describe.get("db_field_types")
-        return cls.ddl.change_column(
+        old_db_column = old_field_describe.get("db_column")
+        new_db_column = new_field_describe.get("db_column")
+        return ChangeColumn(
             model,
-            old_field_describe.get("db_column"),
-            new_field_describe.get("db_column"),
-            db_field_types.get(cls.dialect) or db_field_types.get(""),
+            old_db_column,
+            new_db_column,
+            db_field_types.get(self.dialect) or db_field_types.get(""),
+            provides=[column_resource(db_table, new_db_column)],
+            removes=[column_resource(db_table, old_db_column)],
         )
 
-    @classmethod
-    def _add_fk(cls, model: Type[Model], field_describe: dict, reference_table_describe: dict):
+    def _add_fk(self, model: Type[Model], field_describe: dict, reference_table_describe: dict):
         """
         add fk
         :param model:
@@ -626,22 +822,129 @@ class Migrate:
         :param reference_table_describe:
         :return:
         """
-        return cls.ddl.add_fk(model, field_describe, reference_table_describe)
+        db_table = model._meta.db_table
+        return AddFk(
+            model,
+            field_describe,
+            reference_table_describe,
+            requires=[
+                column_resource(db_table, field_describe.get("raw_field")),
+                column_resource(
+                    reference_table_describe.get("table"),
+                    reference_table_describe.get("pk_field").get("db_column"),
+                ),
+            ],
+            provides=[
+                constraint_resource(
+                    db_table, self._get_fk_name(model, field_describe, reference_table_describe)
+                )
+            ],
+        )
 
-    @classmethod
-    def _merge_operators(cls):
+    def _render_layer(self, layer: List[Operation], coalesce: bool = False) -> List[str]:
         """
-        fk/m2m/index must be last when add,first when drop
+        render independent operations, alterations of one table are merged into one ALTER TABLE
+        if coalesce and the dialect allows it
+        :param layer:
+        :param coalesce:
         :return:
         """
-        for _upgrade_fk_m2m_operator in cls._upgrade_fk_m2m_index_operators:
-            if "ADD" in _upgrade_fk_m2m_operator or "CREATE" in _upgrade_fk_m2m_operator:
-                cls.upgrade_operators.append(_upgrade_fk_m2m_operator)
+        ret: List[str] = []
+        clauses: Dict[str, Tuple[int, List[str]]] = {}
+        for operation in layer:
+            sql = operation.render(self.ddl)
+            model = getattr(operation, "model", None)
+            clause = (
+                self.ddl.get_alter_table_clause(model._meta.db_table, sql)
+                if coalesce and model
+                else None
+            )
+            if clause is None:
+                ret.append(sql)
+                continue
+            db_table = model._meta.db_table
+            if db_table in clauses:
+                clauses[db_table][1].append(clause)
             else:
-                cls.upgrade_operators.insert(0, _upgrade_fk_m2m_operator)
+                clauses[db_table] = (len(ret), [clause])
+                ret.append(sql)
+        for db_table, (position, table_clauses) in clauses.items():
+            if len(table_clauses) > 1:
+                ret[position] = self.ddl.coalesce_alter_table(db_table, table_clauses)
+        return ret
 
-        for _downgrade_fk_m2m_operator in cls._downgrade_fk_m2m_index_operators:
-            if "ADD" in _downgrade_fk_m2m_operator or "CREATE" in _downgrade_fk_m2m_operator:
-                cls.downgrade_operators.append(_downgrade_fk_m2m_operator)
-            else:
-                cls.downgrade_operators.insert(0, _downgrade_fk_m2m_operator)
+    def _warn_table_rewrites(self, operations: List[Operation]):
+        for operation in operations:
+            if isinstance(operation, ModifyColumn) and operation.rewrites_table(self.ddl):
+                db_table, db_column = operation.column_key
+                click.secho(
+                    f"Changing type of column {db_table}.{db_column} rewrites the whole table",
+                    fg=Color.yellow,
+                )
+            elif isinstance(operation, RebuildTable):
+                click.secho(
+                    f"Changing columns of table {operation.model._meta.db_table} rebuilds the "
+                    "whole table",
+                    fg=Color.yellow,
+                )
+
+    def _merge_operators(self, coalesce: bool = False, online: bool = False):
+        """
+        optimize the collected operations, order them by their dependencies, e.g. a fk is added
+        after its column and dropped before it, then render them with the ddl
+        :param coalesce: merge alterations of the same table into one ALTER TABLE
+        :param online: build and drop indexes concurrently, validate foreign keys and not null
+            separately, add online algorithm to alterations, non-transactional operations which remove objects run before the
+            transaction, unless they depend on it, the others after it
+        :return:
+        """
+        for direction in ("upgrade", "downgrade"):
+            operations = getattr(self, f"_{direction}_operations")
+            if online:
+                operations = make_online(operations, self.ddl, self._db_version)
+            operators, pre_operators, post_operators = [], [], []
+            # objects which exist only after the transaction
+            provided = set()
+            operations = optimize_operations(operations, self.ddl)
+            if direction == "upgrade":
+                self._warn_table_rewrites(operations)
+            for layer in sort_operations(operations):
+                transactional = [operation for operation in layer if operation.transactional]
+                operators.extend(self._render_layer(transactional, coalesce))
+                for operation in transactional:
+                    provided |= operation.provides
+                for operation in layer:
+                    if operation.transactional:
+                        continue
+                    if operation.removes and not operation.requires & provided:
+                        pre_operators.append(operation.render(self.ddl))
+                    else:
+                        post_operators.append(operation.render(self.ddl))
+                        provided |= operation.provides
+            getattr(self, f"{direction}_operators").extend(operators)
+            getattr(self, f"pre_{direction}_operators").extend(pre_operators)
+            getattr(self, f"post_{direction}_operators").extend(post_operators)
+
+
+class Migrate(Migrator):
+    """
+    Process wide migrator with the classmethod api, the state is kept on the class.
+    """
+
+    upgrade_operators: List[str] = []
+    downgrade_operators: List[str] = []
+    pre_upgrade_operators: List[str] = []
+    post_upgrade_operators: List[str] = []
+    pre_downgrade_operators: List[str] = []
+    post_downgrade_operators: List[str] = []
+    _upgrade_operations: List[Operation] = []
+    _downgrade_operations: List[Operation] = []
+    _m2m_tables: Set[str] = set()
+    _last_version_content: Optional[dict] = None
+    _db_version: Optional[str] = None
+
+
+# bind the methods of Migrator to the Migrate class itself
+for _name, _method in vars(Migrator).items():
+    if not _name.startswith("__") and callable(_method):
+        setattr(Migrate, _name, classmethod(_method))
@@ -0,0 +1,614 @@
+from collections import defaultdict
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+from tortoise import Model
+from tortoise.indexes import Index
+
+from aerich.ddl import BaseDDL
+
+Resource = Tuple[str, ...]
+
+
+def table_resource(name: str) -> Resource:
+    return ("table", name)
+
+
+def column_resource(table_name: str, name: str) -> Resource:
+    return ("column", table_name, name)
+
+
+def index_resource(table_name: str, name: str) -> Resource:
+    return ("index", table_name, name)
+
+
+def constraint_resource(table_name: str, name: str) -> Resource:
+    return ("constraint", table_name, name)
+
+
+class Operation:
+    """
+    One migrate statement and the database objects it depends on, it is rendered to sql by the
+    ddl of the dialect once, after all operations are collected.
+
+    requires: objects that must exist when the statement runs
+    provides: objects created by the statement
+    removes: objects dropped by the statement
+    """
+
+    # False if the statement can't run inside a transaction
+    transactional = True
+    # MySQL version since which the alteration can be done with ALGORITHM=INSTANT
+    instant_since: Optional[Tuple[int, ...]] = None
+    # online algorithm of the alteration, for dialects with ALGORITHM_HINTS
+    algorithm: Optional[str] = None
+
+    def __init__(
+        self,
+        sql: Optional[str] = None,
+        requires: Iterable[Resource] = (),
+        provides: Iterable[Resource] = (),
+        removes: Iterable[Resource] = (),
+    ):
+        self.sql = sql.rstrip(";") if sql is not None else None
+        self.provides: Set[Resource] = set(provides)
+        self.removes: Set[Resource] = set(removes)
+        self.requires: Set[Resource] = set(requires)
+        # objects of a table always need the table itself
+        for resource in (*self.requires, *self.provides, *self.removes):
+            if resource[0] != "table":
+                self.requires.add(table_resource(resource[1]))
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        raise NotImplementedError
+
+    def render(self, ddl: BaseDDL) -> str:
+        # schema generators keep state between calls, e.g. postgres column comments, so render
+        # only once
+        if self.sql is None:
+            sql = self.to_sql(ddl).rstrip(";")
+            if self.algorithm:
+                sql = ddl.add_algorithm(self.model._meta.db_table, sql, self.algorithm)
+            self.sql = sql
+        return self.sql
+
+    def is_noop(self, ddl: BaseDDL) -> bool:
+        return False
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.sql or self.provides or self.removes}>"
+
+
+class ModelOperation(Operation):
+    def __init__(self, model: Type[Model], **resources):
+        self.model = model
+        super().__init__(**resources)
+
+
+class CreateTable(ModelOperation):
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.create_table(self.model)
+
+
+class DropTable(Operation):
+    def __init__(self, table_name: str, **resources):
+        self.table_name = table_name
+        super().__init__(**resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.drop_table(self.table_name)
+
+
+class RenameTable(ModelOperation):
+    def __init__(self, model: Type[Model], old_table_name: str, new_table_name: str, **resources):
+        self.old_table_name = old_table_name
+        self.new_table_name = new_table_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.rename_table(self.model, self.old_table_name, self.new_table_name)
+
+
+class CreateM2M(ModelOperation):
+    def __init__(
+        self,
+        model: Type[Model],
+        field_describe: dict,
+        reference_table_describe: dict,
+        **resources,
+    ):
+        self.field_describe = field_describe
+        self.reference_table_describe = reference_table_describe
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.create_m2m(self.model, self.field_describe, self.reference_table_describe)
+
+
+class DropM2M(DropTable):
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.drop_m2m(self.table_name)
+
+
+class AddColumn(ModelOperation):
+    instant_since = (8, 0, 12)
+
+    def __init__(self, model: Type[Model], field_describe: dict, is_pk: bool = False, **resources):
+        self.field_describe = field_describe
+        self.is_pk = is_pk
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.add_column(self.model, self.field_describe, self.is_pk)
+
+
+class DropColumn(ModelOperation):
+    instant_since = (8, 0, 29)
+
+    def __init__(self, model: Type[Model], column_name: str, **resources):
+        self.column_name = column_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.drop_column(self.model, self.column_name)
+
+
+class RenameColumn(ModelOperation):
+    instant_since = (8, 0, 28)
+
+    def __init__(self, model: Type[Model], old_column_name: str, new_column_name: str, **resources):
+        self.old_column_name = old_column_name
+        self.new_column_name = new_column_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.rename_column(self.model, self.old_column_name, self.new_column_name)
+
+
+class ChangeColumn(RenameColumn):
+    instant_since = None
+
+    def __init__(
+        self,
+        model: Type[Model],
+        old_column_name: str,
+        new_column_name: str,
+        new_column_type: str,
+        **resources,
+    ):
+        self.new_column_type = new_column_type
+        super().__init__(model, old_column_name, new_column_name, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.change_column(
+            self.model, self.old_column_name, self.new_column_name, self.new_column_type
+        )
+
+
+class AddIndex(ModelOperation):
+    def __init__(
+        self, model: Type[Model], fields: Union[List[str], Index], unique=False, **resources
+    ):
+        self.fields = fields
+        self.unique = unique
+        self.concurrently = False
+        super().__init__(model, **resources)
+
+    @property
+    def transactional(self) -> bool:
+        return not self.concurrently
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        if self.concurrently:
+            return ddl.add_index_concurrently(self.model, self.fields, self.unique)
+        if isinstance(self.fields, Index):
+            return self.fields.get_sql(ddl.schema_generator, self.model, False)
+        return ddl.add_index(self.model, self.fields, self.unique)
+
+
+class DropIndex(AddIndex):
+    def to_sql(self, ddl: BaseDDL) -> str:
+        if self.concurrently:
+            return ddl.drop_index_concurrently(self.model, self.fields, self.unique)
+        if isinstance(self.fields, Index):
+            return ddl.drop_index_by_name(
+                self.model, self.fields.index_name(ddl.schema_generator, self.model)
+            )
+        return ddl.drop_index(self.model, self.fields, self.unique)
+
+
+class AddFk(ModelOperation):
+    def __init__(
+        self,
+        model: Type[Model],
+        field_describe: dict,
+        reference_table_describe: dict,
+        **resources,
+    ):
+        self.field_describe = field_describe
+        self.reference_table_describe = reference_table_describe
+        self.not_valid = False
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        if self.not_valid:
+            return ddl.add_fk_not_valid(
+                self.model, self.field_describe, self.reference_table_describe
+            )
+        return ddl.add_fk(self.model, self.field_describe, self.reference_table_describe)
+
+
+class DropFk(AddFk):
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.drop_fk(self.model, self.field_describe, self.reference_table_describe)
+
+
+class ValidateConstraint(ModelOperation):
+    """
+    Check existing rows against a constraint added as NOT VALID, it runs after the migration
+    transaction so the lock of adding the constraint is not held during the scan.
+    """
+
+    transactional = False
+
+    def __init__(self, model: Type[Model], constraint_name: str, **resources):
+        self.constraint_name = constraint_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.validate_constraint(self.model, self.constraint_name)
+
+
+class DropConstraint(ModelOperation):
+    def __init__(self, model: Type[Model], constraint_name: str, **resources):
+        self.constraint_name = constraint_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.drop_constraint(self.model, self.constraint_name)
+
+
+class AddNotNullCheck(ModelOperation):
+    """
+    Check a column is not null for new rows only, validated later.
+    """
+
+    def __init__(self, model: Type[Model], column_name: str, constraint_name: str, **resources):
+        self.column_name = column_name
+        self.constraint_name = constraint_name
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.add_not_null_check(self.model, self.column_name, self.constraint_name)
+
+
+class AlterColumn(ModelOperation):
+    """
+    Change of one column from old_field_describe to field_describe.
+    """
+
+    def __init__(
+        self,
+        model: Type[Model],
+        field_describe: dict,
+        old_field_describe: Optional[dict] = None,
+        **resources,
+    ):
+        self.field_describe = field_describe
+        self.old_field_describe = old_field_describe
+        super().__init__(model, **resources)
+
+    @property
+    def column_key(self) -> Tuple[str, str]:
+        return self.model._meta.db_table, self.field_describe.get("db_column")
+
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        raise NotImplementedError
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return self._to_sql(ddl, self.field_describe)
+
+    def is_noop(self, ddl: BaseDDL) -> bool:
+        """
+        the change is not visible in the dialect, e.g. a type change to the same database type
+        """
+        return self.old_field_describe is not None and self._to_sql(
+            ddl, self.old_field_describe
+        ) == self._to_sql(ddl, self.field_describe)
+
+
+class ModifyColumn(AlterColumn):
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        return ddl.modify_column(
+            self.model, field_describe, old_field_describe=self.old_field_describe
+        )
+
+    def rewrites_table(self, ddl: BaseDDL) -> bool:
+        """
+        the column type change can't be done in place, the whole table is rewritten
+        """
+        return self.old_field_describe is not None and not ddl.is_binary_coercible(
+            ddl.get_column_type(self.old_field_describe), ddl.get_column_type(self.field_describe)
+        )
+
+
+class AlterDefault(AlterColumn):
+    instant_since = (8, 0, 12)
+
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        return ddl.alter_column_default(self.model, field_describe)
+
+
+class AlterNull(AlterColumn):
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        return ddl.alter_column_null(self.model, field_describe)
+
+
+class AlterDefaultNull(AlterColumn):
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        return ddl.alter_column_default_null(self.model, field_describe)
+
+
+class SetComment(AlterColumn):
+    def _to_sql(self, ddl: BaseDDL, field_describe: dict) -> str:
+        return ddl.set_comment(self.model, field_describe)
+
+
+class RebuildTable(ModelOperation):
+    """
+    Changes of columns of one table applied by one rebuild of the table, for dialects which can't
+    alter columns in place.
+    """
+
+    def __init__(self, model: Type[Model], **resources):
+        # changed columns mapped to their new describe
+        self.field_describes: Dict[str, dict] = {}
+        super().__init__(model, **resources)
+
+    def to_sql(self, ddl: BaseDDL) -> str:
+        return ddl.rebuild_table(self.model, list(self.field_describes.values()))
+
+
+def _cancel_operations(operations: List[Operation]) -> List[Operation]:
+    """
+    cancel an operation creating objects with a later one removing exactly them, when nothing
+    else needs the objects in between
+    """
+    requirers: Dict[Resource, int] = defaultdict(int)
+    removers: Dict[FrozenSet[Resource], List[int]] = defaultdict(list)
+    for i, operation in enumerate(operations):
+        for resource in operation.requires:
+            requirers[resource] += 1
+        if operation.removes:
+            removers[frozenset(operation.removes)].append(i)
+    cancelled = set()
+    for i, operation in enumerate(operations):
+        if i in cancelled or not operation.provides:
+            continue
+        for j in removers.get(frozenset(operation.provides), ()):
+            if j <= i or j in cancelled:
+                continue
+            used = sum(
+                requirers[resource]
+                - (resource in operation.requires)
+                - (resource in operations[j].requires)
+                for resource in operation.provides
+            )
+            if not used:
+                cancelled.update((i, j))
+            break
+    return [operation for i, operation in enumerate(operations) if i not in cancelled]
+
+
+def _fold_operations(operations: List[Operation]) -> List[Operation]:
+    """
+    fold alter default and alter null of the same column into one operation
+    """
+    ret: List[Operation] = []
+    pending: Dict[Tuple[str, str], int] = {}
+    for operation in operations:
+        if isinstance(operation, (AlterDefault, AlterNull)) and operation.transactional:
+            key = operation.column_key
+            position = pending.pop(key, None)
+            if position is not None and type(ret[position]) is not type(operation):
+                other = ret[position]
+                folded = AlterDefaultNull(
+                    operation.model,
+                    operation.field_describe,
+                    requires=other.requires | operation.requires,
+                )
+                folded.algorithm = (other if isinstance(other, AlterNull) else operation).algorithm
+                ret[position] = folded
+                continue
+            pending[key] = len(ret)
+        ret.append(operation)
+    return ret
+
+
+def _batch_rebuilds(operations: List[Operation]) -> List[Operation]:
+    """
+    merge changes of columns of one table into one rebuild of the table, where the first change is
+    """
+    ret: List[Operation] = []
+    rebuilds: Dict[str, RebuildTable] = {}
+    for operation in operations:
+        if not isinstance(operation, AlterColumn):
+            ret.append(operation)
+            continue
+        db_table, db_column = operation.column_key
+        rebuild = rebuilds.get(db_table)
+        if rebuild is None:
+            rebuild = rebuilds[db_table] = RebuildTable(operation.model)
+            ret.append(rebuild)
+        rebuild.field_describes[db_column] = operation.field_describe
+        rebuild.requires |= operation.requires
+    return ret
+
+
+def _set_not_null_online(operation: AlterNull, ddl: BaseDDL) -> List[Operation]:
+    """
+    add a NOT VALID check of the column in the migration transaction, then after it validate the
+    check, set not null which skips the table scan because of the valid check, and drop the check
+    """
+    db_table, db_column = operation.column_key
+    check = constraint_resource(db_table, ddl.get_not_null_check_name(operation.model, db_column))
+    operation.transactional = False
+    operation.requires.add(check)
+    drop_check = DropConstraint(operation.model, check[2], requires=[check], removes=[check])
+    drop_check.transactional = False
+    # validating and setting not null require the same objects, so they keep this order
+    return [
+        AddNotNullCheck(
+            operation.model,
+            db_column,
+            check[2],
+            requires=[column_resource(db_table, db_column)],
+            provides=[check],
+        ),
+        ValidateConstraint(operation.model, check[2], requires=[check]),
+        operation,
+        drop_check,
+    ]
+
+
+def make_online(
+    operations: List[Operation], ddl: BaseDDL, db_version: Optional[str] = None
+) -> List[Operation]:
+    """
+    change operations so writes to the table are not blocked if the dialect supports it, indexes
+    are built and dropped concurrently, foreign keys and not null are checked by NOT VALID
+    constraints validated after the migration transaction, or alterations get the best online
+    algorithm and fail instead of locking the table, objects of tables created, renamed or dropped
+    by the same migration are left as is
+    :param operations: operations not rendered yet
+    :param ddl:
+    :param db_version: server version
+    :return:
+    """
+    tables = {
+        resource
+        for operation in operations
+        if not isinstance(operation, (AddIndex, AddFk, AlterNull))
+        for resource in (*operation.provides, *operation.removes)
+        if resource[0] == "table"
+    }
+    ret: List[Operation] = []
+    for operation in operations:
+        model = getattr(operation, "model", None)
+        if model is None or table_resource(model._meta.db_table) in tables:
+            ret.append(operation)
+            continue
+        if (
+            type(operation) is AlterNull
+            and not operation.field_describe.get("nullable")
+            and ddl.NOT_VALID_CONSTRAINT
+        ):
+            ret.extend(_set_not_null_online(operation, ddl))
+            continue
+        ret.append(operation)
+        if isinstance(operation, AddIndex) and ddl.CONCURRENT_INDEX:
+            operation.concurrently = True
+        elif type(operation) is AddFk and ddl.NOT_VALID_CONSTRAINT:
+            operation.not_valid = True
+            ret.extend(
+                ValidateConstraint(operation.model, resource[2], requires=[resource])
+                for resource in operation.provides
+                if resource[0] == "constraint"
+            )
+        # mysql rejects ADD FOREIGN KEY with ALGORITHM=INPLACE unless foreign_key_checks is off
+        elif ddl.ALGORITHM_HINTS and type(operation) is not AddFk:
+            operation.algorithm = ddl.get_algorithm(operation.instant_since, db_version)
+    return ret
+
+
+def optimize_operations(operations: List[Operation], ddl: BaseDDL) -> List[Operation]:
+    """
+    drop no-op changes, cancel add/drop pairs, fold alter default and alter null of one column,
+    batch changes of columns of one table into one rebuild if the dialect rebuilds tables, then
+    drop operations rendering the same sql as an earlier one
+    :param operations: operations in emission order
+    :param ddl:
+    :return:
+    """
+    operations = [operation for operation in operations if not operation.is_noop(ddl)]
+    operations = _fold_operations(_cancel_operations(operations))
+    if ddl.TABLE_REBUILD:
+        operations = _batch_rebuilds(operations)
+    ret: List[Operation] = []
+    rendered: Dict[str, Operation] = {}
+    for operation in operations:
+        sql = operation.render(ddl)
+        kept = rendered.get(sql)
+        if kept is None:
+            rendered[sql] = operation
+            ret.append(operation)
+        else:
+            kept.requires |= operation.requires
+            kept.provides |= operation.provides
+            kept.removes |= operation.removes
+    return ret
+
+
+def sort_operations(operations: List[Operation]) -> List[List[Operation]]:
+    """
+    order operations by their dependencies with a topological sort, an operation runs after the
+    ones creating what it requires and before the ones removing it, an object is removed before
+    it is created again
+    :param operations: operations in emission order
+    :return: layers of operations, operations of one layer are independent of each other, the
+        emission order is kept inside a layer
+    """
+    requirers, providers, removers = defaultdict(list), defaultdict(list), defaultdict(list)
+    for i, operation in enumerate(operations):
+        for resource in operation.requires:
+            requirers[resource].append(i)
+        for resource in operation.provides:
+            providers[resource].append(i)
+        for resource in operation.removes:
+            removers[resource].append(i)
+
+    successors: List[Set[int]] = [set() for _ in operations]
+    in_degree = [0] * len(operations)
+
+    def add_edge(before: int, after: int):
+        if before != after and after not in successors[before]:
+            successors[before].add(after)
+            in_degree[after] += 1
+
+    for resource, indexes in requirers.items():
+        for i in indexes:
+            for provider in providers.get(resource, ()):
+                add_edge(provider, i)
+            for remover in removers.get(resource, ()):
+                add_edge(i, remover)
+    for resource, indexes in removers.items():
+        for i in indexes:
+            for provider in providers.get(resource, ()):
+                add_edge(i, provider)
+
+    layers = []
+    current = [i for i, degree in enumerate(in_degree) if not degree]
+    visited = 0
+    while current:
+        layers.append([operations[i] for i in current])
+        visited += len(current)
+        following = []
+        for i in current:
+            for j in successors[i]:
+                in_degree[j] -= 1
+                if not in_degree[j]:
+                    following.append(j)
+        current = sorted(following)
+    if visited < len(operations):
+        # dependency cycle, keep emission order for the rest
+        layers.append([operation for i, operation in enumerate(operations) if in_degree[i] > 0])
+    return layers
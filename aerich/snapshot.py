@@ -0,0 +1,102 @@
+import json
+from hashlib import md5
+from typing import Optional
+
+from dictdiffer import diff, patch
+
+from aerich.coder import JsonEncoder, decoder, encoder
+
+# keep a full snapshot every SNAPSHOT_INTERVAL versions, store deltas against it in between
+SNAPSHOT_INTERVAL = 20
+DELTA_KEY = "delta"
+
+
+def normalize(content: dict) -> dict:
+    """
+    round trip content through the json coder, so it compares equal to the stored one
+    :param content:
+    :return:
+    """
+    return decoder(encoder(content))
+
+
+def get_fingerprint(describe: dict) -> str:
+    """
+    stable hash of a model describe, equal for the stored and the current describe of an
+    unchanged model
+    :param describe:
+    :return:
+    """
+    return md5(  # nosec: B303
+        json.dumps(describe, cls=JsonEncoder, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def is_delta(content: Optional[dict]) -> bool:
+    """
+    model names are always dotted, so a top level delta key can't collide with a full snapshot
+    :param content:
+    :return:
+    """
+    return bool(content) and DELTA_KEY in content
+
+
+def get_delta_base(content: dict) -> str:
+    return content[DELTA_KEY]["base"]
+
+
+def apply_delta(base: dict, content: dict) -> dict:
+    """
+    rebuild full snapshot from the base snapshot and stored delta
+    :param base:
+    :param content:
+    :return:
+    """
+    return patch(content[DELTA_KEY]["changes"], base)
+
+
+class SnapshotEncoder:
+    """
+    Encode models snapshots of consecutive versions for storage in the aerich table.
+    """
+
+    def __init__(
+        self,
+        base_version: Optional[str] = None,
+        base: Optional[dict] = None,
+        depth: int = 0,
+        interval: int = SNAPSHOT_INTERVAL,
+    ):
+        self.base_version = base_version
+        self.base = base
+        self.depth = depth
+        self.interval = interval
+
+    @classmethod
+    def from_last_version(cls, version: str, content: dict, base: Optional[dict] = None):
+        """
+        resume encoding after the last stored version
+        :param version: last stored version
+        :param content: stored content of last version
+        :param base: full snapshot referenced by content if it is a delta
+        :return:
+        """
+        if is_delta(content):
+            return cls(get_delta_base(content), base, content[DELTA_KEY]["depth"])
+        return cls(version, content)
+
+    def encode(self, version: str, content: dict) -> dict:
+        content = normalize(content)
+        if self.base is None or self.depth + 1 >= self.interval:
+            self.base_version = version
+            self.base = content
+            self.depth = 0
+            return content
+        self.depth += 1
+        return {
+            DELTA_KEY: {
+                "base": self.base_version,
+                "depth": self.depth,
+                "changes": list(diff(self.base, content)),
+            }
+        }
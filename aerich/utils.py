@@ -1,12 +1,23 @@
 import importlib.util
+import logging
 import os
 import re
 import sys
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Optional
 
+import tortoise
 from click import BadOptionUsage, ClickException, Context
 from tortoise import BaseDBAsyncClient, Tortoise
+from tortoise.backends.base.client import BaseTransactionWrapper, TransactionContextPooled
+from tortoise.transactions import in_transaction
+
+logger = logging.getLogger("aerich")
+# dedicated_connection and dedicated_transaction use private api of the pooled clients of
+# tortoise-orm, the pool, the transaction context acquiring a connection of it and the connection
+# and state of a transaction wrapper, known up to this version
+_POOL_INTERNALS_MAX_VERSION = (0, 21)
 
 
 def add_src_path(path: str) -> str:
@@ -51,6 +62,69 @@ def get_app_connection(config, app) -> BaseDBAsyncClient:
     return Tortoise.get_connection(get_app_connection_name(config, app))
 
 
+def _has_known_pool_internals() -> bool:
+    version = tuple(int(part) for part in re.findall(r"\d+", tortoise.__version__)[:2])
+    return version <= _POOL_INTERNALS_MAX_VERSION
+
+
+@asynccontextmanager
+async def dedicated_connection(conn: BaseDBAsyncClient) -> AsyncIterator[BaseDBAsyncClient]:
+    """
+    get a client running all queries on one connection of the pool, outside of a transaction, so
+    session settings changed on it apply to the next queries, a pooled client acquires a
+    connection for each query and resets it on release, run transactions on the client with
+    dedicated_transaction to keep them on the connection
+    :param conn: client of the app connection
+    :return:
+    """
+    if not _has_known_pool_internals():
+        logger.warning(
+            "Pool of tortoise-orm %s is unknown, session settings only apply in transactions",
+            tortoise.__version__,
+        )
+        yield conn
+        return
+    context = conn._in_transaction()
+    if not isinstance(context, TransactionContextPooled):
+        # the client has a single connection, e.g. sqlite
+        yield conn
+        return
+    await context.ensure_connection()
+    pool = conn._pool
+    client = context.connection
+    client._connection = await pool.acquire()
+    try:
+        yield client
+    finally:
+        await pool.release(client._connection)
+
+
+@asynccontextmanager
+async def dedicated_transaction(client: BaseDBAsyncClient) -> AsyncIterator[BaseDBAsyncClient]:
+    """
+    run a transaction on the connection of a client got from dedicated_connection, instead of
+    acquiring another connection of the pool
+    :param client:
+    :return: client in the transaction
+    """
+    if not isinstance(client, BaseTransactionWrapper):
+        async with in_transaction(client.connection_name) as transaction:
+            yield transaction
+        return
+    await client.start()
+    try:
+        yield client
+    except BaseException:
+        if not client._finalized:
+            await client.rollback()
+        raise
+    else:
+        await client.commit()
+    finally:
+        # the next queries of the client run outside of a transaction
+        client._finalized = False
+
+
 def get_tortoise_config(ctx: Context, tortoise_orm: str) -> dict:
     """
     get tortoise config from module
@@ -94,6 +168,99 @@ def is_default_function(string: str):
     return re.match(r"^<function.+>$", str(string or ""))
 
 
+_DOLLAR_QUOTE_PATTERN = re.compile(r"\$(?:[A-Za-z_][A-Za-z_0-9]*)?\$")
+# statements with a body of statements ended by semicolons, a trigger or a mysql procedure
+_COMPOUND_STATEMENT_PATTERN = re.compile(
+    r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:DEFINER\s*=\s*\S+\s+)?(?:TEMP(?:ORARY)?\s+)?"
+    r"(?:TRIGGER|PROCEDURE|FUNCTION|EVENT)\b",
+    re.I,
+)
+_WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z_0-9$]*")
+# END IF, END LOOP, END WHILE and END REPEAT end blocks not opened by BEGIN or CASE
+_BLOCK_END_PATTERN = re.compile(r"END(?:\s+(IF|LOOP|WHILE|REPEAT|CASE)\b)?", re.I)
+
+
+def _find_end(script: str, start: int, end: str) -> int:
+    position = script.find(end, start)
+    return len(script) if position == -1 else position + len(end) - 1
+
+
+def _is_word_start(script: str, i: int) -> bool:
+    return i == 0 or not (script[i - 1].isalnum() or script[i - 1] in "_$")
+
+
+def split_sql(script: str, dialect: str = "sql") -> List[str]:
+    """
+    split a migration script into statements, semicolons in quotes, comments, postgres dollar
+    quoted bodies and BEGIN ... END bodies of triggers, procedures and functions don't end a
+    statement
+    :param script:
+    :param dialect: mysql strings and postgres E'' strings have backslash escapes, mysql has #
+        comments, postgres has dollar quotes
+    :return: statements without the ending semicolon, comment only statements are dropped
+    """
+    ret = []
+    start = i = 0
+    # start of the statement after leading comments, None until it's found
+    code_start: Optional[int] = None
+    compound = False
+    # open BEGIN ... END and CASE ... END blocks of a compound statement
+    depth = 0
+    while i < len(script):
+        char = script[i]
+        line_comment = script.startswith("--", i) or (char == "#" and dialect == "mysql")
+        block_comment = script.startswith("/*", i)
+        if code_start is None and not (
+            char.isspace() or char == ";" or line_comment or block_comment
+        ):
+            code_start = i
+            compound = bool(_COMPOUND_STATEMENT_PATTERN.match(script, code_start))
+        word = _WORD_PATTERN.match(script, i) if _is_word_start(script, i) else None
+        if char in "'\"`":
+            # postgres E'' strings are prefixed by a standalone E
+            postgres_escapes = (
+                dialect == "postgres"
+                and char == "'"
+                and script[i - 1 : i] in ("E", "e")
+                and _is_word_start(script, i - 1)
+            )
+            escapes = char != "`" and (dialect == "mysql" or postgres_escapes)
+            i += 1
+            while i < len(script) and script[i] != char:
+                if script[i] == "\\" and escapes:
+                    i += 1
+                i += 1
+        elif line_comment:
+            i = _find_end(script, i + 1, "\n")
+        elif block_comment:
+            i = _find_end(script, i + 2, "*/")
+        elif char == "$" and dialect == "postgres" and _DOLLAR_QUOTE_PATTERN.match(script, i):
+            quote = _DOLLAR_QUOTE_PATTERN.match(script, i).group()
+            i = _find_end(script, i + len(quote), quote)
+        elif word:
+            keyword = word.group().upper()
+            i = word.end() - 1
+            if compound and keyword in ("BEGIN", "CASE"):
+                depth += 1
+            elif compound and keyword == "END" and depth:
+                block_end = _BLOCK_END_PATTERN.match(script, word.start())
+                i = block_end.end() - 1
+                if block_end.group(1) is None or block_end.group(1).upper() == "CASE":
+                    depth -= 1
+        elif char == ";":
+            if code_start is None:
+                start = i + 1
+            elif not depth:
+                ret.append(script[start:i].strip())
+                start = i + 1
+                code_start = None
+                compound = False
+        i += 1
+    if code_start is not None:
+        ret.append(script[start:].strip())
+    return ret
+
+
 def import_py_file(file: Path):
     module_name, file_ext = os.path.splitext(os.path.split(file)[-1])
     spec = importlib.util.spec_from_file_location(module_name, file)
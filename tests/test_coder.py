@@ -0,0 +1,42 @@
+import base64
+import json
+import pickle  # nosec: B403
+
+from pypika.terms import Field
+from tortoise.contrib.mysql.indexes import FullTextIndex
+from tortoise.contrib.postgres.indexes import GinIndex
+from tortoise.indexes import Index
+
+from aerich.coder import decode_binary, decoder, encode_binary, encoder
+
+
+def test_encode_index():
+    content = {
+        "indexes": [
+            Index(fields=("name", "type")),
+            FullTextIndex(fields=("body",), parser_name="ngram"),
+            GinIndex(fields=("tags",), name="tags_gin", condition={"id": 1}),
+        ]
+    }
+    encoded = encoder(content)
+    assert "val" not in json.loads(encoded)["indexes"][0]
+
+    indexes = decoder(encoded)["indexes"]
+    for old, new in zip(content["indexes"], indexes):
+        assert type(new) is type(old)
+        assert new.__dict__ == old.__dict__
+    assert decode_binary(encode_binary(content))["indexes"][2].extra == " WHERE id = 1"
+
+
+def test_encode_index_expressions():
+    index = Index(Field("name"), name="name_idx")
+    decoded = decoder(encoder({"indexes": [index]}))["indexes"][0]
+    assert decoded.expressions[0].name == "name"
+
+
+def test_decode_legacy_index():
+    index = Index(fields=("name",))
+    content = json.dumps(
+        {"indexes": [{"type": "index", "val": base64.b64encode(pickle.dumps(index)).decode()}]}
+    )
+    assert decoder(content)["indexes"][0].fields == ["name"]
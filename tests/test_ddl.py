@@ -1,7 +1,14 @@
+import pytest
+from tortoise.transactions import in_transaction
+
 from aerich.ddl.mysql import MysqlDDL
+from aerich.ddl.mysql.shadow import ShadowTable
 from aerich.ddl.postgres import PostgresDDL
 from aerich.ddl.sqlite import SqliteDDL
+from aerich.ddl.sqlite.rebuild import TableRebuild
+from aerich.exceptions import NotSupportError
 from aerich.migrate import Migrate
+from aerich.operations import AddColumn, AddFk, DropFk, make_online
 from tests.models import Category, Product, User
 
 
@@ -87,6 +94,26 @@ def test_modify_column():
         )
 
 
+def test_modify_column_binary_coercible():
+    ddl = PostgresDDL(Migrate.ddl.client)
+    field_describe = Category._meta.fields_map.get("name").describe(False)
+    old_field_describe = dict(field_describe, db_field_types={"": "VARCHAR(100)"})
+    assert (
+        ddl.modify_column(Category, field_describe, old_field_describe=old_field_describe)
+        == 'ALTER TABLE "category" ALTER COLUMN "name" TYPE VARCHAR(200)'
+    )
+    assert (
+        ddl.modify_column(Category, old_field_describe, old_field_describe=field_describe)
+        == 'ALTER TABLE "category" ALTER COLUMN "name" TYPE VARCHAR(100) USING "name"::VARCHAR(100)'
+    )
+    assert ddl.is_binary_coercible("VARCHAR(50)", "TEXT")
+    assert ddl.is_binary_coercible("TEXT", "VARCHAR")
+    assert ddl.is_binary_coercible("DECIMAL(10,2)", "NUMERIC(12, 2)")
+    assert not ddl.is_binary_coercible("DECIMAL(10,2)", "DECIMAL(12,3)")
+    assert not ddl.is_binary_coercible("INT", "BIGINT")
+    assert not ddl.is_binary_coercible("TEXT", "VARCHAR(50)")
+
+
 def test_alter_column_default():
     if isinstance(Migrate.ddl, SqliteDDL):
         return
@@ -178,6 +205,23 @@ def test_drop_index():
         assert ret_u == 'ALTER TABLE "category" DROP INDEX "uid_category_name_8b0cb9"'
 
 
+def test_index_concurrently():
+    ddl = PostgresDDL(Migrate.ddl.client)
+    index = ddl.add_index_concurrently(Category, ["name"], True)
+    assert (
+        index == 'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "uid_category_name_8b0cb9" ON '
+        '"category" ("name")'
+    )
+    assert ddl.get_concurrent_index_name(index) == "uid_category_name_8b0cb9"
+    assert (
+        ddl.drop_index_concurrently(Category, ["name"])
+        == 'DROP INDEX CONCURRENTLY IF EXISTS "idx_category_name_8b0cb9"'
+    )
+    assert Migrate.ddl.get_concurrent_index_name(index) == (
+        "uid_category_name_8b0cb9" if isinstance(Migrate.ddl, PostgresDDL) else None
+    )
+
+
 def test_add_fk():
     ret = Migrate.ddl.add_fk(
         Category, Category._meta.fields_map.get("user").describe(False), User.describe(False)
@@ -204,3 +248,291 @@ def test_drop_fk():
         assert ret == 'ALTER TABLE "category" DROP CONSTRAINT "fk_category_user_e2e3874c"'
     else:
         assert ret == 'ALTER TABLE "category" DROP FOREIGN KEY "fk_category_user_e2e3874c"'
+
+
+def test_get_algorithm_fallback():
+    ddl = MysqlDDL(Migrate.ddl.client)
+    sql = "ALTER TABLE `product` ADD `sort` INT NOT NULL"
+    rejected = Exception(
+        "ALGORITHM=INSTANT is not supported for this operation. Try ALGORITHM=COPY/INPLACE."
+    )
+    assert ddl.get_algorithm(AddColumn.instant_since, "8.0.30") == "INSTANT"
+    assert ddl.get_algorithm(AddColumn.instant_since, "5.7.40-log") == "INPLACE"
+    assert ddl.get_algorithm(AddColumn.instant_since, None) == "INPLACE"
+    instant = ddl.add_algorithm("product", sql, "INSTANT")
+    inplace = ddl.get_algorithm_fallback(instant, rejected, "inplace")
+    assert inplace == f"{sql}, ALGORITHM=INPLACE, LOCK=NONE"
+    assert ddl.get_algorithm_fallback(inplace, rejected, "inplace") is None
+    assert ddl.get_algorithm_fallback(inplace, rejected, "copy") == sql
+    assert ddl.get_algorithm_fallback(instant, rejected, "none") is None
+    assert ddl.get_algorithm_fallback(instant, Exception("Duplicate column name"), "copy") is None
+
+
+def test_add_fk_online():
+    ddl = MysqlDDL(Migrate.ddl.client)
+    field_describe = Category._meta.fields_map.get("user").describe(False)
+    add_fk, drop_fk = (
+        operation(Category, field_describe, User.describe(False)) for operation in (AddFk, DropFk)
+    )
+    make_online([add_fk, drop_fk], ddl, "8.0.30")
+    # INPLACE needs foreign_key_checks off for ADD FOREIGN KEY, it gets no hint
+    assert add_fk.render(ddl) == (
+        "ALTER TABLE `category` ADD CONSTRAINT `fk_category_user_e2e3874c` FOREIGN KEY "
+        "(`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE"
+    )
+    assert drop_fk.render(ddl) == (
+        "ALTER TABLE `category` DROP FOREIGN KEY `fk_category_user_e2e3874c`, "
+        "ALGORITHM=INPLACE, LOCK=NONE"
+    )
+
+
+async def test_shadow_table_copy_rows(mocker):
+    class Connection:
+        def __init__(self):
+            self.pks = [1, 2, 3, 4, 5]
+            self.copied = []
+
+        async def execute_query_dict(self, query, values=None):
+            pks = [pk for pk in self.pks if not values or pk > values[0]]
+            offset = int(query.rsplit("OFFSET ", 1)[1])
+            return [{"pk": pks[offset]}] if offset < len(pks) else []
+
+        async def execute_query(self, query, values=None):
+            self.copied.append(values)
+
+    sleep = mocker.patch("asyncio.sleep")
+    conn = Connection()
+    shadow = ShadowTable(conn, "product", "ADD `tag` INT", chunk_size=2, chunk_sleep=0.5)
+    await shadow._copy_rows("id", {"id": "id"})
+    # chunks of 2 rows, with a sleep between them
+    assert conn.copied == [[2], [2, 4], [4]]
+    assert [call.args for call in sleep.call_args_list] == [(0.5,), (0.5,)]
+
+
+def test_shadow_table():
+    ddl = MysqlDDL(Migrate.ddl.client)
+    table_name, alter_clauses = ddl.parse_alter_table(
+        "ALTER TABLE `product` MODIFY COLUMN `name` VARCHAR(100) NOT NULL, "
+        "RENAME COLUMN `image` TO `pic`"
+    )
+    shadow = ShadowTable(Migrate.ddl.client, table_name, alter_clauses)
+    columns = {"id": "id", "name": "name", "image": "pic"}
+
+    assert shadow.get_renamed_columns() == {"image": "pic"}
+    assert shadow.get_trigger_sql("id", columns) == [
+        "CREATE TRIGGER `_product_ins` AFTER INSERT ON `product` FOR EACH ROW BEGIN "
+        "DELETE FROM `_product_new` WHERE `id` = NEW.`id`; "
+        "INSERT IGNORE INTO `_product_new` (`id`, `name`, `pic`) "
+        "VALUES (NEW.`id`, NEW.`name`, NEW.`image`); END",
+        "CREATE TRIGGER `_product_upd` AFTER UPDATE ON `product` FOR EACH ROW BEGIN "
+        "DELETE FROM `_product_new` WHERE `id` IN (OLD.`id`, NEW.`id`); "
+        "INSERT IGNORE INTO `_product_new` (`id`, `name`, `pic`) "
+        "VALUES (NEW.`id`, NEW.`name`, NEW.`image`); END",
+        "CREATE TRIGGER `_product_del` AFTER DELETE ON `product` FOR EACH ROW "
+        "DELETE FROM `_product_new` WHERE `id` = OLD.`id`",
+    ]
+    assert shadow.get_copy_sql("id", columns, lower=True, upper=True) == (
+        "INSERT IGNORE INTO `_product_new` (`id`, `name`, `pic`) "
+        "SELECT `id`, `name`, `image` FROM `product` WHERE `id` > %s AND `id` <= %s "
+        "LOCK IN SHARE MODE"
+    )
+    assert shadow.get_swap_sql() == (
+        "RENAME TABLE `product` TO `_product_old`, `_product_new` TO `product`"
+    )
+    assert ddl.parse_alter_table("ALTER TABLE `product` RENAME TO `products`") is None
+
+
+def test_rebuild_table():
+    ddl = SqliteDDL(Migrate.ddl.client)
+    sql = ddl.rebuild_table(
+        Category,
+        [
+            Category._meta.fields_map.get("name").describe(False),
+            Category._meta.fields_map.get("slug").describe(False),
+        ],
+    )
+    assert sql == (
+        'ALTER TABLE "category" MODIFY COLUMN "name" VARCHAR(200), '
+        'MODIFY COLUMN "slug" VARCHAR(100) NOT NULL'
+    )
+    table_name, columns = ddl.parse_rebuild_table(sql)
+    assert table_name == "category"
+    assert columns == {"name": '"name" VARCHAR(200)', "slug": '"slug" VARCHAR(100) NOT NULL'}
+    assert ddl.parse_rebuild_table('ALTER TABLE "category" ADD "name" VARCHAR(200)') is None
+
+    rebuild = TableRebuild(
+        Migrate.ddl.client,
+        "category",
+        {"name": "\"name\" VARCHAR(100) NOT NULL DEFAULT 'a, b'", "user_id": '"user_id" INT'},
+    )
+    assert rebuild.get_create_table_sql(
+        'CREATE TABLE "category" (\n'
+        '    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\n'
+        '    "name" VARCHAR(200) /* Name, first */,\n'
+        '    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE /* User */,\n'
+        '    CONSTRAINT "uid_category_name_8b0cb9" UNIQUE ("name", "user_id")\n'
+        ")"
+    ) == (
+        'CREATE TABLE "_category_new" (\n'
+        '    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\n'
+        "    \"name\" VARCHAR(100) NOT NULL DEFAULT 'a, b',\n"
+        '    "user_id" INT REFERENCES "user" ("id") ON DELETE CASCADE,\n'
+        '    CONSTRAINT "uid_category_name_8b0cb9" UNIQUE ("name", "user_id")\n'
+        ")",
+        ["id", "name", "user_id"],
+    )
+
+    # only the constraints are kept from the old definition, not its default
+    rebuild = TableRebuild(
+        Migrate.ddl.client, "tag", {"name": "\"name\" VARCHAR(50) NOT NULL DEFAULT 'y'"}
+    )
+    create_table_sql = (
+        'CREATE TABLE "_tag_new" (\n    "name" VARCHAR(50) NOT NULL DEFAULT \'y\' UNIQUE\n)'
+    )
+    assert rebuild.get_create_table_sql(
+        'CREATE TABLE "tag" (\n'
+        "    \"name\" VARCHAR(50) NOT NULL UNIQUE DEFAULT 'x' /* Name */\n"
+        ")"
+    ) == (create_table_sql, ["name"])
+    # rebuilding the table again doesn't add clauses
+    assert rebuild.get_create_table_sql(create_table_sql.replace("_tag_new", "tag"))[0] == (
+        create_table_sql
+    )
+    rebuild = TableRebuild(Migrate.ddl.client, "tag", {"parent_id": '"parent_id" INT'})
+    assert rebuild.get_create_table_sql(
+        'CREATE TABLE "tag" (\n'
+        '    "parent_id" INT NOT NULL DEFAULT 1 CONSTRAINT "fk_tag" REFERENCES "tag" ("id") '
+        "ON DELETE SET NULL NOT DEFERRABLE COLLATE NOCASE\n"
+        ")"
+    )[0] == (
+        'CREATE TABLE "_tag_new" (\n'
+        '    "parent_id" INT CONSTRAINT "fk_tag" REFERENCES "tag" ("id") ON DELETE SET NULL '
+        "NOT DEFERRABLE\n"
+        ")"
+    )
+
+
+async def test_table_rebuild_run():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    conn = Migrate.ddl.client
+    await conn.execute_script(
+        'CREATE TABLE "rebuild_parent" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL);\n'
+        'CREATE TABLE "rebuild_child" (\n'
+        '    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\n'
+        '    "name" VARCHAR(10) NOT NULL,\n'
+        '    "parent_id" INT NOT NULL REFERENCES "rebuild_parent" ("id") ON DELETE CASCADE\n'
+        ");\n"
+        'CREATE INDEX "idx_rebuild_child_name" ON "rebuild_child" ("name");\n'
+        'INSERT INTO "rebuild_parent" ("id") VALUES (1);\n'
+        'INSERT INTO "rebuild_child" ("name", "parent_id") VALUES (\'a\', 1), (\'b\', 1)'
+    )
+    assert await Migrate.ddl.disable_foreign_keys(conn)
+    try:
+        async with in_transaction("default") as transaction:
+            await TableRebuild(transaction, "rebuild_parent", {"id": '"id" INTEGER NOT NULL'}).run()
+            await TableRebuild(transaction, "rebuild_child", {"name": '"name" VARCHAR(20)'}).run()
+    finally:
+        await Migrate.ddl.enable_foreign_keys(conn)
+
+    # rows referencing the rebuilt parent are kept
+    assert await conn.execute_query_dict(
+        'SELECT "name", "parent_id" FROM "rebuild_child" ORDER BY "id"'
+    ) == [{"name": "a", "parent_id": 1}, {"name": "b", "parent_id": 1}]
+    schema = await conn.execute_query_dict(
+        "SELECT name, sql FROM sqlite_master WHERE tbl_name = 'rebuild_child' ORDER BY type"
+    )
+    assert schema == [
+        {
+            "name": "idx_rebuild_child_name",
+            "sql": 'CREATE INDEX "idx_rebuild_child_name" ON "rebuild_child" ("name")',
+        },
+        {
+            "name": "rebuild_child",
+            "sql": 'CREATE TABLE "rebuild_child" (\n'
+            '    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\n'
+            '    "name" VARCHAR(20),\n'
+            '    "parent_id" INT NOT NULL REFERENCES "rebuild_parent" ("id") ON DELETE CASCADE\n'
+            ")",
+        },
+    ]
+    await conn.execute_script('DROP TABLE "rebuild_child"; DROP TABLE "rebuild_parent"')
+
+
+async def test_tune_for_migration():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    conn = Migrate.ddl.client
+    _, rows = await conn.execute_query("PRAGMA cache_size")
+    cache_size = rows[0][0]
+
+    settings = await Migrate.ddl.tune_for_migration(conn)
+    assert set(settings) == {"journal_mode", "cache_size", "temp_store", "synchronous"}
+    _, rows = await conn.execute_query("PRAGMA cache_size")
+    assert rows[0][0] == -131072
+
+    await Migrate.ddl.restore_tuning(conn, settings)
+    _, rows = await conn.execute_query("PRAGMA cache_size")
+    assert rows[0][0] == cache_size
+
+
+def test_get_migration_settings():
+    if isinstance(Migrate.ddl, PostgresDDL):
+        assert Migrate.ddl.get_migration_settings(1.5, 60, {"maintenance_work_mem": "1GB"}) == {
+            "lock_timeout": "1500ms",
+            "statement_timeout": "60000ms",
+            "maintenance_work_mem": "1GB",
+        }
+    elif isinstance(Migrate.ddl, MysqlDDL):
+        assert Migrate.ddl.get_migration_settings(0.5) == {"lock_wait_timeout": 1}
+        with pytest.raises(NotSupportError):
+            Migrate.ddl.get_migration_settings(statement_timeout=60)
+    else:
+        assert Migrate.ddl.get_migration_settings(2) == {"busy_timeout": 2000}
+        with pytest.raises(NotSupportError):
+            Migrate.ddl.get_migration_settings(statement_timeout=60)
+    with pytest.raises(NotSupportError):
+        Migrate.ddl.get_migration_settings(session_settings={"a = 1; b": 1})
+
+
+def test_get_row_count():
+    ddl = PostgresDDL(Migrate.ddl.client)
+    assert ddl.get_row_count('UPDATE "product" SET "sort" = 1', 42) == 42
+    assert ddl.get_row_count('INSERT INTO "tag" SELECT "id" FROM "product" RETURNING "id"', 3) == 3
+    assert ddl.get_row_count('SELECT "id" FROM "product"', 3) == 3
+    # asyncpg counts the rows returned by other statements, there are none
+    assert ddl.get_row_count('INSERT INTO "tag" SELECT "id" FROM "product"', 0) is None
+    assert ddl.get_row_count('ALTER TABLE "product" ADD "sort" INT', 0) is None
+    assert MysqlDDL(Migrate.ddl.client).get_row_count("ALTER TABLE `product` DROP `sort`", 0) == 0
+
+
+async def test_set_local_session_settings():
+    class Connection:
+        def __init__(self):
+            self.queries = []
+
+        async def execute_query_dict(self, query, values=None):
+            return [{"value": "5s"}]
+
+        async def execute_query(self, query, values=None):
+            self.queries.append((query, values))
+
+    ddl = PostgresDDL(Migrate.ddl.client)
+    conn = Connection()
+    previous = await ddl.set_session_settings(conn, {"lock_timeout": "2s"}, local=True)
+    # SET LOCAL values are returned too, versions sharing the transaction restore them
+    assert previous == {"lock_timeout": "5s"}
+    assert conn.queries == [("SELECT set_config($1, $2, $3)", ["lock_timeout", "2s", True])]
+
+
+async def test_set_session_settings():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    conn = Migrate.ddl.client
+    previous = await Migrate.ddl.set_session_settings(conn, {"busy_timeout": 2000})
+    _, rows = await conn.execute_query("PRAGMA busy_timeout")
+    assert rows[0][0] == 2000
+
+    await Migrate.ddl.set_session_settings(conn, previous)
+    _, rows = await conn.execute_query("PRAGMA busy_timeout")
+    assert rows[0][0] == previous["busy_timeout"]
@@ -1,15 +1,26 @@
+import asyncio
+import sqlite3
 import tempfile
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 from pytest_mock import MockerFixture
+from tortoise import Tortoise
+from tortoise.backends.sqlite import SqliteClient
+from tortoise.exceptions import OperationalError
 
+from aerich import Command
+from aerich.checkpoint import Checkpoint
 from aerich.ddl.mysql import MysqlDDL
+from aerich.ddl.mysql.shadow import ShadowTable
 from aerich.ddl.postgres import PostgresDDL
 from aerich.ddl.sqlite import SqliteDDL
-from aerich.exceptions import NotSupportError
-from aerich.migrate import MIGRATE_TEMPLATE, Migrate
+from aerich.migrate import MIGRATE_TEMPLATE, Migrate, Migrator
+from aerich.models import Aerich
+from aerich.snapshot import SnapshotEncoder
 from aerich.utils import get_models_describe
+from tests.models import Email
 
 old_models_describe = {
     "models.Category": {
@@ -796,13 +807,7 @@ def test_migrate(mocker: MockerFixture):
 
     models_describe = get_models_describe("models")
     Migrate.app = "models"
-    if isinstance(Migrate.ddl, SqliteDDL):
-        with pytest.raises(NotSupportError):
-            Migrate.diff_models(old_models_describe, models_describe)
-            Migrate.diff_models(models_describe, old_models_describe, False)
-    else:
-        Migrate.diff_models(old_models_describe, models_describe)
-        Migrate.diff_models(models_describe, old_models_describe, False)
+    Migrate.diff_models(old_models_describe, models_describe)
     Migrate._merge_operators()
     if isinstance(Migrate.ddl, MysqlDDL):
         expected_upgrade_operators = {
@@ -821,21 +826,12 @@ def test_migrate(mocker: MockerFixture):
             "ALTER TABLE `email` ADD INDEX `idx_email_email_4a1a33` (`email`)",
             "ALTER TABLE `product` ADD UNIQUE INDEX `uid_product_name_869427` (`name`, `type_db_alias`)",
             "ALTER TABLE `product` ALTER COLUMN `view_num` SET DEFAULT 0",
-            "ALTER TABLE `product` MODIFY COLUMN `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6)",
-            "ALTER TABLE `product` MODIFY COLUMN `is_reviewed` BOOL NOT NULL  COMMENT 'Is Reviewed'",
             "ALTER TABLE `user` DROP COLUMN `avatar`",
             "ALTER TABLE `user` MODIFY COLUMN `password` VARCHAR(100) NOT NULL",
-            "ALTER TABLE `user` MODIFY COLUMN `intro` LONGTEXT NOT NULL",
-            "ALTER TABLE `user` MODIFY COLUMN `last_login` DATETIME(6) NOT NULL  COMMENT 'Last Login'",
-            "ALTER TABLE `user` MODIFY COLUMN `is_active` BOOL NOT NULL  COMMENT 'Is Active' DEFAULT 1",
-            "ALTER TABLE `user` MODIFY COLUMN `is_superuser` BOOL NOT NULL  COMMENT 'Is SuperUser' DEFAULT 0",
             "ALTER TABLE `user` MODIFY COLUMN `longitude` DECIMAL(10,8) NOT NULL",
             "ALTER TABLE `user` ADD UNIQUE INDEX `uid_user_usernam_9987ab` (`username`)",
             "CREATE TABLE `email_user` (\n    `email_id` INT NOT NULL REFERENCES `email` (`email_id`) ON DELETE CASCADE,\n    `user_id` INT NOT NULL REFERENCES `user` (`id`) ON DELETE CASCADE\n) CHARACTER SET utf8mb4",
             "CREATE TABLE IF NOT EXISTS `newmodel` (\n    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,\n    `name` VARCHAR(50) NOT NULL\n) CHARACTER SET utf8mb4",
-            "ALTER TABLE `category` MODIFY COLUMN `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6)",
-            "ALTER TABLE `product` MODIFY COLUMN `body` LONGTEXT NOT NULL",
-            "ALTER TABLE `email` MODIFY COLUMN `is_primary` BOOL NOT NULL  DEFAULT 0",
         }
         expected_downgrade_operators = {
             "ALTER TABLE `category` MODIFY COLUMN `name` VARCHAR(200) NOT NULL",
@@ -853,21 +849,12 @@ def test_migrate(mocker: MockerFixture):
             "ALTER TABLE `product` DROP INDEX `uid_product_name_869427`",
             "ALTER TABLE `product` ALTER COLUMN `view_num` DROP DEFAULT",
             "ALTER TABLE `user` ADD `avatar` VARCHAR(200) NOT NULL  DEFAULT ''",
-            "ALTER TABLE `user` DROP INDEX `idx_user_usernam_9987ab`",
+            "ALTER TABLE `user` DROP INDEX `uid_user_usernam_9987ab`",
             "ALTER TABLE `user` MODIFY COLUMN `password` VARCHAR(200) NOT NULL",
             "DROP TABLE IF EXISTS `email_user`",
             "DROP TABLE IF EXISTS `newmodel`",
-            "ALTER TABLE `user` MODIFY COLUMN `intro` LONGTEXT NOT NULL",
             "ALTER TABLE `config` MODIFY COLUMN `value` TEXT NOT NULL",
-            "ALTER TABLE `category` MODIFY COLUMN `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6)",
-            "ALTER TABLE `product` MODIFY COLUMN `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6)",
-            "ALTER TABLE `product` MODIFY COLUMN `is_reviewed` BOOL NOT NULL  COMMENT 'Is Reviewed'",
-            "ALTER TABLE `user` MODIFY COLUMN `last_login` DATETIME(6) NOT NULL  COMMENT 'Last Login'",
-            "ALTER TABLE `user` MODIFY COLUMN `is_active` BOOL NOT NULL  COMMENT 'Is Active' DEFAULT 1",
-            "ALTER TABLE `user` MODIFY COLUMN `is_superuser` BOOL NOT NULL  COMMENT 'Is SuperUser' DEFAULT 0",
             "ALTER TABLE `user` MODIFY COLUMN `longitude` DECIMAL(12,9) NOT NULL",
-            "ALTER TABLE `product` MODIFY COLUMN `body` LONGTEXT NOT NULL",
-            "ALTER TABLE `email` MODIFY COLUMN `is_primary` BOOL NOT NULL  DEFAULT 0",
         }
         assert not set(Migrate.upgrade_operators).symmetric_difference(expected_upgrade_operators)
 
@@ -879,27 +866,17 @@ def test_migrate(mocker: MockerFixture):
         expected_upgrade_operators = {
             'ALTER TABLE "category" ALTER COLUMN "name" DROP NOT NULL',
             'ALTER TABLE "category" ALTER COLUMN "slug" TYPE VARCHAR(100) USING "slug"::VARCHAR(100)',
-            'ALTER TABLE "category" ALTER COLUMN "created_at" TYPE TIMESTAMPTZ USING "created_at"::TIMESTAMPTZ',
             'ALTER TABLE "config" ADD "user_id" INT NOT NULL',
             'ALTER TABLE "config" ADD CONSTRAINT "fk_config_user_17daa970" FOREIGN KEY ("user_id") REFERENCES "user" ("id") ON DELETE CASCADE',
             'ALTER TABLE "config" ALTER COLUMN "status" DROP DEFAULT',
-            'ALTER TABLE "config" ALTER COLUMN "value" TYPE JSONB USING "value"::JSONB',
             'ALTER TABLE "configs" RENAME TO "config"',
             'ALTER TABLE "email" ADD "address" VARCHAR(200) NOT NULL',
             'ALTER TABLE "email" DROP COLUMN "user_id"',
             'ALTER TABLE "email" RENAME COLUMN "id" TO "email_id"',
-            'ALTER TABLE "email" ALTER COLUMN "is_primary" TYPE BOOL USING "is_primary"::BOOL',
             'ALTER TABLE "product" ALTER COLUMN "view_num" SET DEFAULT 0',
             'ALTER TABLE "product" RENAME COLUMN "image" TO "pic"',
-            'ALTER TABLE "product" ALTER COLUMN "is_reviewed" TYPE BOOL USING "is_reviewed"::BOOL',
-            'ALTER TABLE "product" ALTER COLUMN "body" TYPE TEXT USING "body"::TEXT',
-            'ALTER TABLE "product" ALTER COLUMN "created_at" TYPE TIMESTAMPTZ USING "created_at"::TIMESTAMPTZ',
             'ALTER TABLE "user" ALTER COLUMN "password" TYPE VARCHAR(100) USING "password"::VARCHAR(100)',
             'ALTER TABLE "user" DROP COLUMN "avatar"',
-            'ALTER TABLE "user" ALTER COLUMN "is_superuser" TYPE BOOL USING "is_superuser"::BOOL',
-            'ALTER TABLE "user" ALTER COLUMN "last_login" TYPE TIMESTAMPTZ USING "last_login"::TIMESTAMPTZ',
-            'ALTER TABLE "user" ALTER COLUMN "intro" TYPE TEXT USING "intro"::TEXT',
-            'ALTER TABLE "user" ALTER COLUMN "is_active" TYPE BOOL USING "is_active"::BOOL',
             'ALTER TABLE "user" ALTER COLUMN "longitude" TYPE DECIMAL(10,8) USING "longitude"::DECIMAL(10,8)',
             'CREATE INDEX "idx_product_name_869427" ON "product" ("name", "type_db_alias")',
             'CREATE INDEX "idx_email_email_4a1a33" ON "email" ("email")',
@@ -910,32 +887,22 @@ def test_migrate(mocker: MockerFixture):
         }
         expected_downgrade_operators = {
             'ALTER TABLE "category" ALTER COLUMN "name" SET NOT NULL',
-            'ALTER TABLE "category" ALTER COLUMN "slug" TYPE VARCHAR(200) USING "slug"::VARCHAR(200)',
-            'ALTER TABLE "category" ALTER COLUMN "created_at" TYPE TIMESTAMPTZ USING "created_at"::TIMESTAMPTZ',
+            'ALTER TABLE "category" ALTER COLUMN "slug" TYPE VARCHAR(200)',
             'ALTER TABLE "config" ALTER COLUMN "status" SET DEFAULT 1',
             'ALTER TABLE "config" DROP COLUMN "user_id"',
             'ALTER TABLE "config" DROP CONSTRAINT "fk_config_user_17daa970"',
             'ALTER TABLE "config" RENAME TO "configs"',
-            'ALTER TABLE "config" ALTER COLUMN "value" TYPE JSONB USING "value"::JSONB',
             'ALTER TABLE "email" ADD "user_id" INT NOT NULL',
             'ALTER TABLE "email" DROP COLUMN "address"',
             'ALTER TABLE "email" RENAME COLUMN "email_id" TO "id"',
-            'ALTER TABLE "email" ALTER COLUMN "is_primary" TYPE BOOL USING "is_primary"::BOOL',
             'ALTER TABLE "product" ALTER COLUMN "view_num" DROP DEFAULT',
             'ALTER TABLE "product" RENAME COLUMN "pic" TO "image"',
             'ALTER TABLE "user" ADD "avatar" VARCHAR(200) NOT NULL  DEFAULT \'\'',
-            'ALTER TABLE "user" ALTER COLUMN "password" TYPE VARCHAR(200) USING "password"::VARCHAR(200)',
-            'ALTER TABLE "user" ALTER COLUMN "last_login" TYPE TIMESTAMPTZ USING "last_login"::TIMESTAMPTZ',
-            'ALTER TABLE "user" ALTER COLUMN "is_superuser" TYPE BOOL USING "is_superuser"::BOOL',
-            'ALTER TABLE "user" ALTER COLUMN "is_active" TYPE BOOL USING "is_active"::BOOL',
-            'ALTER TABLE "user" ALTER COLUMN "intro" TYPE TEXT USING "intro"::TEXT',
+            'ALTER TABLE "user" ALTER COLUMN "password" TYPE VARCHAR(200)',
             'ALTER TABLE "user" ALTER COLUMN "longitude" TYPE DECIMAL(12,9) USING "longitude"::DECIMAL(12,9)',
-            'ALTER TABLE "product" ALTER COLUMN "created_at" TYPE TIMESTAMPTZ USING "created_at"::TIMESTAMPTZ',
-            'ALTER TABLE "product" ALTER COLUMN "is_reviewed" TYPE BOOL USING "is_reviewed"::BOOL',
-            'ALTER TABLE "product" ALTER COLUMN "body" TYPE TEXT USING "body"::TEXT',
             'DROP INDEX "idx_product_name_869427"',
             'DROP INDEX "idx_email_email_4a1a33"',
-            'DROP INDEX "idx_user_usernam_9987ab"',
+            'DROP INDEX "uid_user_usernam_9987ab"',
             'DROP INDEX "uid_product_name_869427"',
             'DROP TABLE IF EXISTS "email_user"',
             'DROP TABLE IF EXISTS "newmodel"',
@@ -946,8 +913,26 @@ def test_migrate(mocker: MockerFixture):
         )
 
     elif isinstance(Migrate.ddl, SqliteDDL):
-        assert Migrate.upgrade_operators == []
-        assert Migrate.downgrade_operators == []
+        # changes of columns of one table are batched into one rebuild
+        expected_upgrade_rebuilds = {
+            'ALTER TABLE "category" MODIFY COLUMN "slug" VARCHAR(100) NOT NULL, MODIFY COLUMN "name" VARCHAR(200)',
+            'ALTER TABLE "config" MODIFY COLUMN "value" JSON NOT NULL, MODIFY COLUMN "status" SMALLINT NOT NULL  /* on: 1\\noff: 0 */',
+            'ALTER TABLE "product" MODIFY COLUMN "view_num" INT NOT NULL  DEFAULT 0 /* View Num */',
+            'ALTER TABLE "user" MODIFY COLUMN "password" VARCHAR(100) NOT NULL',
+        }
+        expected_downgrade_rebuilds = {
+            'ALTER TABLE "category" MODIFY COLUMN "slug" VARCHAR(200) NOT NULL, MODIFY COLUMN "name" VARCHAR(200) NOT NULL',
+            'ALTER TABLE "config" MODIFY COLUMN "value" TEXT NOT NULL, MODIFY COLUMN "status" SMALLINT NOT NULL  DEFAULT 1 /* on: 1\\noff: 0 */',
+            'ALTER TABLE "product" MODIFY COLUMN "view_num" INT NOT NULL  /* View Num */',
+            'ALTER TABLE "user" MODIFY COLUMN "password" VARCHAR(200) NOT NULL',
+        }
+        for operators, expected_rebuilds in (
+            (Migrate.upgrade_operators, expected_upgrade_rebuilds),
+            (Migrate.downgrade_operators, expected_downgrade_rebuilds),
+        ):
+            assert {
+                operator for operator in operators if "MODIFY COLUMN" in operator
+            } == expected_rebuilds
 
 
 def test_sort_all_version_files(mocker):
@@ -982,3 +967,544 @@ async def test_empty_migration(mocker) -> None:
 
         with open(Path(temp_dir, migration_file), "r") as f:
             assert f.read() == expected_content
+
+
+async def test_get_applied_versions():
+    Migrate.app = "models"
+    versions = ["0_20230101000000_init.py", "1_20230102000000_update.py"]
+    for version in versions:
+        await Aerich.create(version=version, app="models", content={})
+    await Aerich.create(version="0_20230101000000_init.py", app="other", content={})
+    try:
+        assert await Migrate.get_applied_versions() == set(versions)
+    finally:
+        await Aerich.all().delete()
+
+
+async def test_get_last_version_without_content():
+    Migrate.app = "models"
+    await Aerich.create(version="0_20230101000000_init.py", app="models", content={"a": 1})
+    await Aerich.create(version="1_20230102000000_update.py", app="models", content={"b": 2})
+    try:
+        last_version = await Migrate.get_last_version(with_content=False)
+        assert last_version.version == "1_20230102000000_update.py"
+        assert "content" not in last_version.__dict__
+        assert await Migrate.get_last_version_content() == {"b": 2}
+    finally:
+        await Aerich.all().delete()
+
+
+async def test_upgrade_nothing_pending(mocker: MockerFixture):
+    command = Command({})
+    mocker.patch.object(command.migrator, "get_applied_versions", return_value={"0_init.py"})
+    mocker.patch.object(command.migrator, "get_all_version_files", return_value=["0_init.py"])
+    get_snapshot_encoder = mocker.patch.object(command.migrator, "get_snapshot_encoder")
+    assert await command.upgrade() == []
+    # no snapshot is decoded when every version is applied
+    get_snapshot_encoder.assert_not_called()
+
+
+async def test_execute_script_timings():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({}, slow_statement_seconds=0)
+    command.migrator.ddl = Migrate.ddl
+    await command._execute_script(
+        Tortoise.get_connection("default"),
+        'CREATE TABLE "timing" ("id" INT NOT NULL);\n'
+        "-- two rows;\n"
+        'INSERT INTO "timing" VALUES (1), (2);\n'
+        'DROP TABLE "timing";',
+        version="1_20230101000000_update.py",
+    )
+
+    assert [(timing.sql, timing.rows) for timing in command.statement_timings] == [
+        ('CREATE TABLE "timing" ("id" INT NOT NULL)', 0),
+        ('-- two rows;\nINSERT INTO "timing" VALUES (1), (2)', 2),
+        ('DROP TABLE "timing"', 0),
+    ]
+    assert {timing.version for timing in command.statement_timings} == {
+        "1_20230101000000_update.py"
+    }
+    assert command.slow_statements == command.statement_timings
+
+
+async def test_execute_script_checkpoint():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    conn = Tortoise.get_connection("default")
+    command = Command({})
+    command.migrator.ddl = Migrate.ddl
+    version = "2_20230101000000_update.py"
+    checkpoint = Checkpoint(conn, Migrate.ddl, "models", version)
+    await checkpoint.load()
+    assert checkpoint.section is None
+    # the first statement was applied before the failure
+    await conn.execute_script('CREATE TABLE "resumed" ("id" INT NOT NULL)')
+    await checkpoint.save("upgrade", 1)
+    assert checkpoint.is_applied("pre_upgrade", 5)
+    assert not checkpoint.is_applied("post_upgrade", 0)
+
+    checkpoint = Checkpoint(conn, Migrate.ddl, "models", version)
+    await checkpoint.load()
+    await command._execute_script(
+        conn,
+        'CREATE TABLE "resumed" ("id" INT NOT NULL);\n'
+        'INSERT INTO "resumed" VALUES (1);\n'
+        'DROP TABLE "resumed";',
+        version=version,
+        checkpoint=checkpoint,
+    )
+
+    assert [timing.sql for timing in command.statement_timings] == [
+        'INSERT INTO "resumed" VALUES (1)',
+        'DROP TABLE "resumed"',
+    ]
+    checkpoint = Checkpoint(conn, Migrate.ddl, "models", version)
+    await checkpoint.load()
+    assert (checkpoint.section, checkpoint.statements) == ("upgrade", 3)
+    await checkpoint.delete()
+    await checkpoint.load()
+    assert checkpoint.section is None
+
+
+async def test_retry_on_lock_timeout():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({}, lock_retry_seconds=1)
+    command.migrator.ddl = Migrate.ddl
+    command._LOCK_RETRY_DELAY = 0.01
+    errors = [OperationalError("database is locked")] * 2
+
+    async def statement():
+        if errors:
+            raise errors.pop()
+        return 1
+
+    conn = Tortoise.get_connection("default")
+    assert await command._retry_on_lock_timeout(conn, None, "SELECT 1", statement) == 1
+    assert not errors
+
+    errors = [OperationalError("no such table: missing")]
+    with pytest.raises(OperationalError):
+        await command._retry_on_lock_timeout(conn, None, "SELECT 1", statement)
+    assert not errors
+
+    command.lock_retry_seconds = 0
+    errors = [OperationalError("database is locked")] * 2
+    with pytest.raises(OperationalError):
+        await command._retry_on_lock_timeout(conn, None, "SELECT 1", statement)
+    assert len(errors) == 1
+
+
+async def test_upgrade_batch():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({"apps": {"models": {"default_connection": "default"}}})
+    command.migrator.ddl = Migrate.ddl
+
+    def migration(sql: str, **kwargs):
+        async def upgrade(db):
+            return sql
+
+        return SimpleNamespace(upgrade=upgrade, **kwargs)
+
+    async def post_upgrade(db):
+        return []
+
+    assert command._can_batch(migration(""))
+    assert not command._can_batch(migration("", atomic=False))
+    assert not command._can_batch(migration("", post_upgrade=post_upgrade))
+
+    versions = [
+        ("1_20230101000000_batch.py", migration('CREATE TABLE "batch" ("id" INT NOT NULL);')),
+        ("2_20230101000000_batch.py", migration('INSERT INTO "missing" VALUES (1);')),
+    ]
+    with pytest.raises(OperationalError):
+        await command._upgrade_batch(versions, SnapshotEncoder(), {})
+    assert not await Aerich.filter(version__endswith="_batch.py").exists()
+
+    versions[1] = ("2_20230101000000_batch.py", migration('DROP TABLE "batch";'))
+    assert await command._upgrade_batch(versions, SnapshotEncoder(), {}) == [
+        "1_20230101000000_batch.py",
+        "2_20230101000000_batch.py",
+    ]
+    assert await Aerich.filter(version__endswith="_batch.py").order_by("id").values_list(
+        "version", flat=True
+    ) == ["1_20230101000000_batch.py", "2_20230101000000_batch.py"]
+    await Aerich.filter(version__endswith="_batch.py").delete()
+
+
+async def test_upgrade_batch_session_settings():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({"apps": {"models": {"default_connection": "default"}}})
+    command.migrator.ddl = Migrate.ddl
+    conn = Tortoise.get_connection("default")
+    _, rows = await conn.execute_query("PRAGMA busy_timeout")
+    busy_timeout = rows[0][0]
+
+    async def upgrade(db):
+        _, rows = await db.execute_query("PRAGMA busy_timeout")
+        busy_timeouts.append(rows[0][0])
+        return ""
+
+    busy_timeouts = []
+    versions = [
+        ("1_20230101000000_batch_settings.py", SimpleNamespace(upgrade=upgrade, lock_timeout=1)),
+        ("2_20230101000000_batch_settings.py", SimpleNamespace(upgrade=upgrade, lock_timeout=2)),
+        ("3_20230101000000_batch_settings.py", SimpleNamespace(upgrade=upgrade)),
+    ]
+    await command._upgrade_batch(versions, SnapshotEncoder(), {})
+
+    # the settings of a file are restored before the next file of the batch
+    assert busy_timeouts == [1000, 2000, busy_timeout]
+    await Aerich.filter(version__endswith="_batch_settings.py").delete()
+
+
+async def test_upgrade_version_session_settings():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({"apps": {"models": {"default_connection": "default"}}})
+    command.migrator.ddl = Migrate.ddl
+    busy_timeouts = []
+
+    def spy(run):
+        async def run_statement(conn, sql, *args):
+            _, rows = await conn.execute_query("PRAGMA busy_timeout")
+            busy_timeouts.append(rows[0][0])
+            return await run(conn, sql, *args)
+
+        return run_statement
+
+    command._run_statement = spy(command._run_statement)
+    command._run_non_transactional_statement = spy(command._run_non_transactional_statement)
+
+    async def upgrade(db):
+        return "SELECT 1;"
+
+    async def non_transactional(db):
+        return ["SELECT 1"]
+
+    conn = Tortoise.get_connection("default")
+    _, rows = await conn.execute_query("PRAGMA busy_timeout")
+    busy_timeout = rows[0][0]
+    for atomic in (True, False):
+        m = SimpleNamespace(
+            upgrade=upgrade,
+            pre_upgrade=non_transactional,
+            post_upgrade=non_transactional,
+            atomic=atomic,
+            lock_timeout=3,
+        )
+        await command._upgrade_version(f"{atomic}_settings.py", m, SnapshotEncoder(), {})
+
+    # pre_upgrade, upgrade and post_upgrade statements of both files run with the setting
+    assert busy_timeouts == [3000] * 6
+    _, rows = await conn.execute_query("PRAGMA busy_timeout")
+    assert rows[0][0] == busy_timeout
+    await Aerich.filter(version__endswith="_settings.py").delete()
+
+
+async def test_upgrade_version_post_upgrade_fails():
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    command = Command({"apps": {"models": {"default_connection": "default"}}})
+    command.migrator.ddl = Migrate.ddl
+    conn = Tortoise.get_connection("default")
+    version = "3_20230101000000_post_upgrade.py"
+    post_upgrade_sql = ['INSERT INTO "post" VALUES (1)', 'INSERT INTO "missing" VALUES (1)']
+
+    async def upgrade(db):
+        return 'CREATE TABLE "post" ("id" INT NOT NULL);'
+
+    async def post_upgrade(db):
+        return post_upgrade_sql
+
+    m = SimpleNamespace(upgrade=upgrade, post_upgrade=post_upgrade)
+    with pytest.raises(OperationalError):
+        await command._upgrade_version(version, m, SnapshotEncoder(), {})
+    # the transaction is committed, the version isn't recorded until post_upgrade succeeds
+    assert not await Aerich.filter(version=version).exists()
+    checkpoint = Checkpoint(conn, Migrate.ddl, "models", version)
+    await checkpoint.load()
+    assert (checkpoint.section, checkpoint.statements) == ("post_upgrade", 1)
+
+    # upgrading again runs the rest of post_upgrade only
+    post_upgrade_sql[1] = 'INSERT INTO "post" VALUES (2)'
+    command.statement_timings = []
+    await command._upgrade_version(version, m, SnapshotEncoder(), {})
+    assert [timing.sql for timing in command.statement_timings] == [post_upgrade_sql[1]]
+    assert await Aerich.filter(version=version).exists()
+    checkpoint = Checkpoint(conn, Migrate.ddl, "models", version)
+    await checkpoint.load()
+    assert checkpoint.section is None
+    await conn.execute_script('DROP TABLE "post"')
+    await Aerich.filter(version=version).delete()
+
+
+async def test_alter_shadow_table_chunks(mocker: MockerFixture):
+    command = Command({}, shadow_chunk_size=2, shadow_chunk_sleep=0.5)
+    command.migrator.ddl = MysqlDDL(Migrate.ddl.client)
+    mocker.patch("aerich.get_app_connection", return_value=Migrate.ddl.client)
+    run = mocker.patch.object(ShadowTable, "run", autospec=True)
+    assert await command._alter_shadow_table("ALTER TABLE `product` ADD `tag` INT")
+    shadow = run.call_args[0][0]
+    assert (shadow.table_name, shadow.chunk_size, shadow.chunk_sleep) == ("product", 2, 0.5)
+
+
+async def test_lock_timeout_retry(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    if not isinstance(Migrate.ddl, SqliteDDL):
+        return
+    path = str(tmp_path / "lock.sqlite3")
+    client = SqliteClient(file_path=path, connection_name="lock")
+    await client.create_connection(with_db=True)
+    await client.execute_script('CREATE TABLE "locked" ("id" INT NOT NULL)')
+    command = Command({}, lock_retry_seconds=10)
+    command.migrator.ddl = Migrate.ddl
+    command._LOCK_RETRY_DELAY = 0.05
+    settings = Migrate.ddl.get_migration_settings(lock_timeout=0.1)
+    holder = sqlite3.connect(path, isolation_level=None)
+    holder.execute("BEGIN EXCLUSIVE")
+    try:
+        async with command._session_settings(client, settings):
+            # the statement times out waiting for the lock
+            with pytest.raises(OperationalError, match="locked"):
+                await command._execute_non_transactional(
+                    client, ['INSERT INTO "locked" VALUES (1)']
+                )
+            # and succeeds once it's released
+            asyncio.get_event_loop().call_later(0.3, holder.execute, "COMMIT")
+            await command._execute_non_transactional(
+                client, ['INSERT INTO "locked" VALUES (1)'], lock_retry=True
+            )
+        assert await client.execute_query_dict('SELECT "id" FROM "locked"') == [{"id": 1}]
+        assert "timed out waiting for a lock" in caplog.text
+    finally:
+        holder.close()
+        await client.close()
+
+
+def test_rename_fields_by_signature(mocker: MockerFixture):
+    prompt = mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    for field in old_models_describe["models.Product"]["data_fields"]:
+        if field["name"] == "pic":
+            field["name"] = field["db_column"] = "image"
+        elif field["name"] == "name":
+            field["name"] = field["db_column"] = "title"
+    Migrate.app = "models"
+
+    Migrate.diff_models(old_models_describe, models_describe)
+    Migrate._merge_operators()
+
+    assert {call.args[0] for call in prompt.call_args_list} == {
+        "Rename image to pic?",
+        "Rename title to name?",
+    }
+    assert len(Migrate.upgrade_operators) == 2
+    assert len(Migrate.downgrade_operators) == 2
+
+
+def test_remove_indexed_field():
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_field = dict(old_models_describe["models.Email"]["data_fields"][0])
+    old_field.update(name="old_email", db_column="old_email", unique=True, indexed=True)
+    old_models_describe["models.Email"]["data_fields"].append(old_field)
+    Migrate.app = "models"
+
+    Migrate.diff_models(old_models_describe, models_describe)
+    Migrate._merge_operators()
+
+    assert Migrate.upgrade_operators == [
+        Migrate.ddl.drop_index(Email, ["old_email"], True),
+        Migrate.ddl.drop_column(Email, "old_email"),
+    ]
+    assert Migrate.downgrade_operators == [
+        Migrate.ddl.add_column(Email, old_field),
+        Migrate.ddl.add_index(Email, ["old_email"], True),
+    ]
+
+
+def test_migrators_keep_own_operators():
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_models_describe.pop("models.Email")
+    migrator, other_migrator = Migrator("models"), Migrator("models")
+    migrator.ddl = other_migrator.ddl = Migrate.ddl
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators()
+
+    assert migrator.upgrade_operators
+    assert other_migrator.upgrade_operators == []
+    assert Migrate.upgrade_operators == []
+
+
+@pytest.mark.parametrize("ddl_class", [MysqlDDL, PostgresDDL])
+def test_merge_operators_coalesce(mocker: MockerFixture, ddl_class):
+    mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_fields = old_models_describe["models.Product"]["data_fields"]
+    for field in old_fields:
+        if field["name"] == "pic":
+            field["name"] = field["db_column"] = "image"
+        elif field["name"] == "name":
+            field["constraints"] = {"max_length": 40}
+            field["db_field_types"] = {"": "VARCHAR(40)"}
+    old_fields.remove(next(field for field in old_fields if field["name"] == "sort"))
+    migrator = Migrator("models")
+    migrator.ddl = ddl_class(Tortoise.get_connection("default"))
+    migrator.dialect = migrator.ddl.DIALECT
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators(coalesce=True)
+
+    if ddl_class is MysqlDDL:
+        assert migrator.upgrade_operators == [
+            "ALTER TABLE `product` ADD `sort` INT NOT NULL, RENAME COLUMN `image` TO `pic`, "
+            "MODIFY COLUMN `name` VARCHAR(50) NOT NULL",
+        ]
+    else:
+        assert sorted(migrator.upgrade_operators) == [
+            'ALTER TABLE "product" ADD "sort" INT NOT NULL, '
+            'ALTER COLUMN "name" TYPE VARCHAR(50)',
+            'ALTER TABLE "product" RENAME COLUMN "image" TO "pic"',
+        ]
+
+
+def test_merge_operators_online(mocker: MockerFixture):
+    mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_models_describe["models.Product"]["indexes"] = []
+    old_fields = old_models_describe["models.Product"]["data_fields"]
+    old_fields.remove(next(field for field in old_fields if field["name"] == "sort"))
+    migrator = Migrator("models")
+    migrator.ddl = PostgresDDL(Tortoise.get_connection("default"))
+    migrator.dialect = migrator.ddl.DIALECT
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators(online=True)
+
+    assert migrator.upgrade_operators == ['ALTER TABLE "product" ADD "sort" INT NOT NULL']
+    assert migrator.post_upgrade_operators == [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS "idx_product_name_869427" ON "product" '
+        '("name", "type_db_alias")'
+    ]
+    assert migrator.downgrade_operators == ['ALTER TABLE "product" DROP COLUMN "sort"']
+    assert migrator.pre_downgrade_operators == [
+        'DROP INDEX CONCURRENTLY IF EXISTS "idx_product_name_869427"'
+    ]
+    assert migrator.pre_upgrade_operators == migrator.post_downgrade_operators == []
+    content = migrator._get_diff_file_content()
+    assert content.startswith(
+        MIGRATE_TEMPLATE.format(
+            upgrade_sql='ALTER TABLE "product" ADD "sort" INT NOT NULL;',
+            downgrade_sql='ALTER TABLE "product" DROP COLUMN "sort";',
+        )
+    )
+    assert "async def post_upgrade(db: BaseDBAsyncClient) -> list:" in content
+    assert "async def pre_downgrade(db: BaseDBAsyncClient) -> list:" in content
+    assert "async def pre_upgrade" not in content
+
+
+def test_merge_operators_online_fk(mocker: MockerFixture):
+    mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_config = old_models_describe["models.Config"]
+    old_config["fk_fields"] = []
+    old_config["data_fields"] = [
+        field for field in old_config["data_fields"] if field["name"] != "user_id"
+    ]
+    migrator = Migrator("models")
+    migrator.ddl = PostgresDDL(Tortoise.get_connection("default"))
+    migrator.dialect = migrator.ddl.DIALECT
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators(online=True)
+
+    assert migrator.upgrade_operators == [
+        'ALTER TABLE "config" ADD "user_id" INT NOT NULL',
+        'ALTER TABLE "config" ADD CONSTRAINT "fk_config_user_17daa970" FOREIGN KEY ("user_id") '
+        'REFERENCES "user" ("id") ON DELETE CASCADE NOT VALID',
+    ]
+    assert migrator.post_upgrade_operators == [
+        'ALTER TABLE "config" VALIDATE CONSTRAINT "fk_config_user_17daa970"'
+    ]
+    assert migrator.downgrade_operators == [
+        'ALTER TABLE "config" DROP CONSTRAINT "fk_config_user_17daa970"',
+        'ALTER TABLE "config" DROP COLUMN "user_id"',
+    ]
+    assert migrator.pre_downgrade_operators == migrator.post_downgrade_operators == []
+
+
+def test_merge_operators_online_not_null(mocker: MockerFixture):
+    mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    for field in old_models_describe["models.Product"]["data_fields"]:
+        if field["name"] == "name":
+            field["nullable"] = True
+    migrator = Migrator("models")
+    migrator.ddl = PostgresDDL(Tortoise.get_connection("default"))
+    migrator.dialect = migrator.ddl.DIALECT
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators(online=True)
+
+    assert migrator.upgrade_operators == [
+        'ALTER TABLE "product" ADD CONSTRAINT "chk_product_name_683352" '
+        'CHECK ("name" IS NOT NULL) NOT VALID'
+    ]
+    assert migrator.post_upgrade_operators == [
+        'ALTER TABLE "product" VALIDATE CONSTRAINT "chk_product_name_683352"',
+        'ALTER TABLE "product" ALTER COLUMN "name" SET NOT NULL',
+        'ALTER TABLE "product" DROP CONSTRAINT "chk_product_name_683352"',
+    ]
+    assert migrator.pre_upgrade_operators == []
+    assert migrator.downgrade_operators == [
+        'ALTER TABLE "product" ALTER COLUMN "name" DROP NOT NULL'
+    ]
+
+
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_merge_operators_online_algorithm(mocker: MockerFixture, coalesce: bool):
+    mocker.patch("click.prompt", return_value=True)
+    models_describe = get_models_describe("models")
+    old_models_describe = get_models_describe("models")
+    old_models_describe["models.Product"]["indexes"] = []
+    old_fields = old_models_describe["models.Product"]["data_fields"]
+    old_fields.remove(next(field for field in old_fields if field["name"] == "sort"))
+    migrator = Migrator("models")
+    migrator.ddl = MysqlDDL(Tortoise.get_connection("default"))
+    migrator.dialect = migrator.ddl.DIALECT
+    migrator._db_version = "8.0.30"
+
+    migrator.diff_models(old_models_describe, models_describe)
+    migrator._merge_operators(coalesce=coalesce, online=True)
+
+    if coalesce:
+        assert migrator.upgrade_operators == [
+            "ALTER TABLE `product` ADD INDEX `idx_product_name_869427` (`name`, `type_db_alias`), "
+            "ADD `sort` INT NOT NULL, ALGORITHM=INPLACE, LOCK=NONE"
+        ]
+        assert migrator.downgrade_operators == [
+            "ALTER TABLE `product` DROP INDEX `idx_product_name_869427`, DROP COLUMN `sort`, "
+            "ALGORITHM=INPLACE, LOCK=NONE"
+        ]
+    else:
+        assert migrator.upgrade_operators == [
+            "ALTER TABLE `product` ADD INDEX `idx_product_name_869427` (`name`, `type_db_alias`), "
+            "ALGORITHM=INPLACE, LOCK=NONE",
+            "ALTER TABLE `product` ADD `sort` INT NOT NULL, ALGORITHM=INSTANT",
+        ]
+        assert migrator.downgrade_operators == [
+            "ALTER TABLE `product` DROP INDEX `idx_product_name_869427`, "
+            "ALGORITHM=INPLACE, LOCK=NONE",
+            "ALTER TABLE `product` DROP COLUMN `sort`, ALGORITHM=INSTANT",
+        ]
@@ -0,0 +1,144 @@
+from tortoise import Tortoise
+
+from aerich.ddl.mysql import MysqlDDL
+from aerich.ddl.postgres import PostgresDDL
+from aerich.migrate import Migrate, Migrator
+from aerich.operations import (
+    AddColumn,
+    AddIndex,
+    AlterDefault,
+    AlterNull,
+    DropColumn,
+    ModifyColumn,
+    Operation,
+    column_resource,
+    constraint_resource,
+    optimize_operations,
+    sort_operations,
+    table_resource,
+)
+from tests.models import Category, Product, User
+
+
+def test_sort_operations():
+    add_fk = Operation(
+        'ALTER TABLE "config" ADD CONSTRAINT "fk_config_user" FOREIGN KEY ("user_id")',
+        requires=[column_resource("config", "user_id")],
+        provides=[constraint_resource("config", "fk_config_user")],
+    )
+    add_column = Operation(
+        'ALTER TABLE "config" ADD "user_id" INT NOT NULL',
+        provides=[column_resource("config", "user_id")],
+    )
+    rename_table = Operation(
+        'ALTER TABLE "configs" RENAME TO "config"',
+        provides=[table_resource("config")],
+        removes=[table_resource("configs")],
+    )
+    drop_column = Operation(
+        'ALTER TABLE "user" DROP COLUMN "avatar"', removes=[column_resource("user", "avatar")]
+    )
+
+    layers = sort_operations([add_fk, add_column, rename_table, drop_column])
+
+    assert layers == [[rename_table, drop_column], [add_column], [add_fk]]
+
+
+def test_sort_operations_drop_before_remove():
+    drop_fk = Operation(
+        'ALTER TABLE "config" DROP CONSTRAINT "fk_config_user"',
+        requires=[column_resource("config", "user_id")],
+        removes=[constraint_resource("config", "fk_config_user")],
+    )
+    drop_column = Operation(
+        'ALTER TABLE "config" DROP COLUMN "user_id"',
+        removes=[column_resource("config", "user_id")],
+    )
+    rename_table = Operation(
+        'ALTER TABLE "config" RENAME TO "configs"',
+        provides=[table_resource("configs")],
+        removes=[table_resource("config")],
+    )
+
+    layers = sort_operations([rename_table, drop_column, drop_fk])
+
+    assert layers == [[drop_fk], [drop_column], [rename_table]]
+
+
+def test_sort_operations_drop_fk_before_drop_table():
+    migrator = Migrator("models")
+    migrator.ddl = Migrate.ddl
+    drop_table = migrator.drop_model(User._meta.db_table)
+    drop_fk = migrator._drop_fk(
+        Category, Category._meta.fields_map["user"].describe(False), User.describe(False)
+    )
+
+    assert sort_operations([drop_table, drop_fk]) == [[drop_fk], [drop_table]]
+
+
+def test_sort_operations_cycle():
+    first = Operation("first", requires=[table_resource("b")], provides=[table_resource("a")])
+    second = Operation("second", requires=[table_resource("a")], provides=[table_resource("b")])
+
+    assert sort_operations([first, second]) == [[first, second]]
+
+
+def _get_field_describe(model, name: str) -> dict:
+    return next(
+        field for field in model.describe(serializable=True)["data_fields"] if field["name"] == name
+    )
+
+
+def test_optimize_operations_fold_alter_default_null():
+    ddl = PostgresDDL(Tortoise.get_connection("default"))
+    field_describe = _get_field_describe(Product, "view_num")
+    old_field_describe = dict(field_describe, default=None, nullable=True)
+
+    operations = optimize_operations(
+        [
+            AlterDefault(Product, field_describe, old_field_describe),
+            AlterNull(Product, field_describe, old_field_describe),
+        ],
+        ddl,
+    )
+
+    assert [operation.render(ddl) for operation in operations] == [
+        'ALTER TABLE "product" ALTER COLUMN "view_num" SET DEFAULT 0, '
+        'ALTER COLUMN "view_num" SET NOT NULL'
+    ]
+
+
+def test_optimize_operations_noop_and_duplicate():
+    ddl = MysqlDDL(Tortoise.get_connection("default"))
+    field_describe = _get_field_describe(Product, "name")
+    old_field_describe = dict(field_describe, nullable=True)
+
+    operations = optimize_operations(
+        [
+            # same database type, nothing to change
+            ModifyColumn(Product, field_describe, dict(field_describe, python_type="str")),
+            AlterNull(Product, field_describe, old_field_describe),
+            ModifyColumn(Product, field_describe, old_field_describe),
+        ],
+        ddl,
+    )
+
+    assert [operation.render(ddl) for operation in operations] == [
+        "ALTER TABLE `product` MODIFY COLUMN `name` VARCHAR(50) NOT NULL"
+    ]
+
+
+def test_optimize_operations_cancel():
+    ddl = PostgresDDL(Tortoise.get_connection("default"))
+    field_describe = _get_field_describe(Product, "name")
+    add_column = AddColumn(Product, field_describe, provides=[column_resource("product", "name")])
+    drop_column = DropColumn(Product, "name", removes=[column_resource("product", "name")])
+
+    assert optimize_operations([add_column, drop_column], ddl) == []
+
+    add_index = AddIndex(Product, ["name"], requires=[column_resource("product", "name")])
+    assert optimize_operations([add_column, add_index, drop_column], ddl) == [
+        add_column,
+        add_index,
+        drop_column,
+    ]
@@ -0,0 +1,57 @@
+from tortoise.indexes import Index
+
+from aerich.snapshot import (
+    SnapshotEncoder,
+    apply_delta,
+    get_delta_base,
+    get_fingerprint,
+    is_delta,
+    normalize,
+)
+from aerich.utils import get_models_describe
+
+
+def test_snapshot_encoder():
+    models_describe = get_models_describe("models")
+    changed_describe = get_models_describe("models")
+    changed_describe["models.User"]["data_fields"].pop()
+    snapshot_encoder = SnapshotEncoder(interval=3)
+
+    contents = [
+        snapshot_encoder.encode("0_init.py", models_describe),
+        snapshot_encoder.encode("1_update.py", changed_describe),
+        snapshot_encoder.encode("2_update.py", changed_describe),
+        snapshot_encoder.encode("3_update.py", models_describe),
+    ]
+    assert not is_delta(contents[0])
+    assert is_delta(contents[1]) and get_delta_base(contents[1]) == "0_init.py"
+    assert is_delta(contents[2]) and get_delta_base(contents[2]) == "0_init.py"
+    assert not is_delta(contents[3])
+
+    base = contents[0]
+    assert apply_delta(base, contents[1])["models.User"] == changed_describe["models.User"]
+    assert apply_delta(base, contents[2]) == apply_delta(base, contents[1])
+
+
+def test_snapshot_encoder_resume():
+    models_describe = get_models_describe("models")
+    snapshot_encoder = SnapshotEncoder()
+    base = snapshot_encoder.encode("0_init.py", models_describe)
+    content = snapshot_encoder.encode("1_update.py", models_describe)
+    assert content["delta"]["changes"] == []
+
+    snapshot_encoder = SnapshotEncoder.from_last_version("1_update.py", content, base)
+    content = snapshot_encoder.encode("2_update.py", models_describe)
+    assert get_delta_base(content) == "0_init.py"
+    assert content["delta"]["depth"] == 2
+
+
+def test_get_fingerprint():
+    models_describe = get_models_describe("models")
+    describe = models_describe["models.Product"]
+    describe["indexes"] = [Index(fields=("name",))]
+    stored = normalize(describe)
+    assert get_fingerprint(stored) == get_fingerprint(describe)
+
+    stored["indexes"][0].fields = ["name", "type"]
+    assert get_fingerprint(stored) != get_fingerprint(describe)
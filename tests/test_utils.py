@@ -1,6 +1,133 @@
-from aerich.utils import import_py_file
+import pytest
+from tortoise.backends.asyncpg import AsyncpgDBClient
+
+from aerich.utils import dedicated_connection, dedicated_transaction, import_py_file, split_sql
 
 
 def test_import_py_file():
     m = import_py_file("aerich/utils.py")
     assert getattr(m, "import_py_file")
+
+
+def test_split_sql():
+    assert split_sql('ALTER TABLE "a" ADD "b" INT;\nALTER TABLE "a" ADD "c" INT;\n') == [
+        'ALTER TABLE "a" ADD "b" INT',
+        'ALTER TABLE "a" ADD "c" INT',
+    ]
+    # semicolons in quotes and comments, comment only statements
+    assert split_sql(
+        "-- add rows;\nINSERT INTO \"a\" VALUES ('b;c', 'it''s');\n/* done; */;\n"
+        'CREATE TRIGGER "t" AFTER INSERT ON "a" BEGIN DELETE FROM "b"; END;'
+    ) == [
+        "-- add rows;\nINSERT INTO \"a\" VALUES ('b;c', 'it''s')",
+        'CREATE TRIGGER "t" AFTER INSERT ON "a" BEGIN DELETE FROM "b"; END',
+    ]
+    assert split_sql(
+        "CREATE FUNCTION f() RETURNS trigger AS $body$ BEGIN RETURN NEW; END; $body$ "
+        "LANGUAGE plpgsql; SELECT $$;$$",
+        "postgres",
+    ) == [
+        "CREATE FUNCTION f() RETURNS trigger AS $body$ BEGIN RETURN NEW; END; $body$ "
+        "LANGUAGE plpgsql",
+        "SELECT $$;$$",
+    ]
+    assert split_sql("SELECT 'a\\';b'; # c;\nSELECT 1", "mysql") == [
+        "SELECT 'a\\';b'",
+        "# c;\nSELECT 1",
+    ]
+    # compound bodies of mysql routines and triggers
+    procedure = (
+        "CREATE DEFINER=`root`@`%` PROCEDURE p(IN n INT) BEGIN\n"
+        "  IF n > 0 THEN SELECT CASE n WHEN 1 THEN 'a' ELSE 'b' END; END IF;\n"
+        "  WHILE n > 0 DO SET n = n - 1; END WHILE;\n"
+        "  BEGIN SELECT 'end;'; END;\n"
+        "END"
+    )
+    function = "CREATE FUNCTION f() RETURNS INT DETERMINISTIC RETURN 1"
+    trigger = "CREATE TRIGGER t BEFORE INSERT ON a FOR EACH ROW SET NEW.b = 1"
+    assert split_sql(f"{procedure};\n{function};\n{trigger};\nSELECT 1;", "mysql") == [
+        procedure,
+        function,
+        trigger,
+        "SELECT 1",
+    ]
+    assert split_sql("BEGIN; SELECT 1; END;", "mysql") == ["BEGIN", "SELECT 1", "END"]
+    # backslash escapes in postgres E'' strings only
+    assert split_sql("SELECT E'a\\';b'; SELECT 'c\\'; SELECT e'd;'", "postgres") == [
+        "SELECT E'a\\';b'",
+        "SELECT 'c\\'",
+        "SELECT e'd;'",
+    ]
+
+
+class FakeTransaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def start(self):
+        self.connection.queries.append("BEGIN")
+
+    async def commit(self):
+        self.connection.queries.append("COMMIT")
+
+    async def rollback(self):
+        self.connection.queries.append("ROLLBACK")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.queries = []
+
+    async def fetch(self, query, *args):
+        self.queries.append(query)
+        return []
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakePool:
+    def __init__(self):
+        self.acquired = []
+        self.released = []
+
+    async def acquire(self):
+        self.acquired.append(FakeConnection())
+        return self.acquired[-1]
+
+    async def release(self, connection):
+        self.released.append(connection)
+
+
+async def test_dedicated_connection():
+    client = AsyncpgDBClient(connection_name="fake", database="fake", host="localhost")
+    client._pool = FakePool()
+    # a pooled client acquires a connection for each query
+    await client.execute_query("SET lock_timeout = 1000")
+    await client.execute_query("SELECT 1")
+    assert len(client._pool.acquired) == 2
+
+    client._pool = FakePool()
+    async with dedicated_connection(client) as conn:
+        await conn.execute_query("SET lock_timeout = 1000")
+        async with dedicated_transaction(conn) as transaction:
+            await transaction.execute_query("SELECT 1")
+        with pytest.raises(ValueError):
+            async with dedicated_transaction(conn):
+                raise ValueError
+        await conn.execute_query("SELECT 2")
+        assert not client._pool.released
+    # the transactions run on the connection too, a pool of one connection is enough
+    assert client._pool.released == client._pool.acquired
+    assert [connection.queries for connection in client._pool.acquired] == [
+        ["SET lock_timeout = 1000", "BEGIN", "SELECT 1", "COMMIT", "BEGIN", "ROLLBACK", "SELECT 2"]
+    ]
+
+
+async def test_dedicated_connection_unknown_pool(mocker):
+    mocker.patch("aerich.utils._POOL_INTERNALS_MAX_VERSION", (0, 0))
+    client = AsyncpgDBClient(connection_name="fake", database="fake", host="localhost")
+    client._pool = FakePool()
+    async with dedicated_connection(client) as conn:
+        # the pooled client is used as is
+        assert conn is client